@@ -0,0 +1,1028 @@
+#!/usr/bin/python
+# encoding: utf-8
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''benchmark-installinstallmacos.py
+Benchmarks for installinstallmacos.py that run entirely offline, against a
+local HTTP server standing in for Apple's softwareupdate servers'''
+
+
+import argparse
+import BaseHTTPServer
+import email.utils
+import hashlib
+import json
+import os
+import platform
+import plistlib
+import shutil
+import socket
+import SocketServer
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from xml.dom import minidom
+
+import installinstallmacos
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Serves files from the server's root directory, supporting single
+    byte-range requests and If-Modified-Since and limiting each connection
+    to the server's bandwidth'''
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_HEAD(self):
+        '''Send headers only'''
+        self.send_file(head=True)
+
+    def do_GET(self):
+        '''Send headers and content'''
+        self.send_file()
+
+    def send_file(self, head=False):
+        '''Send the file named by the request path, or part of it'''
+        self.server.count_request()
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        path = os.path.join(self.server.root, self.path.split('?')[0][1:])
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        since = email.utils.parsedate_tz(
+            self.headers.getheader('if-modified-since') or '')
+        if since and int(os.path.getmtime(path)) <= email.utils.mktime_tz(
+                since):
+            self.send_response(304)
+            self.end_headers()
+            return
+        length = os.path.getsize(path)
+        start, end = 0, length - 1
+        range_header = self.headers.getheader('range')
+        if range_header and self.server.ranges:
+            first, last = range_header.split('=', 1)[1].split('-', 1)
+            start, end = int(first), min(int(last or end), end)
+            self.send_response(206)
+            self.send_header('Content-Range',
+                             'bytes %s-%s/%s' % (start, end, length))
+        else:
+            self.send_response(200)
+        if self.server.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Last-Modified',
+                         email.utils.formatdate(os.path.getmtime(path),
+                                                usegmt=True))
+        self.end_headers()
+        if not head:
+            self.send_bytes(path, start, end)
+
+    def send_bytes(self, path, start, end):
+        '''Send bytes start through end of path at no more than the
+        server's per-connection rate'''
+        began = time.time()
+        sent = 0
+        with open(path, 'rb') as fileobj:
+            fileobj.seek(start)
+            remaining = end - start + 1
+            while remaining:
+                data = fileobj.read(min(64 * 1024, remaining))
+                self.wfile.write(data)
+                remaining -= len(data)
+                sent += len(data)
+                if self.server.rate:
+                    delay = began + float(sent) / self.server.rate - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+
+    def log_message(self, *args):
+        '''Keep the benchmark output readable'''
+        pass
+
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''A local HTTP server for the files under root, run on a background
+    thread, that waits latency seconds before answering each request and
+    counts the connections made to it'''
+
+    daemon_threads = True
+
+    def __init__(self, root, rate=None, ranges=True, latency=0):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, ('127.0.0.1', 0), StandInHandler)
+        self.root = root
+        self.rate = rate
+        self.ranges = ranges
+        self.latency = latency
+        self.connections = 0
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def count_request(self):
+        '''Count a request'''
+        with self.lock:
+            self.requests += 1
+
+    def reset_counts(self):
+        '''Start counting connections and requests again'''
+        with self.lock:
+            self.connections = self.requests = 0
+
+    def finish_request(self, request, client_address):
+        '''Count each connection as it is handled'''
+        with self.lock:
+            self.connections += 1
+        BaseHTTPServer.HTTPServer.finish_request(
+            self, request, client_address)
+
+    def handle_error(self, request, client_address):
+        '''Clients abandoning a transfer part way through is expected'''
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(
+                self, request, client_address)
+
+    def start(self):
+        '''Start serving; returns the base URL of the server'''
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return 'http://127.0.0.1:%s' % self.server_address[1]
+
+
+def md5_of(path):
+    '''Returns the hex MD5 digest of the file at path'''
+    digest = hashlib.md5()
+    with open(path, 'rb') as fileobj:
+        for block in iter(lambda: fileobj.read(1024 * 1024), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def make_package(path, size):
+    '''Write size bytes of incompressible data to path'''
+    block = os.urandom(1024 * 1024)
+    with open(path, 'wb') as fileobj:
+        for _ in range(size // len(block)):
+            fileobj.write(block)
+        fileobj.write(block[:size % len(block)])
+
+
+def benchmark_segments(args):
+    '''Time replicate_url on one large package with different numbers of
+    byte-range segments, against a server that limits each connection'''
+    tmpdir = tempfile.mkdtemp()
+    try:
+        serve_dir = os.path.join(tmpdir, 'serve')
+        os.makedirs(serve_dir)
+        size = args.size * 1024 * 1024
+        package = os.path.join(serve_dir, 'InstallESD.dmg')
+        make_package(package, size)
+        expected = md5_of(package)
+
+        print '%-12s %-8s %10s %12s' % ('Segments', 'Ranges', 'Seconds',
+                                         'MB/s')
+        for ranges in (True, False):
+            server = StandInServer(serve_dir, rate=args.rate * 1024 * 1024,
+                                   ranges=ranges)
+            url = server.start() + '/InstallESD.dmg'
+            for segments in args.segments:
+                workdir = os.path.join(tmpdir, 'workdir')
+                shutil.rmtree(workdir, ignore_errors=True)
+                began = time.time()
+                local_path = installinstallmacos.replicate_url(
+                    url, root_dir=workdir, size=size, segments=segments)
+                elapsed = time.time() - began
+                if md5_of(local_path) != expected:
+                    print >> sys.stderr, 'Downloaded file does not match!'
+                    exit(-1)
+                print '%-12s %-8s %10.2f %12.1f' % (
+                    segments, ranges and 'yes' or 'no', elapsed,
+                    args.size / elapsed)
+            server.shutdown()
+            server.server_close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+CATALOG_PRODUCT = '''
+        <key>%(product_id)s</key>
+        <dict>
+            <key>Distributions</key>
+            <dict>
+                <key>English</key>
+                <string>%(base)s/%(product_id)s/%(product_id)s.English.dist</string>
+                <key>French</key>
+                <string>%(base)s/%(product_id)s/%(product_id)s.French.dist</string>
+            </dict>%(extended)s
+            <key>Packages</key>
+            <array>%(packages)s
+            </array>
+            <key>PostDate</key>
+            <date>2018-09-24T17:00:00Z</date>
+            <key>ServerMetadataURL</key>
+            <string>%(base)s/%(product_id)s/%(product_id)s.smd</string>
+        </dict>'''
+
+CATALOG_INSTALLER = '''
+            <key>ExtendedMetaInfo</key>
+            <dict>
+                <key>InstallAssistantPackageIdentifiers</key>
+                <dict>
+                    <key>OSInstall</key>
+                    <string>com.apple.mpkg.OSInstall</string>
+                </dict>
+            </dict>'''
+
+CATALOG_PACKAGE = '''
+                <dict>%(digest)s
+                    <key>MetadataURL</key>
+                    <string>%(base)s/%(product_id)s/Package%(index)s.pkm</string>
+                    <key>Size</key>
+                    <integer>%(size)s</integer>
+                    <key>URL</key>
+                    <string>%(base)s/%(product_id)s/Package%(index)s.pkg</string>
+                </dict>'''
+
+CATALOG_DIGEST = '''
+                    <key>Digest</key>
+                    <string>%s</string>'''
+
+
+def make_catalog(path, products, installers, base='http://127.0.0.1',
+                 packages=None):
+    '''Write a synthetic sucatalog with products entries, the first
+    installers of which look like macOS installers. packages may map
+    product ids to a list of (size, digest) tuples describing their
+    packages; a digest of None leaves it out. Returns the product ids of
+    the installers.'''
+    installer_ids = []
+    with open(path, 'w') as fileobj:
+        fileobj.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                      '<plist version="1.0">\n<dict>\n'
+                      '    <key>CatalogVersion</key>\n'
+                      '    <integer>2</integer>\n'
+                      '    <key>Products</key>\n    <dict>')
+        for number in range(products):
+            product_id = '041-%05d' % number
+            extended = ''
+            if number < installers:
+                extended = CATALOG_INSTALLER
+                installer_ids.append(product_id)
+            described = (packages or {}).get(product_id) or [
+                (1024 * (index + 1),
+                 hashlib.sha1(product_id + str(index)).hexdigest())
+                for index in range(4)]
+            entries = ''.join(
+                CATALOG_PACKAGE % {
+                    'base': base, 'product_id': product_id, 'index': index,
+                    'size': size,
+                    'digest': digest and CATALOG_DIGEST % digest or ''}
+                for index, (size, digest) in enumerate(described))
+            fileobj.write(CATALOG_PRODUCT % {
+                'base': base, 'product_id': product_id,
+                'extended': extended, 'packages': entries})
+        fileobj.write('\n    </dict>\n</dict>\n</plist>\n')
+    return installer_ids
+
+
+# run in a fresh interpreter so each parser's peak memory use is its own
+CATALOG_PARSERS = {
+    'plistlib': ('catalog = installinstallmacos.plistlib.readPlist(path); '
+                 'installinstallmacos.find_mac_os_installers(catalog)'),
+    'streaming': ('catalog = installinstallmacos.parse_sucatalog('
+                  'path, installinstallmacos.is_mac_os_installer); '
+                  'installinstallmacos.find_mac_os_installers(catalog)'),
+}
+
+CATALOG_WORKER = '''
+import resource, sys, time
+sys.path.insert(0, %(libdir)r)
+import installinstallmacos
+path = %(path)r
+began = time.time()
+%(parser)s
+elapsed = time.time() - began
+peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+if sys.platform != 'darwin':
+    peak *= 1024
+print elapsed, peak
+'''
+
+
+def check_catalog_parser(path):
+    '''Returns a list of the ways parse_sucatalog's results for the catalog
+    at path, filtered and unfiltered, differ from plistlib's'''
+    expected = plistlib.readPlist(path)
+    mismatches = []
+    if installinstallmacos.parse_sucatalog(path) != expected:
+        mismatches.append('unfiltered')
+    expected['Products'] = dict(
+        (product_key, product)
+        for product_key, product in expected['Products'].items()
+        if installinstallmacos.is_mac_os_installer(product))
+    if installinstallmacos.parse_sucatalog(
+            path, installinstallmacos.is_mac_os_installer) != expected:
+        mismatches.append('filtered')
+    return mismatches
+
+
+def benchmark_catalog(args):
+    '''Compare parsing a large synthetic catalog with plistlib against the
+    streaming parser'''
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'index.sucatalog')
+        make_catalog(path, args.products, args.installers)
+        print 'Catalog of %s products, %s' % (
+            args.products, installinstallmacos.human_size(
+                os.path.getsize(path)))
+        mismatches = check_catalog_parser(path)
+        if mismatches:
+            print >> sys.stderr, 'MISMATCH with plistlib: %s' % (
+                ', '.join(mismatches))
+            exit(-1)
+        print 'Streaming parser matches plistlib, filtered and unfiltered'
+        print '%-12s %10s %12s' % ('Parser', 'Seconds', 'Peak RSS')
+        libdir = os.path.dirname(os.path.abspath(__file__))
+        for name in sorted(CATALOG_PARSERS):
+            output = subprocess.check_output([
+                sys.executable, '-c', CATALOG_WORKER % {
+                    'libdir': libdir, 'path': path,
+                    'parser': CATALOG_PARSERS[name]}])
+            elapsed, peak = output.split()
+            print '%-12s %10.2f %12s' % (
+                name, float(elapsed),
+                installinstallmacos.human_size(int(peak)))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def minidom_parse_dist(filename):
+    '''The DOM-based parse_dist installinstallmacos.py used to have, kept
+    as the reference for the streaming parser'''
+    dist_info = {}
+    try:
+        dom = minidom.parse(filename)
+    except Exception:
+        return dist_info
+    auxinfos = dom.getElementsByTagName('auxinfo')
+    if not auxinfos:
+        return dist_info
+    auxinfo = auxinfos[0]
+    key = None
+    value = None
+    children = auxinfo.childNodes
+    dict_nodes = [n for n in auxinfo.childNodes
+                  if n.nodeType == n.ELEMENT_NODE and
+                  n.tagName == 'dict']
+    if dict_nodes:
+        children = dict_nodes[0].childNodes
+    for node in children:
+        if node.nodeType == node.ELEMENT_NODE and node.tagName == 'key':
+            key = node.firstChild.wholeText
+        if node.nodeType == node.ELEMENT_NODE and node.tagName == 'string':
+            value = node.firstChild.wholeText
+        if key and value:
+            dist_info[key] = value
+            key = None
+            value = None
+    return dist_info
+
+
+DIST_TEMPLATE = '''<?xml version="1.0" encoding="utf-8"?>
+<installer-gui-script minSpecVersion="2">
+    <title>SU_TITLE</title>
+    <options hostArchitectures="x86_64" customize="never"/>
+    <script><![CDATA[
+%(script)s
+    ]]></script>
+    <choices-outline>
+        <line choice="InstallAssistantAuto"/>
+    </choices-outline>
+    <choice id="InstallAssistantAuto" title="SU_TITLE" start_visible="false">
+        <pkg-ref id="com.apple.pkg.InstallAssistantAuto"/>
+    </choice>
+    <pkg-ref id="com.apple.pkg.InstallAssistantAuto" installKBytes="%(kbytes)s"
+        version="%(version)s" auth="Root">InstallAssistantAuto.pkg</pkg-ref>
+%(before)s    %(auxinfo)s
+%(after)s</installer-gui-script>
+'''
+
+DIST_AUXINFO = {
+    'nested': '''<auxinfo>
+        <dict>
+            <key>BUILD</key>
+            <string>%(build)s</string>
+            <key>OSVERSION</key>
+            <string>%(version)s</string>
+        </dict>
+    </auxinfo>''',
+    'flat': '''<auxinfo>
+        <key>BUILD</key>
+        <string>%(build)s</string>
+        <key>OSVERSION</key>
+        <string>%(version)s</string>
+    </auxinfo>''',
+    'mixed': '''<auxinfo>
+        <key>IGNORED</key>
+        <string>outside the dict</string>
+        <dict>
+            <key>BUILD</key>
+            <string>%(build)s</string>
+            <!-- the version is wrapped in CDATA and an entity -->
+            <key>OSVERSION</key>
+            <string><![CDATA[%(version)s]]>&#32;</string>
+        </dict>
+        <dict>
+            <key>SECOND</key>
+            <string>ignored too</string>
+        </dict>
+    </auxinfo>''',
+    'missing': '',
+}
+
+
+def dist_localizations(count):
+    '''Returns count localization blocks like the ones embedded in real
+    dist files'''
+    strings = ''.join('"STRING_%s" = "Localized text number %s &amp; more";'
+                      '\n' % (number, number) for number in range(200))
+    return ''.join('    <localization><strings language="Language%s">\n'
+                   '%s    </strings></localization>\n' % (number, strings)
+                   for number in range(count))
+
+
+def make_dist_corpus(directory, count):
+    '''Write count synthetic dist files to directory, covering the auxinfo
+    layouts parse_dist has to handle and placing auxinfo before, between
+    and after large localization blocks'''
+    script = '\n'.join('function check%s() { return system.compareVersions('
+                        'my.target.systemVersion.ProductVersion, "10.%s") '
+                        '>= 0 && "<auxinfo>" != ""; }' % (number, number)
+                        for number in range(300))
+    localizations = dist_localizations(10)
+    layouts = sorted(DIST_AUXINFO)
+    for number in range(count):
+        version = '10.14.%s' % number
+        auxinfo = DIST_AUXINFO[layouts[number % len(layouts)]] % {
+            'build': '18A%03d' % number, 'version': version}
+        before = after = ''
+        placement = number % 3
+        if placement == 1:
+            after = localizations
+        elif placement == 2:
+            before = localizations
+        else:
+            before = after = localizations
+        with open(os.path.join(directory, '%03d.English.dist' % number),
+                  'w') as fileobj:
+            fileobj.write(DIST_TEMPLATE % {
+                'script': script, 'kbytes': 5000000 + number,
+                'version': version, 'auxinfo': auxinfo,
+                'before': before, 'after': after})
+
+
+def benchmark_dist(args):
+    '''Check parse_dist against the minidom reference on a corpus of dist
+    files, then time both. The synthetic corpus is always checked, and any
+    real dist files found under the --corpus directories as well.'''
+    tmpdir = tempfile.mkdtemp()
+    make_dist_corpus(tmpdir, args.files)
+    paths = [os.path.join(tmpdir, name) for name in os.listdir(tmpdir)]
+    for corpus in args.corpus or []:
+        found = [os.path.join(dirpath, name)
+                 for dirpath, _, names in os.walk(corpus)
+                 for name in names if name.endswith('.dist')]
+        if not found:
+            print >> sys.stderr, 'No dist files found in %s.' % corpus
+            exit(-1)
+        paths.extend(found)
+    try:
+        mismatches = 0
+        for path in sorted(paths):
+            expected = minidom_parse_dist(path)
+            found = installinstallmacos.parse_dist(path)
+            if found != expected:
+                mismatches += 1
+                print >> sys.stderr, 'MISMATCH %s: expected %r, got %r' % (
+                    path, expected, found)
+        print '%s dist files, %s mismatches' % (len(paths), mismatches)
+
+        print '%-12s %10s %14s' % ('Parser', 'Seconds', 'ms per file')
+        for name, parser in (('minidom', minidom_parse_dist),
+                             ('streaming', installinstallmacos.parse_dist)):
+            began = time.time()
+            for _ in range(args.rounds):
+                for path in paths:
+                    parser(path)
+            elapsed = time.time() - began
+            print '%-12s %10.2f %14.2f' % (
+                name, elapsed, elapsed * 1000 / (args.rounds * len(paths)))
+        if mismatches:
+            exit(-1)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+SMD_TITLE = 'macOS Benchmark %s'
+
+# how each pipeline result is compared with the last run's: the label it is
+# printed with and whether a higher value is better
+PIPELINE_METRICS = [
+    ('list_cold_seconds', 'List, cold (s)', False),
+    ('list_cold_parse_seconds', 'Catalog parse (s)', False),
+    ('list_cold_peak_rss', 'List peak RSS', False),
+    ('list_warm_seconds', 'List, warm (s)', False),
+    ('download_seconds', 'Download (s)', False),
+    ('download_rate', 'Download rate', True),
+    ('download_peak_rss', 'Download peak RSS', False),
+]
+
+# where pipeline results are kept between runs, so that a run from a
+# checkout doesn't leave an untracked file in it
+PIPELINE_RESULTS = os.path.expanduser(
+    '~/.benchmark-installinstallmacos.jsonl')
+
+PIPELINE_WORKER = '''
+import sys
+sys.path.insert(0, %(libdir)r)
+import installinstallmacos
+catalog = installinstallmacos.download_and_parse_sucatalog(
+    %(url)r, %(workdir)r)
+installinstallmacos.replicate_product(
+    catalog, %(product_id)r, %(workdir)r, jobs=%(jobs)r,
+    segments=%(segments)r)
+installinstallmacos.PHASES.write_trace(%(trace)r)
+'''
+
+
+def zero_digest(size):
+    '''Returns the hex SHA-1 digest of size zero bytes, as the catalog
+    gives it for a sparse package'''
+    digest = hashlib.sha1()
+    block = '\0' * (1024 * 1024)
+    for _ in range(size // len(block)):
+        digest.update(block)
+    digest.update(block[:size % len(block)])
+    return digest.hexdigest()
+
+
+def make_site(root, base, products, installers, package_size):
+    '''Write a synthetic softwareupdate site to root, as served from base:
+    a catalog of products products with installers installers, the
+    ServerMetadata and dist files of each installer, and the packages of
+    the first, the largest of them a sparse file of package_size MB.
+    Returns the catalog URL and the product id of that installer.'''
+    size = package_size * 1024 * 1024
+    product_id = '041-00000'
+    product_dir = os.path.join(root, product_id)
+    os.makedirs(product_dir)
+    # a sparse InstallESD-like package and a few small ones, as real
+    # installers have
+    with open(os.path.join(product_dir, 'Package0.pkg'), 'wb') as fileobj:
+        fileobj.truncate(size)
+    packages = [(size, zero_digest(size))]
+    for index in range(1, 4):
+        path = os.path.join(product_dir, 'Package%s.pkg' % index)
+        make_package(path, 1024 * 1024 * index)
+        packages.append((os.path.getsize(path), None))
+    catalog_path = os.path.join(root, 'index.sucatalog')
+    installer_ids = make_catalog(catalog_path, products, installers,
+                                 base=base, packages={product_id: packages})
+
+    localizations = dist_localizations(10)
+    for number, installer_id in enumerate(installer_ids):
+        installer_dir = os.path.join(root, installer_id)
+        if not os.path.isdir(installer_dir):
+            os.makedirs(installer_dir)
+        for index in range(4):
+            with open(os.path.join(installer_dir, 'Package%s.pkm' % index),
+                      'w') as fileobj:
+                fileobj.write('<pkg-info/>\n')
+        version = '10.14.%s' % number
+        plistlib.writePlist(
+            {'CFBundleShortVersionString': version,
+             'localization': {'English': {'title': SMD_TITLE % number}}},
+            os.path.join(installer_dir, installer_id + '.smd'))
+        with open(os.path.join(installer_dir, installer_id + '.English.dist'),
+                  'w') as fileobj:
+            fileobj.write(DIST_TEMPLATE % {
+                'script': '', 'kbytes': package_size * 1024,
+                'version': version,
+                'auxinfo': DIST_AUXINFO['nested'] % {
+                    'build': '18A%03d' % number, 'version': version},
+                'before': localizations, 'after': ''})
+    return base + '/index.sucatalog', product_id
+
+
+def read_trace(path):
+    '''Returns the trace installinstallmacos.py wrote to path, with its
+    phases keyed by name'''
+    with open(path) as fileobj:
+        trace = json.load(fileobj)
+    trace['phases'] = dict((record['phase'], record)
+                           for record in trace['phases'])
+    return trace
+
+
+def time_list(url, workdir, trace_path):
+    '''Run installinstallmacos.py --list against url; returns its trace'''
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'installinstallmacos.py')
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(
+            [sys.executable, script, '--catalogurl', url,
+             '--workdir', workdir, '--list', '--trace', trace_path],
+            stdout=devnull, stderr=devnull)
+    return read_trace(trace_path)
+
+
+def time_replicate(url, workdir, product_id, args, trace_path):
+    '''Run replicate_product in a fresh interpreter, so its peak memory use
+    is its own; returns its trace'''
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(
+            [sys.executable, '-c', PIPELINE_WORKER % {
+                'libdir': os.path.dirname(os.path.abspath(__file__)),
+                'url': url, 'workdir': workdir, 'product_id': product_id,
+                'jobs': args.jobs, 'segments': args.segments,
+                'trace': trace_path}],
+            stdout=devnull)
+    return read_trace(trace_path)
+
+
+def load_results(path):
+    '''Returns the results stored in path, oldest first'''
+    results = []
+    if os.path.exists(path):
+        with open(path) as fileobj:
+            for line in fileobj:
+                if line.strip():
+                    results.append(json.loads(line))
+    return results
+
+
+def compare_results(current, previous, tolerance):
+    '''Print current results beside previous ones, which may be None.
+    Returns the labels of the metrics that got worse by more than
+    tolerance percent.'''
+    regressions = []
+    print '%-20s %12s %12s %9s' % ('Metric', 'This run', 'Last run',
+                                   'Change')
+    for name, label, higher_is_better in PIPELINE_METRICS:
+        value = current[name]
+        if name.endswith('_seconds'):
+            shown = '%.2f' % value
+        elif name.endswith('_rate'):
+            shown = installinstallmacos.human_size(value) + '/s'
+        else:
+            shown = installinstallmacos.human_size(value)
+        if not previous or not previous.get(name):
+            print '%-20s %12s' % (label, shown)
+            continue
+        change = (value - previous[name]) * 100.0 / previous[name]
+        worse = -change if higher_is_better else change
+        flag = ''
+        if worse > tolerance:
+            flag = ' REGRESSION'
+            regressions.append(label)
+        if name.endswith('_seconds'):
+            before = '%.2f' % previous[name]
+        elif name.endswith('_rate'):
+            before = installinstallmacos.human_size(previous[name]) + '/s'
+        else:
+            before = installinstallmacos.human_size(previous[name])
+        print '%-20s %12s %12s %+8.1f%%%s' % (label, shown, before, change,
+                                              flag)
+    return regressions
+
+
+def benchmark_pipeline(args):
+    '''Time --list, cold and warm, and replicate_product against a
+    synthetic site served with latency and limited bandwidth, and compare
+    the results with the last run with the same settings'''
+    settings = dict((name, getattr(args, name)) for name in (
+        'products', 'installers', 'package_size', 'rate', 'latency', 'jobs',
+        'segments'))
+    tmpdir = tempfile.mkdtemp()
+    server = None
+    try:
+        serve_dir = os.path.join(tmpdir, 'serve')
+        os.makedirs(serve_dir)
+        server = StandInServer(serve_dir, rate=args.rate * 1024 * 1024,
+                               latency=args.latency / 1000.0)
+        base = server.start()
+        url, product_id = make_site(serve_dir, base, args.products,
+                                    args.installers, args.package_size)
+        print 'Catalog of %s products, %s; %s package of %s' % (
+            args.products, installinstallmacos.human_size(
+                os.path.getsize(os.path.join(serve_dir, 'index.sucatalog'))),
+            product_id, installinstallmacos.human_size(
+                args.package_size * 1024 * 1024))
+
+        workdir = os.path.join(tmpdir, 'workdir')
+        trace_path = os.path.join(tmpdir, 'trace.json')
+        cold = time_list(url, workdir, trace_path)
+        warm = time_list(url, workdir, trace_path)
+        shutil.rmtree(workdir)
+        download = time_replicate(url, workdir, product_id, args, trace_path)
+        # nothing has changed, so downloading again only sends HEAD and
+        # conditional requests, which should reuse a connection per job
+        server.reset_counts()
+        time_replicate(url, workdir, product_id, args, trace_path)
+        warm_requests, warm_connections = server.requests, server.connections
+        seconds = download['phases']['download']['seconds']
+        results = {
+            'list_cold_seconds': cold['seconds'],
+            'list_cold_parse_seconds':
+                cold['phases']['catalog parse']['seconds'],
+            'list_cold_peak_rss': cold['peak_rss'],
+            'list_warm_seconds': warm['seconds'],
+            'download_seconds': seconds,
+            'download_rate':
+                download['phases']['download']['bytes'] / max(seconds, 0.001),
+            'download_peak_rss': download['peak_rss'],
+        }
+    except subprocess.CalledProcessError, err:
+        print >> sys.stderr, 'Benchmark run failed: %s' % err
+        exit(-1)
+    finally:
+        if server:
+            server.shutdown()
+            server.server_close()
+        shutil.rmtree(tmpdir)
+
+    history = [record for record in load_results(args.results)
+               if record.get('benchmark') == 'pipeline' and
+               record.get('settings') == settings]
+    previous = history and history[-1]['results'] or None
+    regressions = compare_results(results, previous, args.tolerance)
+    if not args.no_save:
+        with open(args.results, 'a') as fileobj:
+            fileobj.write(json.dumps({
+                'benchmark': 'pipeline',
+                'date': email.utils.formatdate(usegmt=True),
+                'host': platform.node(),
+                'python': platform.python_version(),
+                'settings': settings,
+                'results': results}, sort_keys=True) + '\n')
+    print 'Warm download: %s requests on %s connections' % (
+        warm_requests, warm_connections)
+    if warm_connections > args.jobs:
+        print >> sys.stderr, (
+            'A warm download should need no more connections than jobs '
+            '(%s), but opened %s' % (args.jobs, warm_connections))
+        exit(-1)
+    if regressions:
+        print >> sys.stderr, 'Worse than the last run by more than %s%%: %s' % (
+            args.tolerance, ', '.join(regressions))
+        exit(-1)
+
+
+class StubImageTools(object):
+    '''Stands in for installinstallmacos.ImageTools where hdiutil and
+    installer don't exist, taking the given number of seconds to make,
+    mount and install to an image'''
+
+    def __init__(self, create, attach, install, detach=0.5):
+        self.create = create
+        self.attach_time = attach
+        self.install_time = install
+        self.detach_time = detach
+
+    def create_sparse(self, volume_name, output_path, size):
+        '''Make an empty file for the image'''
+        time.sleep(self.create)
+        open(output_path, 'w').close()
+        return plistlib.writePlistToString([output_path])
+
+    def create_from_folder(self, folder, output_path):
+        '''Make an empty file for the compressed image'''
+        time.sleep(self.create)
+        open(output_path, 'w').close()
+
+    def attach(self, path):
+        '''Make a directory to stand for the mounted image'''
+        time.sleep(self.attach_time)
+        mountpoint = tempfile.mkdtemp(dir=os.path.dirname(path))
+        return 0, plistlib.writePlistToString(
+            {'system-entities': [{'mount-point': mountpoint}]}), ''
+
+    def detach(self, mountpoint, force=False):
+        '''Remove the directory standing for the mounted image'''
+        time.sleep(self.detach_time)
+        shutil.rmtree(mountpoint)
+        return 0, ''
+
+    def install(self, dist_path, target_vol):
+        '''Make an empty app where the installer would put one'''
+        time.sleep(self.install_time)
+        os.makedirs(os.path.join(target_vol, 'Applications',
+                                 'Install macOS Benchmark.app'))
+
+
+def benchmark_overlap(args):
+    '''Time building an image with its preparation run before and during
+    the download, with hdiutil and installer stubbed out'''
+    tmpdir = tempfile.mkdtemp()
+    server = None
+    tools = installinstallmacos.IMAGE_TOOLS
+    stdout = sys.stdout
+    try:
+        serve_dir = os.path.join(tmpdir, 'serve')
+        os.makedirs(serve_dir)
+        server = StandInServer(serve_dir, rate=args.rate * 1024 * 1024,
+                               latency=args.latency / 1000.0)
+        url, product_id = make_site(serve_dir, server.start(), 1, 1,
+                                    args.package_size)
+        installinstallmacos.IMAGE_TOOLS = StubImageTools(
+            args.create, args.attach, args.install)
+        print ('%s package, %.1fs to make and %.1fs to mount an image, '
+               '%.1fs to install' % (
+                   installinstallmacos.human_size(
+                       args.package_size * 1024 * 1024),
+                   args.create, args.attach, args.install))
+        print '%-12s %10s' % ('Build', 'Seconds')
+        timings = {}
+        for overlap in (False, True):
+            workdir = os.path.join(tmpdir, 'workdir')
+            shutil.rmtree(workdir, ignore_errors=True)
+            with open(os.devnull, 'w') as devnull:
+                sys.stdout = devnull
+                catalog = installinstallmacos.download_and_parse_sucatalog(
+                    url, workdir)
+                product_info = installinstallmacos.os_installer_product_info(
+                    catalog, workdir, product_keys=[product_id])
+                plan = installinstallmacos.plan_products(
+                    catalog, [product_id], workdir, compress=args.compress)
+                began = time.time()
+                dummy_paths, failed = installinstallmacos.build_products(
+                    catalog, [product_id], product_info, workdir, plan,
+                    compress=args.compress, segments=args.segments,
+                    overlap=overlap)
+                timings[overlap] = time.time() - began
+                sys.stdout = stdout
+            if failed:
+                print >> sys.stderr, 'Build failed!'
+                exit(-1)
+            print '%-12s %10.2f' % (overlap and 'overlapped' or 'sequential',
+                                    timings[overlap])
+        saved = timings[False] - timings[True]
+        print 'Overlap saved %.2fs (%.0f%%)' % (
+            saved, saved * 100 / timings[False])
+    finally:
+        sys.stdout = stdout
+        installinstallmacos.IMAGE_TOOLS = tools
+        if server:
+            server.shutdown()
+            server.server_close()
+        shutil.rmtree(tmpdir)
+
+
+def main():
+    '''Parse the command line and run the chosen benchmark'''
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers()
+
+    segments_parser = subparsers.add_parser(
+        'segments', help='Compare single-stream and segmented downloads '
+        'of one large package.')
+    segments_parser.add_argument(
+        '--size', metavar='MB', type=int, default=256,
+        help='Size of the test package in MB. Defaults to 256.')
+    segments_parser.add_argument(
+        '--rate', metavar='MB/s', type=int, default=16,
+        help='Per-connection bandwidth limit of the stand-in server in '
+        'MB/s. Defaults to 16.')
+    segments_parser.add_argument(
+        '--segments', metavar='N', type=int, nargs='+', default=[1, 2, 4, 8],
+        help='Segment counts to try. Defaults to 1 2 4 8.')
+    segments_parser.set_defaults(func=benchmark_segments)
+
+    catalog_parser = subparsers.add_parser(
+        'catalog', help='Compare plistlib and the streaming catalog parser '
+        'on a large synthetic catalog.')
+    catalog_parser.add_argument(
+        '--products', metavar='N', type=int, default=30000,
+        help='Number of products in the catalog. Defaults to 30000.')
+    catalog_parser.add_argument(
+        '--installers', metavar='N', type=int, default=20,
+        help='Number of those that are macOS installers. Defaults to 20.')
+    catalog_parser.set_defaults(func=benchmark_catalog)
+
+    dist_parser = subparsers.add_parser(
+        'dist', help='Check the streaming dist parser against the minidom '
+        'one and compare their speed.')
+    dist_parser.add_argument(
+        '--corpus', metavar='DIR', action='append',
+        help='Directory (such as an installinstallmacos.py workdir) to '
+        'search for real .dist files to check and time along with the '
+        'synthetic corpus. May be given more than once.')
+    dist_parser.add_argument(
+        '--files', metavar='N', type=int, default=60,
+        help='Number of synthetic dist files. Defaults to 60.')
+    dist_parser.add_argument(
+        '--rounds', metavar='N', type=int, default=5,
+        help='Number of times to parse the corpus. Defaults to 5.')
+    dist_parser.set_defaults(func=benchmark_dist)
+
+    pipeline_parser = subparsers.add_parser(
+        'pipeline', help='Time --list and replicate_product against a '
+        'synthetic site, and compare with the last run.')
+    pipeline_parser.add_argument(
+        '--products', metavar='N', type=int, default=10000,
+        help='Number of products in the catalog. Defaults to 10000.')
+    pipeline_parser.add_argument(
+        '--installers', metavar='N', type=int, default=10,
+        help='Number of those that are macOS installers. Defaults to 10.')
+    pipeline_parser.add_argument(
+        '--package-size', metavar='MB', type=int, default=2048,
+        help='Size of the sparse package downloaded, in MB. Defaults to '
+        '2048.')
+    pipeline_parser.add_argument(
+        '--rate', metavar='MB/s', type=int, default=64,
+        help='Per-connection bandwidth limit of the stand-in server in '
+        'MB/s. Defaults to 64.')
+    pipeline_parser.add_argument(
+        '--latency', metavar='ms', type=int, default=20,
+        help='Time the stand-in server waits before answering each '
+        'request, in milliseconds. Defaults to 20.')
+    pipeline_parser.add_argument(
+        '--jobs', metavar='N', type=int,
+        default=installinstallmacos.DEFAULT_JOBS,
+        help='Concurrent downloads. Defaults to %s.'
+        % installinstallmacos.DEFAULT_JOBS)
+    pipeline_parser.add_argument(
+        '--segments', metavar='N', type=int,
+        default=installinstallmacos.DEFAULT_SEGMENTS,
+        help='Byte-range segments per large download. Defaults to %s.'
+        % installinstallmacos.DEFAULT_SEGMENTS)
+    pipeline_parser.add_argument(
+        '--results', metavar='FILE', default=PIPELINE_RESULTS,
+        help='File results are stored in and compared with. Defaults to '
+        '~/.benchmark-installinstallmacos.jsonl, outside any checkout.')
+    pipeline_parser.add_argument(
+        '--tolerance', metavar='PERCENT', type=float, default=20,
+        help='How much worse than the last run with the same settings a '
+        'result may be before it is reported as a regression. Defaults '
+        'to 20.')
+    pipeline_parser.add_argument(
+        '--no-save', action='store_true',
+        help='Compare with the stored results without adding this run.')
+    pipeline_parser.set_defaults(func=benchmark_pipeline)
+
+    overlap_parser = subparsers.add_parser(
+        'overlap', help='Compare building an image with and without '
+        'preparing it while the packages download, with hdiutil and '
+        'installer stubbed out.')
+    overlap_parser.add_argument(
+        '--package-size', metavar='MB', type=int, default=1024,
+        help='Size of the sparse package downloaded, in MB. Defaults to '
+        '1024.')
+    overlap_parser.add_argument(
+        '--rate', metavar='MB/s', type=int, default=64,
+        help='Per-connection bandwidth limit of the stand-in server in '
+        'MB/s. Defaults to 64.')
+    overlap_parser.add_argument(
+        '--latency', metavar='ms', type=int, default=20,
+        help='Time the stand-in server waits before answering each '
+        'request, in milliseconds. Defaults to 20.')
+    overlap_parser.add_argument(
+        '--segments', metavar='N', type=int,
+        default=installinstallmacos.DEFAULT_SEGMENTS,
+        help='Byte-range segments per large download. Defaults to %s.'
+        % installinstallmacos.DEFAULT_SEGMENTS)
+    overlap_parser.add_argument(
+        '--create', metavar='SECONDS', type=float, default=2,
+        help='Time the stub takes to make an image. Defaults to 2.')
+    overlap_parser.add_argument(
+        '--attach', metavar='SECONDS', type=float, default=3,
+        help='Time the stub takes to mount an image. Defaults to 3.')
+    overlap_parser.add_argument(
+        '--install', metavar='SECONDS', type=float, default=5,
+        help='Time the stub takes to install a product. Defaults to 5.')
+    overlap_parser.add_argument(
+        '--compress', action='store_true',
+        help='Make a compressed image of the app as well.')
+    overlap_parser.set_defaults(func=benchmark_overlap)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+
+## benchmark-release-to-jss.py: time release-to-jss.py --all pushes against
+## a local stand-in for the JSS, so nothing touches a real Jamf server
+import argparse
+import BaseHTTPServer
+import json
+import os
+import plistlib
+import random
+import shutil
+import SocketServer
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib
+from base64 import b64decode, b64encode
+from xml.etree import ElementTree
+
+DESCRIPTION = """Benchmark release-to-jss.py --all pushes end to end.
+
+A synthetic git repository of N scripts is pushed to a local HTTP server
+standing in for the JSS, which answers the Script GET and PUT requests
+python-jss makes after a configurable delay. Each push is run twice, so the
+second shows the cost of a release in which nothing has changed, and the
+time spent cloning, reading git info, templating, loading and saving is
+reported for each.
+
+python-jss must be installed. Its preferences are written to a temporary
+home directory, so your own JSS settings are not used or changed.
+"""
+
+TAG = 'bench-1'
+
+# The phases release-to-jss.py --trace reports, in the order they happen
+PHASES = ['clone', 'git info', 'load', 'templating', 'save']
+
+SCRIPT_TEMPLATE = """#!/bin/sh
+# Version: @@VERSION
+# Date: @@DATE
+# Origin: @@ORIGIN
+# Path: @@PATH
+# Pushed by: @@USER
+%s
+"""
+
+
+class JSSStandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Answers the Script requests python-jss makes, from the scripts the
+    server holds """
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        """ Send a script, found by name or id """
+        time.sleep(self.server.latency)
+        self.server.count('get')
+        script = self.find_script()
+        if script is None:
+            self.send_xml(404, '<html><body>Not Found</body></html>')
+            return
+        self.send_xml(200, ElementTree.tostring(self.server.to_xml(script)))
+
+    def do_PUT(self):
+        """ Replace the notes and contents of a script """
+        time.sleep(self.server.latency)
+        self.server.count('put')
+        body = self.rfile.read(int(self.headers.getheader('content-length', 0)))
+        script = self.find_script()
+        if script is None:
+            self.send_xml(404, '<html><body>Not Found</body></html>')
+            return
+        self.server.update(script, ElementTree.fromstring(body))
+        self.send_xml(201, '<?xml version="1.0" encoding="UTF-8"?>'
+                      '<script><id>%s</id></script>' % script['id'])
+
+    def find_script(self):
+        """ The script the request path names, or None """
+        parts = self.path.split('?')[0].strip('/').split('/')
+        if len(parts) != 4 or parts[:2] != ['JSSResource', 'scripts']:
+            return None
+        key, value = parts[2], urllib.unquote(parts[3])
+        with self.server.lock:
+            for script in self.server.scripts.values():
+                if (key == 'name' and script['name'] == value or
+                        key == 'id' and str(script['id']) == value):
+                    return script
+        return None
+
+    def send_xml(self, status, text):
+        """ Send text as the response """
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml;charset=UTF-8')
+        self.send_header('Content-Length', str(len(text)))
+        self.end_headers()
+        self.wfile.write(text)
+
+    def log_message(self, *args):
+        """ Keep the benchmark output readable """
+        pass
+
+
+class JSSStandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ A local HTTP server holding script objects like the JSS does, that
+    waits latency seconds before answering each request """
+
+    daemon_threads = True
+
+    def __init__(self, names, latency=0):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, ('127.0.0.1', 0), JSSStandInHandler)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.requests = {'get': 0, 'put': 0}
+        self.scripts = {}
+        for number, name in enumerate(sorted(names)):
+            self.scripts[name] = {'id': number + 1, 'name': name,
+                                  'notes': '', 'contents': ''}
+
+    def count(self, method):
+        """ Count a request """
+        with self.lock:
+            self.requests[method] += 1
+
+    def reset_counts(self):
+        """ Start counting requests again; returns the old counts """
+        with self.lock:
+            counts = self.requests
+            self.requests = {'get': 0, 'put': 0}
+        return counts
+
+    @staticmethod
+    def to_xml(script):
+        """ The script as the JSS API returns it """
+        element = ElementTree.Element('script')
+        for tag, text in (('id', str(script['id'])),
+                          ('name', script['name']),
+                          ('category', 'No category assigned'),
+                          ('filename', script['name']),
+                          ('info', ''),
+                          ('notes', script['notes']),
+                          ('priority', 'After'),
+                          ('parameters', ''),
+                          ('os_requirements', ''),
+                          ('script_contents', script['contents']),
+                          ('script_contents_encoded',
+                           b64encode(script['contents'].encode('utf-8')))):
+            ElementTree.SubElement(element, tag).text = text
+        return element
+
+    def update(self, script, element):
+        """ Store the notes and contents PUT for script """
+        with self.lock:
+            notes = element.find('notes')
+            if notes is not None:
+                script['notes'] = notes.text or ''
+            encoded = element.find('script_contents_encoded')
+            plain = element.find('script_contents')
+            if encoded is not None and encoded.text:
+                script['contents'] = b64decode(encoded.text).decode('utf-8')
+            elif plain is not None:
+                script['contents'] = plain.text or ''
+
+    def start(self):
+        """ Start serving; returns the URL of the server """
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return 'http://127.0.0.1:%s' % self.server_address[1]
+
+
+def git(args, cwd):
+    """ Run a git command quietly in cwd """
+    with open(os.devnull, 'w') as fnull:
+        subprocess.check_call(['git'] + args, cwd=cwd, stdout=fnull,
+                              stderr=subprocess.STDOUT)
+
+
+def make_repo(directory, scripts, commits):
+    """ Make a bare origin and a clone of it in directory, holding scripts
+    script files changed over commits commits and tagged TAG. Returns the
+    path of the clone and the names of the scripts """
+    origin = os.path.join(directory, 'origin.git')
+    work = os.path.join(directory, 'work')
+    git(['init', '-q', '--bare', origin], directory)
+    git(['clone', '-q', origin, work], directory)
+    git(['config', 'user.name', 'Benchmark'], work)
+    git(['config', 'user.email', 'benchmark@example.com'], work)
+    extensions = ['sh', 'py', 'pl']
+    names = ['script%04d.%s' % (number, extensions[number % len(extensions)])
+             for number in range(scripts)]
+    body = '\n'.join('echo "line %s"' % line for line in range(100))
+    for name in names:
+        with open(os.path.join(work, name), 'w') as handle:
+            handle.write(SCRIPT_TEMPLATE % body)
+    git(['add', '.'], work)
+    git(['commit', '-q', '-m', 'Add scripts'], work)
+    # each later commit changes a few scripts, as real releases do
+    generator = random.Random(scripts)
+    for number in range(1, commits):
+        for name in generator.sample(names, min(3, len(names))):
+            with open(os.path.join(work, name), 'a') as handle:
+                handle.write('echo "change %s"\n' % number)
+        git(['commit', '-q', '-a', '-m', 'Change %s' % number], work)
+    git(['tag', '-a', TAG, '-m', 'Benchmark release'], work)
+    git(['push', '-q', 'origin', 'HEAD:refs/heads/master', TAG], work)
+    return work, names
+
+
+def write_prefs(home, url):
+    """ Point python-jss at url, in the preferences files it reads on
+    macOS and on Linux under the home directory home """
+    prefs = {'jss_url': url, 'jss_user': 'benchmark',
+             'jss_pass': 'benchmark', 'verify': False,
+             'suppress_warnings': True, 'repos': []}
+    mac_prefs = os.path.join(home, 'Library', 'Preferences')
+    os.makedirs(mac_prefs)
+    plistlib.writePlist(prefs, os.path.join(
+        mac_prefs, 'com.github.sheagcraig.python-jss.plist'))
+    plistlib.writePlist(prefs, os.path.join(
+        home, '.com.github.sheagcraig.python-jss.plist'))
+
+
+def push(work, home, jobs, trace):
+    """ Run release-to-jss.py --all in work with HOME set to home; returns
+    its trace """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'release-to-jss.py')
+    env = dict(os.environ, HOME=home)
+    with open(os.devnull, 'w') as fnull:
+        subprocess.check_call([sys.executable, script, '--all', '--jobs',
+                               str(jobs), '--trace', trace, TAG],
+                              cwd=work, env=env, stdout=fnull,
+                              stderr=subprocess.STDOUT)
+    with open(trace) as handle:
+        return json.load(handle)
+
+
+def print_row(label, jobs, trace, requests):
+    """ Print the times of one push """
+    phases = trace['phases']
+    print '%-8s %5s %8.2f %s %5s %5s' % (
+        label, jobs, trace['seconds'],
+        ' '.join('%10.2f' % phases.get(phase, {}).get('seconds', 0)
+                 for phase in PHASES),
+        requests['get'], requests['put'])
+
+
+def _main(options):
+    """ Main function """
+    tmpdir = tempfile.mkdtemp()
+    server = None
+    try:
+        work, names = make_repo(tmpdir, options.scripts, options.commits)
+        print "%d scripts over %d commits, %dms per JSS request" % (
+            options.scripts, options.commits, options.latency)
+        print "Phase times are summed over all jobs.\n"
+        print '%-8s %5s %8s %s %5s %5s' % (
+            'Push', 'Jobs', 'Total', ' '.join('%10s' % phase
+                                              for phase in PHASES),
+            'GETs', 'PUTs')
+        for jobs in options.jobs:
+            # a fresh JSS for each, so the first push changes every script
+            server = JSSStandInServer(names, options.latency / 1000.0)
+            home = tempfile.mkdtemp(dir=tmpdir)
+            write_prefs(home, server.start())
+            trace = os.path.join(tmpdir, 'trace.json')
+            for label in ('first', 'repeat'):
+                result = push(work, home, jobs, trace)
+                print_row(label, jobs, result, server.reset_counts())
+            server.shutdown()
+            server.server_close()
+            server = None
+    except subprocess.CalledProcessError, err:
+        print >> sys.stderr, "Benchmark run failed: %s" % err
+        sys.exit(1)
+    finally:
+        if server:
+            server.shutdown()
+            server.server_close()
+        shutil.rmtree(tmpdir)
+
+
+def _get_args():
+    """ Parse arguments from the commandline """
+    parser = argparse.ArgumentParser(
+        description=DESCRIPTION,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scripts', metavar='N', type=int, default=150,
+                        help='Number of scripts in the repository (default 150)')
+    parser.add_argument('--commits', metavar='N', type=int, default=200,
+                        help='Number of commits in its history (default 200)')
+    parser.add_argument('--latency', metavar='MS', type=int, default=50,
+                        help=('Time the stand-in JSS takes to answer each '
+                              'request, in milliseconds (default 50)'))
+    parser.add_argument('--jobs', metavar='N', type=int, nargs='+',
+                        default=[1, 8],
+                        help='--jobs values to push with (default 1 8)')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    _main(_get_args())
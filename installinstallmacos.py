@@ -24,13 +24,39 @@ softwareupdate servers and install a functioning Install macOS app onto an
 empty disk image'''
 
 
+import BaseHTTPServer
+import SocketServer
 import argparse
+import atexit
+import bisect
+import contextlib
+import copy
+import cPickle
+import datetime
+import email.utils
+import errno
+import fnmatch
+import functools
+import hashlib
+import httplib
+import json
+import mmap
 import os
 import plistlib
+import random
+import resource
+import shutil
+import socket
+import stat
+import struct
 import subprocess
 import sys
+import threading
+import time
+import urllib
 import urlparse
-from xml.dom import minidom
+from xml.etree import cElementTree as ElementTree
+from xml.parsers import expat
 from xml.parsers.expat import ExpatError
 
 
@@ -39,13 +65,276 @@ DEFAULT_SUCATALOG = (
     'index-10.13seed-10.13-10.12-10.11-10.10-10.9'
     '-mountainlion-lion-snowleopard-leopard.merged-1.sucatalog')
 
+# number of concurrent transfers used by replicate_products
+DEFAULT_JOBS = 1
 
-def make_sparse_image(volume_name, output_path):
-    '''Make a sparse disk image we can install a product to'''
-    cmd = ['/usr/bin/hdiutil', 'create', '-size', '8g', '-fs', 'HFS+',
-           '-volname', volume_name, '-type', 'SPARSE', '-plist', output_path]
+# number of products whose metadata and distribution files are fetched
+# and parsed at the same time when listing installers
+METADATA_JOBS = 8
+
+# file in the workdir remembering the results of parsing the catalog,
+# ServerMetadata and dist files
+PARSE_CACHE_NAME = '.parsecache'
+
+# the filter_key catalogs filtered by is_mac_os_installer are cached under
+INSTALLERS_FILTER_KEY = 'macos installers'
+
+# directory in the workdir keeping one copy of each package, named by the
+# digest and size the catalog gives for it
+STORE_DIR_NAME = '.store'
+
+# file in the workdir recording when each replicated file was last used
+CACHE_INDEX_NAME = '.cacheindex'
+
+# files listed by --cache-report
+CACHE_REPORT_FILES = 20
+
+# seconds between combined progress reports for concurrent transfers
+PROGRESS_INTERVAL = 5
+
+# number of byte ranges a single large package is split into
+DEFAULT_SEGMENTS = 4
+
+# packages at least this big are fetched as resumable byte ranges, each
+# of at least MIN_SEGMENT_SIZE bytes
+SEGMENT_THRESHOLD = 64 * 1024 * 1024
+MIN_SEGMENT_SIZE = 16 * 1024 * 1024
+
+# bytes a range is fetched between updates of its resume journal
+JOURNAL_INTERVAL = 32 * 1024 * 1024
+
+# times the damaged chunks of a download are fetched again before giving up
+CHUNK_RETRIES = 3
+
+# threads reading packages back from disk to check them with --verify-only
+VERIFY_JOBS = 4
+
+# first four bytes of a chunklist, as a little-endian integer ('CNKL'), and
+# the chunk method that means each chunk has a SHA-256 digest
+CHUNKLIST_MAGIC = 0x4C4B4E43
+CHUNKLIST_SHA256 = 1
+
+# the sparse image an installer is installed to is sized at this multiple
+# of the product's package sizes, rounded up to a whole gigabyte, and no
+# smaller than MIN_IMAGE_SIZE
+IMAGE_SIZE_FACTOR = 1.25
+MIN_IMAGE_SIZE = 8 * 1024 ** 3
+
+# free space a run leaves on the workdir's filesystem, beyond its plan
+SPACE_MARGIN = 1024 ** 3
+
+# file in the workdir remembering the installer products each catalog
+# listed on the last --list --incremental run
+LIST_STATE_NAME = '.liststate.plist'
+
+# directory in the workdir holding the catalogs served by --mirror, with
+# their URLs rewritten to point at the mirror, and the port it listens on
+MIRROR_DIR_NAME = '.mirror'
+MIRROR_PORT = 8088
+
+# suffixes of partial and temporary files the mirror never serves
+UNSERVED_SUFFIXES = ('.download', '.journal', '.link', '.new')
+
+# socket timeout in seconds, and the size of each read from a response
+HTTP_TIMEOUT = 60
+READ_SIZE = 256 * 1024
+
+# statuses a server asks clients to slow down with; how many times to back
+# off and retry, and the first and longest delays in seconds
+BACKOFF_STATUSES = (429, 503)
+BACKOFF_RETRIES = 5
+BACKOFF_DELAY = 1
+BACKOFF_MAX_DELAY = 60
+
+# what PhaseRecorder counts during each phase: bytes received over HTTP,
+# files found current (cache hits) or downloaded (misses), and parse
+# results reused from the ParseCache or not
+PHASE_COUNTERS = ('bytes', 'hits', 'misses', 'parse_hits', 'parse_misses')
+
+
+def peak_rss():
+    '''Returns the most memory this process has used so far, in bytes'''
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux kilobytes
+    if sys.platform != 'darwin':
+        usage *= 1024
+    return usage
+
+
+class PhaseRecorder(object):
+    '''Records the wall time of each phase of a run, with the bytes
+    received, cache hits and misses during it and the peak memory use at
+    its end, for a summary at exit and an optional JSON trace. The counts
+    are for the whole process, so a phase that ran alongside a phase on
+    another thread, as images are prepared during downloads, includes the
+    other's counts; those phases record which phases they overlapped and
+    are marked in the summary.'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = dict.fromkeys(PHASE_COUNTERS, 0)
+        self.phases = []
+        self.running = []
+        self.started = time.time()
+
+    def count(self, counter, amount=1):
+        '''Add amount to one of the PHASE_COUNTERS'''
+        with self.lock:
+            self.counters[counter] += amount
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        '''Context manager recording the enclosed code as phase name'''
+        thread = threading.current_thread()
+        overlaps = set()
+        with self.lock:
+            before = dict(self.counters)
+            for other_thread, other_name, other_overlaps in self.running:
+                if other_thread is not thread:
+                    overlaps.add(other_name)
+                    other_overlaps.add(name)
+            running = (thread, name, overlaps)
+            self.running.append(running)
+        started = time.time()
+        try:
+            yield
+        finally:
+            record = {'phase': name,
+                      'started': round(started - self.started, 3),
+                      'seconds': round(time.time() - started, 3),
+                      'peak_rss': peak_rss()}
+            with self.lock:
+                self.running.remove(running)
+                record['overlaps'] = sorted(overlaps)
+                for counter in PHASE_COUNTERS:
+                    record[counter] = self.counters[counter] - before[counter]
+            self.phases.append(record)
+            EVENTS.emit('phase', **record)
+
+    def report(self, output=None):
+        '''Print a table of the phases recorded'''
+        output = output or sys.stderr
+        print >> output, '%-14s %9s %10s %10s %9s %9s %10s' % (
+            'Phase', 'Seconds', 'Received', 'Rate', 'Cache', 'Parsed',
+            'Peak RSS')
+        for record in self.phases:
+            rate = record['bytes'] / max(record['seconds'], 0.001)
+            label = record['phase']
+            if record['overlaps']:
+                label += ' *'
+            print >> output, '%-14s %9.2f %10s %8s/s %9s %9s %10s' % (
+                label, record['seconds'],
+                human_size(record['bytes']), human_size(rate),
+                '%s/%s' % (record['hits'], record['hits'] + record['misses']),
+                '%s/%s' % (record['parse_hits'],
+                           record['parse_hits'] + record['parse_misses']),
+                human_size(record['peak_rss']))
+        print >> output, '%-14s %9.2f' % ('Total', time.time() - self.started)
+        if any(record['overlaps'] for record in self.phases):
+            print >> output, ('* ran alongside other phases, whose counts '
+                              'are included')
+
+    def write_trace(self, path):
+        '''Write the phases recorded to path as JSON'''
+        trace = {'argv': sys.argv,
+                 'started': email.utils.formatdate(self.started, usegmt=True),
+                 'seconds': round(time.time() - self.started, 3),
+                 'peak_rss': peak_rss(),
+                 'totals': dict(self.counters),
+                 'phases': self.phases}
+        try:
+            with open(path, 'w') as fileobj:
+                json.dump(trace, fileobj, indent=2, sort_keys=True)
+        except (IOError, OSError), err:
+            print >> sys.stderr, 'Could not write %s: %s' % (path, err)
+
+    def finish(self, trace_path=None):
+        '''Print the summary, if any phases were recorded, and write the
+        trace if asked to; registered to run at exit'''
+        if self.phases:
+            sys.stdout.flush()
+            self.report()
+        if trace_path:
+            self.write_trace(trace_path)
+
+
+PHASES = PhaseRecorder()
+
+
+def phase(name):
+    '''Decorator recording each call of a function as the phase name'''
+    def decorate(func):
+        '''Wrap func in PHASES.phase'''
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            '''Call func as a phase'''
+            with PHASES.phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+class ImageTools(object):
+    '''Runs the hdiutil and installer commands building an image needs.
+    IMAGE_TOOLS can be replaced by an object with the same methods to run
+    the rest of a build where those commands don't exist, as
+    benchmark-installinstallmacos.py does.'''
+
+    def create_sparse(self, volume_name, output_path, size):
+        '''Creates a sparse image of at least size bytes; returns the
+        plist hdiutil prints. Raises CalledProcessError on failure.'''
+        cmd = ['/usr/bin/hdiutil', 'create',
+               '-size', '%dg' % -(-size // 1024 ** 3), '-fs', 'HFS+',
+               '-volname', volume_name, '-type', 'SPARSE', '-plist',
+               output_path]
+        return subprocess.check_output(cmd)
+
+    def create_from_folder(self, folder, output_path):
+        '''Creates a compressed image holding folder. Raises
+        CalledProcessError on failure.'''
+        cmd = ['/usr/bin/hdiutil', 'create', '-fs', 'HFS+',
+               '-srcfolder', folder, output_path]
+        subprocess.check_call(cmd)
+
+    def attach(self, path):
+        '''Mounts the image at path; returns the return code, the plist
+        hdiutil prints and its error output'''
+        cmd = ['/usr/bin/hdiutil', 'attach', path,
+               '-mountRandom', '/tmp', '-nobrowse', '-plist',
+               '-owners', 'on']
+        proc = subprocess.Popen(cmd, bufsize=-1,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output, err = proc.communicate()
+        return proc.returncode, output, err
+
+    def detach(self, mountpoint, force=False):
+        '''Unmounts mountpoint; returns the return code and error
+        output'''
+        cmd = ['/usr/bin/hdiutil', 'detach', mountpoint]
+        if force:
+            cmd.append('-force')
+        proc = subprocess.Popen(cmd, bufsize=-1, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        dummy_output, err = proc.communicate()
+        return proc.returncode, err
+
+    def install(self, dist_path, target_vol):
+        '''Installs the product described by dist_path to target_vol.
+        Raises CalledProcessError on failure.'''
+        cmd = ['/usr/sbin/installer', '-pkg', dist_path, '-target',
+               target_vol]
+        subprocess.check_call(cmd)
+
+
+IMAGE_TOOLS = ImageTools()
+
+
+@phase('image')
+def make_sparse_image(volume_name, output_path, size=MIN_IMAGE_SIZE):
+    '''Make a sparse disk image we can install a product to, able to hold
+    size bytes'''
     try:
-        output = subprocess.check_output(cmd)
+        output = IMAGE_TOOLS.create_sparse(volume_name, output_path, size)
     except subprocess.CalledProcessError, err:
         print >> sys.stderr, err
         exit(-1)
@@ -60,35 +349,30 @@ def make_sparse_image(volume_name, output_path):
         exit(-1)
 
 
+@phase('compress')
 def make_compressed_dmg(app_path, diskimagepath):
     """Returns path to newly-created compressed r/o disk image containing
     Install macOS.app"""
 
     print ('Making read-only compressed disk image containing %s...'
            % os.path.basename(app_path))
-    cmd = ['/usr/bin/hdiutil', 'create', '-fs', 'HFS+',
-           '-srcfolder', app_path, diskimagepath]
     try:
-        subprocess.check_call(cmd)
+        IMAGE_TOOLS.create_from_folder(app_path, diskimagepath)
     except subprocess.CalledProcessError, err:
         print >> sys.stderr, err
     else:
         print 'Disk image created at: %s' % diskimagepath
 
 
+@phase('mount')
 def mountdmg(dmgpath):
     """
     Attempts to mount the dmg at dmgpath and returns first mountpoint
     """
     mountpoints = []
     dmgname = os.path.basename(dmgpath)
-    cmd = ['/usr/bin/hdiutil', 'attach', dmgpath,
-           '-mountRandom', '/tmp', '-nobrowse', '-plist',
-           '-owners', 'on']
-    proc = subprocess.Popen(cmd, bufsize=-1,
-                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    (pliststr, err) = proc.communicate()
-    if proc.returncode:
+    returncode, pliststr, err = IMAGE_TOOLS.attach(dmgpath)
+    if returncode:
         print >> sys.stderr, 'Error: "%s" while mounting %s.' % (err, dmgname)
         return None
     if pliststr:
@@ -104,26 +388,22 @@ def unmountdmg(mountpoint):
     """
     Unmounts the dmg at mountpoint
     """
-    proc = subprocess.Popen(['/usr/bin/hdiutil', 'detach', mountpoint],
-                            bufsize=-1, stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE)
-    (dummy_output, err) = proc.communicate()
-    if proc.returncode:
+    returncode, err = IMAGE_TOOLS.detach(mountpoint)
+    if returncode:
         print >> sys.stderr, 'Polite unmount failed: %s' % err
         print >> sys.stderr, 'Attempting to force unmount %s' % mountpoint
         # try forcing the unmount
-        retcode = subprocess.call(['/usr/bin/hdiutil', 'detach', mountpoint,
-                                   '-force'])
-        if retcode:
+        returncode, err = IMAGE_TOOLS.detach(mountpoint, force=True)
+        if returncode:
             print >> sys.stderr, 'Failed to unmount %s' % mountpoint
 
 
+@phase('install')
 def install_product(dist_path, target_vol):
     '''Install a product to a target volume.
     Returns a boolean to indicate success or failure.'''
-    cmd = ['/usr/sbin/installer', '-pkg', dist_path, '-target', target_vol]
     try:
-        subprocess.check_call(cmd)
+        IMAGE_TOOLS.install(dist_path, target_vol)
         return True
     except subprocess.CalledProcessError, err:
         print >> sys.stderr, err
@@ -135,503 +415,1616 @@ class ReplicationError(Exception):
     pass
 
 
-def replicate_url(full_url, root_dir='/tmp',
-                  show_progress=False, ignore_cache=False):
-    '''Downloads a URL and stores it in the same relative path on our
-    filesystem. Returns a path to the replicated file.'''
-
+def local_path_for_url(full_url, root_dir):
+    '''Returns the path a URL is replicated to under root_dir'''
     path = urlparse.urlsplit(full_url)[2]
     relative_url = path.lstrip('/')
     relative_url = os.path.normpath(relative_url)
-    local_file_path = os.path.join(root_dir, relative_url)
-    if show_progress:
-        options = '-fL'
-    else:
-        options = '-sfL'
-    curl_cmd = ['/usr/bin/curl', options, '--create-dirs',
-                '-o', local_file_path]
-    if not ignore_cache and os.path.exists(local_file_path):
-        curl_cmd.extend(['-z', local_file_path])
-    curl_cmd.append(full_url)
-    print "Downloading %s..." % full_url
-    try:
-        subprocess.check_call(curl_cmd)
-    except subprocess.CalledProcessError, err:
-        raise ReplicationError(err)
-    return local_file_path
+    return os.path.join(root_dir, relative_url)
 
 
-def parse_server_metadata(filename):
-    '''Parses a softwareupdate server metadata file, looking for information
-    of interest.
-    Returns a dictionary containing title, version, and description.'''
-    title = ''
-    vers = ''
-    try:
-        md_plist = plistlib.readPlist(filename)
-    except (OSError, IOError, ExpatError), err:
-        print >> sys.stderr, 'Error reading %s: %s' % (filename, err)
-        return {}
-    vers = md_plist.get('CFBundleShortVersionString', '')
-    localization = md_plist.get('localization', {})
-    preferred_localization = (localization.get('English') or
-                              localization.get('en'))
-    if preferred_localization:
-        title = preferred_localization.get('title', '')
-
-    metadata = {}
-    metadata['title'] = title
-    metadata['version'] = vers
-    return metadata
-
-
-def get_server_metadata(catalog, product_key, workdir, ignore_cache=False):
-    '''Replicate ServerMetaData'''
-    try:
-        url = catalog['Products'][product_key]['ServerMetadataURL']
+def proxy_for(scheme, host):
+    '''Returns the host:port of the proxy to use for scheme and host, from
+    the same environment variables curl uses, or None'''
+    if urllib.proxy_bypass(host):
+        return None
+    proxy = urllib.getproxies().get(scheme)
+    if not proxy:
+        return None
+    return urlparse.urlsplit(proxy).netloc or proxy
+
+
+class TokenBucket(object):
+    '''Hands out bytes at rate per second, allowing bursts of up to a
+    second's worth, or without limit if rate is None or 0. Takers are
+    never refused; they are told how long to wait instead, each queued
+    behind those before.'''
+
+    def __init__(self, rate=None):
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.tokens = rate or 0
+        self.updated = time.time()
+
+    def refill(self):
+        '''Adds the tokens earned since the last update; call with the
+        lock held'''
+        now = time.time()
+        if self.rate:
+            self.tokens = min(self.rate, self.tokens +
+                              (now - self.updated) * self.rate)
+        self.updated = now
+
+    def set_rate(self, rate):
+        '''Changes the rate, keeping any tokens already earned or owed'''
+        with self.lock:
+            if rate == self.rate:
+                return
+            self.refill()
+            if not self.rate:
+                self.tokens = rate or 0
+            self.rate = rate
+            self.tokens = min(self.tokens, rate or 0)
+
+    def take(self, amount):
+        '''Takes amount tokens; returns how many seconds to wait before
+        using them'''
+        with self.lock:
+            if not self.rate:
+                return 0
+            self.refill()
+            self.tokens -= amount
+            return max(0, -self.tokens / float(self.rate))
+
+
+class RateLimiter(object):
+    '''Limits how fast every transfer in the run receives data, with one
+    TokenBucket for all hosts and one for each host, the first following
+    a time-of-day schedule if there is one. A host that answers with one
+    of the BACKOFF_STATUSES pauses every request to it, not just the one
+    that was refused.'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rate = None
+        self.schedule = []
+        self.host_rate = None
+        self.host_rates = {}
+        self.total = TokenBucket()
+        self.buckets = {}
+        self.paused = {}
+
+    def configure(self, rate=None, host_rates=(), schedule=()):
+        '''Sets the limit on all transfers together, a list of (host,
+        rate) limits on each host, where a host of None applies to every
+        host not named, and a list of (start, end, rate) windows, in
+        minutes after local midnight, in which rate replaces the overall
+        limit. Rates are in bytes per second; 0 or None is no limit.'''
+        self.rate = rate
+        self.schedule = list(schedule)
+        for host, host_rate in host_rates:
+            if host is None:
+                self.host_rate = host_rate
+            else:
+                self.host_rates[host.lower()] = host_rate
+
+    def current_rate(self):
+        '''Returns the overall limit that applies now'''
+        now = time.localtime()
+        minute = now.tm_hour * 60 + now.tm_min
+        for start, end, rate in self.schedule:
+            if start <= end:
+                inside = start <= minute < end
+            else:
+                # the window spans midnight
+                inside = minute >= start or minute < end
+            if inside:
+                return rate
+        return self.rate
+
+    def throttle(self, host, amount):
+        '''Waits until amount more bytes from host are within the
+        limits'''
+        if not (self.rate or self.schedule or self.host_rate or
+                self.host_rates):
+            return
+        self.total.set_rate(self.current_rate())
+        with self.lock:
+            bucket = self.buckets.get(host)
+            if bucket is None:
+                bucket = self.buckets[host] = TokenBucket(
+                    self.host_rates.get(host, self.host_rate))
+        delay = max(self.total.take(amount), bucket.take(amount))
+        if delay:
+            time.sleep(delay)
+
+    def back_off(self, host, attempt, retry_after=None):
+        '''Pauses requests to host after it refused attempt + 1 requests
+        in a row: for retry_after seconds if it said, otherwise for a
+        random time up to an exponentially growing limit, so that clients
+        refused together don't all retry together. Returns the delay.'''
+        if retry_after is None:
+            delay = random.uniform(
+                0, min(BACKOFF_MAX_DELAY, BACKOFF_DELAY * 2 ** attempt))
+        else:
+            delay = min(BACKOFF_MAX_DELAY,
+                        retry_after + random.uniform(0, BACKOFF_DELAY))
+        with self.lock:
+            self.paused[host] = max(self.paused.get(host, 0),
+                                    time.time() + delay)
+        return delay
+
+    def wait_for(self, host):
+        '''Waits out any pause of requests to host'''
+        with self.lock:
+            delay = self.paused.get(host, 0) - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+
+# limits shared by every transfer in this run
+RATE_LIMIT = RateLimiter()
+
+
+def retry_after(response):
+    '''Returns the seconds a response's Retry-After header asks for, or
+    None'''
+    value = response.getheader('retry-after')
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return int(value)
+    date = email.utils.parsedate_tz(value)
+    if date is None:
+        return None
+    return max(0, email.utils.mktime_tz(date) - time.time())
+
+
+class ConnectionPool(object):
+    '''Keeps HTTP and HTTPS connections open between requests, so that
+    successive requests to a host reuse a connection (and its TLS session)
+    instead of opening a new one for each file'''
+
+    def __init__(self, max_idle=16):
+        self.max_idle = max_idle
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def connect(self, scheme, netloc):
+        '''Returns a new connection to netloc, through a proxy if one is
+        configured'''
+        host = netloc.rsplit('@', 1)[-1]
+        proxy = proxy_for(scheme, host.split(':')[0])
+        if scheme == 'https':
+            connection = httplib.HTTPSConnection(
+                proxy or host, timeout=HTTP_TIMEOUT)
+            if proxy:
+                connection.set_tunnel(host)
+        else:
+            connection = httplib.HTTPConnection(
+                proxy or host, timeout=HTTP_TIMEOUT)
+        return connection
+
+    def send(self, key, method, path, headers):
+        '''Sends a request on an idle connection for key, or on a new one
+        if there isn't one or the server has since closed it'''
+        while True:
+            with self.lock:
+                idle = self.idle.get(key)
+                connection = idle.pop() if idle else None
+            reused = connection is not None
+            if not reused:
+                connection = self.connect(*key)
+            try:
+                connection.request(method, path, headers=headers)
+                response = connection.getresponse()
+            except (httplib.HTTPException, socket.error), err:
+                connection.close()
+                if reused:
+                    continue
+                raise ReplicationError(err)
+            response.pool_key = key
+            response.connection = connection
+            return response
+
+    def urlopen(self, method, full_url, headers=None, max_redirects=5):
+        '''Sends an HTTP request, following redirects. Returns a tuple of
+        (response, final_url); pass the response to release() once it has
+        been read.'''
+        url = full_url
+        redirects = attempts = 0
+        while redirects <= max_redirects:
+            parts = urlparse.urlsplit(url)
+            if parts.scheme not in ('http', 'https'):
+                raise ReplicationError('Unsupported URL: %s' % url)
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            if (parts.scheme == 'http' and
+                    proxy_for('http', parts.hostname)):
+                path = urlparse.urlunsplit(parts[:4] + ('',))
+            RATE_LIMIT.wait_for(parts.hostname)
+            response = self.send((parts.scheme, parts.netloc), method, path,
+                                 headers or {})
+            if (response.status in BACKOFF_STATUSES and
+                    attempts < BACKOFF_RETRIES):
+                response.read()
+                self.release(response)
+                delay = RATE_LIMIT.back_off(parts.hostname, attempts,
+                                            retry_after(response))
+                attempts += 1
+                print >> sys.stderr, (
+                    'HTTP %s for %s, retrying in %.1fs...'
+                    % (response.status, url, delay))
+                continue
+            location = response.getheader('location')
+            if response.status in (301, 302, 303, 307, 308) and location:
+                response.read()
+                self.release(response)
+                url = urlparse.urljoin(url, location)
+                redirects += 1
+                continue
+            return response, url
+        raise ReplicationError('Too many redirects for %s' % full_url)
+
+    def release(self, response):
+        '''Returns the connection of a response to the pool if the response
+        was read completely and the server will keep it open; otherwise
+        closes it'''
+        if not response.isclosed() and response.length == 0:
+            # httplib gives HEAD, 204 and 304 replies no body, but only
+            # counts them as closed once they have been read
+            response.read()
+        if response.isclosed() and not response.will_close:
+            with self.lock:
+                idle = self.idle.setdefault(response.pool_key, [])
+                if len(idle) < self.max_idle:
+                    idle.append(response.connection)
+                    return
+        response.connection.close()
+
+
+# connections shared by every transfer in this run
+HTTP_POOL = ConnectionPool()
+
+
+class ResumeJournal(object):
+    '''Records which byte ranges of a partial download are already on disk,
+    together with the size and validators of the copy they came from, so
+    an interrupted download can be resumed'''
+
+    def __init__(self, path, url, size, etag=None, last_modified=None,
+                 completed=None):
+        self.path = path
+        self.url = url
+        self.size = size
+        self.etag = etag
+        self.last_modified = last_modified
+        self.completed = completed or []
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path):
+        '''Returns the journal stored at path, or None if there isn't a
+        readable one'''
         try:
-            smd_path = replicate_url(
-                url, root_dir=workdir, ignore_cache=ignore_cache)
-            return smd_path
-        except ReplicationError, err:
-            print >> sys.stderr, (
-                'Could not replicate %s: %s' % (url, err))
+            journal = plistlib.readPlist(path)
+            return cls(path, journal['URL'], journal['Size'],
+                       etag=journal.get('ETag'),
+                       last_modified=journal.get('LastModified'),
+                       completed=[tuple(item)
+                                  for item in journal['Completed']])
+        except (OSError, IOError, ExpatError, KeyError, TypeError):
             return None
-    except KeyError:
-        print >> sys.stderr, 'Malformed catalog.'
-        return None
-
-
-def parse_dist(filename):
-    '''Parses a softwareupdate dist file, returning a dict of info of
-    interest'''
-    dist_info = {}
-    try:
-        dom = minidom.parse(filename)
-    except ExpatError:
-        print >> sys.stderr, 'Invalid XML in %s' % filename
-        return dist_info
-    except IOError, err:
-        print >> sys.stderr, 'Error reading %s: %s' % (filename, err)
-        return dist_info
-
-    auxinfos = dom.getElementsByTagName('auxinfo')
-    if not auxinfos:
-        return dist_info
-    auxinfo = auxinfos[0]
-    key = None
-    value = None
-    children = auxinfo.childNodes
-    # handle the possibility that keys from auxinfo may be nested
-    # within a 'dict' element
-    dict_nodes = [n for n in auxinfo.childNodes
-                  if n.nodeType == n.ELEMENT_NODE and
-                  n.tagName == 'dict']
-    if dict_nodes:
-        children = dict_nodes[0].childNodes
-    for node in children:
-        if node.nodeType == node.ELEMENT_NODE and node.tagName == 'key':
-            key = node.firstChild.wholeText
-        if node.nodeType == node.ELEMENT_NODE and node.tagName == 'string':
-            value = node.firstChild.wholeText
-        if key and value:
-            dist_info[key] = value
-            key = None
-            value = None
-    return dist_info
 
+    def matches(self, url, size, etag, last_modified):
+        '''Returns True if the partial download can be resumed from a copy
+        with this size and these validators'''
+        if url != self.url or size != self.size:
+            return False
+        if etag and self.etag:
+            return etag == self.etag
+        if last_modified and self.last_modified:
+            return last_modified == self.last_modified
+        return False
 
-def download_and_parse_sucatalog(sucatalog, workdir, ignore_cache=False):
-    '''Downloads and returns a parsed softwareupdate catalog'''
+    def save(self):
+        '''Write the journal to disk, replacing any previous copy'''
+        journal = {'URL': self.url, 'Size': self.size,
+                   'Completed': [list(item) for item in self.completed]}
+        if self.etag:
+            journal['ETag'] = self.etag
+        if self.last_modified:
+            journal['LastModified'] = self.last_modified
+        plistlib.writePlist(journal, self.path + '.new')
+        os.rename(self.path + '.new', self.path)
+
+    def remove(self):
+        '''Delete the journal'''
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def add(self, start, end):
+        '''Record that bytes start through end are on disk'''
+        with self.lock:
+            ranges = sorted(self.completed + [(start, end)])
+            merged = [ranges[0]]
+            for first, last in ranges[1:]:
+                if first <= merged[-1][1] + 1:
+                    merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+                else:
+                    merged.append((first, last))
+            self.completed = merged
+            self.save()
+
+    def completed_bytes(self):
+        '''Returns the number of bytes already on disk'''
+        return sum(last - first + 1 for first, last in self.completed)
+
+    def missing(self):
+        '''Returns a list of the (start, end) ranges still to be fetched'''
+        gaps = []
+        position = 0
+        for first, last in self.completed:
+            if first > position:
+                gaps.append((position, first - 1))
+            position = max(position, last + 1)
+        if position < self.size:
+            gaps.append((position, self.size - 1))
+        return gaps
+
+
+def fetch_range(url, path, start, end, progress=None, cancelled=None,
+                validator=None, journal=None, check=None):
+    '''Fetches bytes start through end (inclusive) of url and writes them
+    at the same offset in the existing file at path. If validator (an ETag
+    or Last-Modified value) is given the server must still hold that copy
+    of the file. If journal is given, the bytes written are synced and
+    recorded in it every JOURNAL_INTERVAL bytes. If check is given, it is
+    passed the bytes as they are written.'''
+    headers = {'Range': 'bytes=%s-%s' % (start, end)}
+    if validator:
+        headers['If-Range'] = validator
+    response, final_url = HTTP_POOL.urlopen('GET', url, headers)
+    host = urlparse.urlsplit(final_url).hostname
     try:
-        localcatalogpath = replicate_url(
-            sucatalog, root_dir=workdir, ignore_cache=ignore_cache)
-    except ReplicationError, err:
-        print >> sys.stderr, 'Could not replicate %s: %s' % (sucatalog, err)
-        exit(-1)
+        content_range = response.getheader('content-range', '')
+        if (response.status != 206 or not
+                content_range.startswith('bytes %s-' % start)):
+            raise ReplicationError(
+                'Range request for %s returned HTTP %s; has it changed on '
+                'the server?' % (url, response.status))
+        with open(path, 'r+b') as fileobj:
+            fileobj.seek(start)
+            position = unsynced = start
+            while position <= end:
+                if cancelled and cancelled():
+                    raise ReplicationError('Transfer of %s cancelled' % url)
+                try:
+                    data = response.read(min(READ_SIZE, end - position + 1))
+                except (httplib.HTTPException, socket.error), err:
+                    raise ReplicationError(err)
+                if not data:
+                    raise ReplicationError(
+                        'Connection closed early while fetching %s' % url)
+                PHASES.count('bytes', len(data))
+                RATE_LIMIT.throttle(host, len(data))
+                fileobj.write(data)
+                if check:
+                    check.update(position, data)
+                position += len(data)
+                if progress:
+                    progress(len(data))
+                if journal and (position - unsynced >= JOURNAL_INTERVAL or
+                                position > end):
+                    fileobj.flush()
+                    os.fsync(fileobj.fileno())
+                    journal.add(unsynced, position - 1)
+                    unsynced = position
+    finally:
+        HTTP_POOL.release(response)
+
+
+def split_ranges(ranges, segments, boundaries=None):
+    '''Splits a list of (start, end) byte ranges into pieces of at least
+    MIN_SEGMENT_SIZE bytes, about segments of them in all. Given a sorted
+    list of boundaries, pieces are extended to end just before one, so
+    that no chunk starting at a boundary is split between pieces.'''
+    total = sum(end - start + 1 for start, end in ranges)
+    piece_size = max(MIN_SEGMENT_SIZE, -(-total // max(1, segments)))
+    pieces = []
+    for start, end in ranges:
+        first = start
+        while first <= end:
+            last = min(first + piece_size - 1, end)
+            if boundaries and last < end:
+                index = bisect.bisect_left(boundaries, last + 1)
+                if index < len(boundaries):
+                    last = min(boundaries[index] - 1, end)
+                else:
+                    last = end
+            pieces.append((first, last))
+            first = last + 1
+    return pieces
+
+
+def parse_chunklist(path):
+    '''Returns a list of (offset, size, SHA-256 digest) tuples for the
+    chunks described by the chunklist file at path. Raises ValueError if it
+    isn't a chunklist of SHA-256 digests. The signature is not checked.'''
+    with open(path, 'rb') as fileobj:
+        data = fileobj.read()
     try:
-        catalog = plistlib.readPlist(localcatalogpath)
-        return catalog
-    except (OSError, IOError, ExpatError), err:
-        print >> sys.stderr, (
-            'Error reading %s: %s' % (localcatalogpath, err))
-        exit(-1)
-
-
-def find_mac_os_installers(catalog):
-    '''Return a list of product identifiers for what appear to be macOS
-    installers'''
-    mac_os_installer_products = []
-    if 'Products' in catalog:
-        product_keys = list(catalog['Products'].keys())
-        for product_key in product_keys:
-            product = catalog['Products'][product_key]
-            try:
-                if product['ExtendedMetaInfo'][
-                        'InstallAssistantPackageIdentifiers'][
-                            'OSInstall'] == 'com.apple.mpkg.OSInstall':
-                    mac_os_installer_products.append(product_key)
-            except KeyError:
-                continue
-    return mac_os_installer_products
-
-
-def os_installer_product_info(catalog, workdir, ignore_cache=False):
-    '''Returns a dict of info about products that look like macOS installers'''
-    product_info = {}
-    installer_products = find_mac_os_installers(catalog)
-    for product_key in installer_products:
-        product_info[product_key] = {}
-        filename = get_server_metadata(catalog, product_key, workdir)
-        product_info[product_key] = parse_server_metadata(filename)
-        product = catalog['Products'][product_key]
-        product_info[product_key]['PostDate'] = str(product['PostDate'])
-        distributions = product['Distributions']
-        dist_url = distributions.get('English') or distributions.get('en')
+        (magic, _, _, method, _, _, count,
+         chunk_offset, _) = struct.unpack('<IIBBBBQQQ', data[:36])
+    except struct.error:
+        raise ValueError('%s is too short to be a chunklist' % path)
+    if magic != CHUNKLIST_MAGIC or method != CHUNKLIST_SHA256:
+        raise ValueError('%s is not a SHA-256 chunklist' % path)
+    chunks = []
+    position = 0
+    for index in range(count):
+        entry = data[chunk_offset + index * 36:chunk_offset + index * 36 + 36]
         try:
-            dist_path = replicate_url(
-                dist_url, root_dir=workdir, ignore_cache=ignore_cache)
-        except ReplicationError, err:
-            print >> sys.stderr, 'Could not replicate %s: %s' % (dist_url, err)
-        dist_info = parse_dist(dist_path)
-        product_info[product_key]['DistributionPath'] = dist_path
-        product_info[product_key].update(dist_info)
-
-    return product_info
-
-
-def replicate_product(catalog, product_id, workdir, ignore_cache=False):
-    '''Downloads all the packages for a product'''
-    product = catalog['Products'][product_id]
-    for package in product.get('Packages', []):
-        # TO-DO: Check 'Size' attribute and make sure
-        # we have enough space on the target
-        # filesystem before attempting to download
-        if 'URL' in package:
-            try:
-                replicate_url(
-                    package['URL'], root_dir=workdir,
-                    show_progress=True, ignore_cache=ignore_cache)
-            except ReplicationError, err:
-                print >> sys.stderr, (
-                    'Could not replicate %s: %s' % (package['URL'], err))
-                exit(-1)
-        if 'MetadataURL' in package:
-            try:
-                replicate_url(package['MetadataURL'], root_dir=workdir,
-                              ignore_cache=ignore_cache)
-            except ReplicationError, err:
-                print >> sys.stderr, (
-                    'Could not replicate %s: %s'
-                    % (package['MetadataURL'], err))
-                exit(-1)
-
-def main():
-    '''Do the main thing here'''
-
-    if os.getuid() != 0:
-        sys.exit('This command requires root (to install packages), so please '
-                 'run again with sudo or as root.')
-
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--catalogurl', metavar='sucatalog_url',
-                        default=DEFAULT_SUCATALOG,
-                        help='Software Update catalog URL.')
-    parser.add_argument('--workdir', metavar='path_to_working_dir',
-                        default='.',
-                        help='Path to working directory on a volume with over '
-                        '10G of available space. Defaults to current working '
-                        'directory.')
-    parser.add_argument('--compress', action='store_true',
-                        help='Output a read-only compressed disk image with '
-                        'the Install macOS app at the root.')
-    parser.add_argument('--ignore-cache', action='store_true',
-                        help='Ignore any previously cached files.')
-    parser.add_argument('--build', metavar='build_version',
-                        default='',
-                        help='Specify a specific build to search for and '
-                        'download.')
-    parser.add_argument('--list', action='store_true',
-                        help='Output the available updates to a plist '
-                        'and quit.')
-    args = parser.parse_args()
-
-    # download sucatalog and look for products that are for macOS installers
-    catalog = download_and_parse_sucatalog(
-        args.catalogurl, args.workdir, ignore_cache=args.ignore_cache)
-    product_info = os_installer_product_info(
-        catalog, args.workdir, ignore_cache=args.ignore_cache)
-
-    if not product_info:
-        print >> sys.stderr, (
-            'No macOS installer products found in the sucatalog.')
-        exit(-1)
-
-    output_plist = "%s/softwareupdate.plist" % args.workdir
-    pl = {}
-    pl['result'] = []
-
-    # display a menu of choices (some seed catalogs have multiple installers)
-    print '%2s %12s %10s %8s  %s' % ('#', 'ProductID', 'Version',
-                                     'Build', 'Title')
-    for index, product_id in enumerate(product_info):
-        print '%2s %12s %10s %8s  %s' % (index+1,
-                                         product_id,
-                                         product_info[product_id]['version'],
-                                         product_info[product_id]['BUILD'],
-                                         product_info[product_id]['title'])
-
-        pl_index =  {'index': index+1,
-                'product_id': product_id,
-                'version': product_info[product_id]['version'],
-                'build': product_info[product_id]['BUILD'],
-                'title': product_info[product_id]['title'],
-                }
-
-        pl['result'].append(pl_index)
-
-        if args.build:
-            if args.build == product_info[product_id]['BUILD']:
-                answer = index+1
-
-
-    # Output a plist of available updates and quit if --list option chosen
-    if args.list:
-        plistlib.writePlist(pl, output_plist)
-        exit(0)
+            size, digest = struct.unpack('<I32s', entry)
+        except struct.error:
+            raise ValueError('%s is truncated' % path)
+        chunks.append((position, size, digest))
+        position += size
+    return chunks
+
+
+def hash_mapped(mapped, start, length, hasher):
+    '''Feeds length bytes of the mmap mapped from start to hasher, without
+    copying them. Returns hasher.'''
+    end = min(start + length, len(mapped))
+    for offset in range(start, end, READ_SIZE):
+        hasher.update(buffer(mapped, offset, min(READ_SIZE, end - offset)))
+    return hasher
+
+
+class IntegrityCheck(object):
+    '''Checks a download against the size, SHA-1 digest and SHA-256
+    chunklist the catalog gives for it, hashing its bytes as they are
+    written by any number of transfers. Chunks whose bytes didn't all
+    arrive in order, such as those resumed from an earlier run, are read
+    back from disk, through mmap and from up to jobs threads, when the
+    download is checked.'''
+
+    def __init__(self, size=None, digest=None, chunks=None):
+        self.size = size
+        self.digest = digest.lower() if digest else None
+        self.chunks = chunks or []
+        self.offsets = [chunk[0] for chunk in self.chunks]
+        self.lock = threading.Lock()
+        # chunk index -> [sha256 of the bytes so far, next offset expected]
+        self.hashing = {}
+        # chunk index -> True if it matched its digest
+        self.verified = {}
+        self.sha1 = hashlib.sha1()
+        self.sha1_position = 0
+        self.sha1_stale = False
+        self.passed = False
+
+    def update(self, offset, data):
+        '''Hash data, which has just been written at offset'''
+        if self.digest:
+            with self.lock:
+                if offset == self.sha1_position:
+                    self.sha1.update(data)
+                    self.sha1_position += len(data)
+                elif offset < self.sha1_position:
+                    self.sha1_stale = True
+        position = offset
+        end = offset + len(data)
+        index = bisect.bisect_right(self.offsets, position) - 1
+        while index >= 0 and index < len(self.chunks) and position < end:
+            chunk_offset, chunk_size, chunk_digest = self.chunks[index]
+            chunk_end = chunk_offset + chunk_size
+            piece_end = min(end, chunk_end)
+            with self.lock:
+                if position == chunk_offset:
+                    self.hashing[index] = [hashlib.sha256(), chunk_offset]
+                    self.verified.pop(index, None)
+                state = self.hashing.get(index)
+                if state and state[1] == position:
+                    state[1] = piece_end
+                else:
+                    # out of order, so left to be read back from disk
+                    self.hashing.pop(index, None)
+                    state = None
+            if state:
+                state[0].update(
+                    buffer(data, position - offset, piece_end - position))
+                if piece_end == chunk_end:
+                    with self.lock:
+                        self.verified[index] = (
+                            state[0].digest() == chunk_digest)
+                        self.hashing.pop(index, None)
+            position = piece_end
+            index += 1
+
+    def damaged_ranges(self, path, jobs=1):
+        '''Returns a list of the (start, end) ranges of chunks of the file
+        at path that don't match the chunklist'''
+        unchecked = [index for index in range(len(self.chunks))
+                     if index not in self.verified]
+        if unchecked:
+            with open(path, 'rb') as fileobj:
+                try:
+                    mapped = mmap.mmap(fileobj.fileno(), 0,
+                                       access=mmap.ACCESS_READ)
+                except (ValueError, mmap.error):
+                    # an empty file can't be mapped, nor does it match
+                    mapped = None
+                try:
+                    results = concurrent_map(
+                        lambda index: mapped is not None and hash_mapped(
+                            mapped, self.chunks[index][0],
+                            self.chunks[index][1],
+                            hashlib.sha256()).digest() == self.chunks[index][2],
+                        unchecked, jobs)
+                finally:
+                    if mapped is not None:
+                        mapped.close()
+            with self.lock:
+                self.verified.update(zip(unchecked, results))
+        return [(self.chunks[index][0],
+                 self.chunks[index][0] + self.chunks[index][1] - 1)
+                for index in sorted(self.verified)
+                if not self.verified[index]]
+
+    def matches(self, path):
+        '''Returns True if the file at path is the size the catalog gives
+        and matches its digest. Once every chunk has matched the chunklist,
+        the digest is only compared if it was worked out as the bytes
+        arrived; otherwise the rest of the file is read back to finish
+        it.'''
+        if self.size and os.path.getsize(path) != self.size:
+            return False
+        if self.digest:
+            complete = (not self.sha1_stale and
+                        self.sha1_position == os.path.getsize(path))
+            if (not complete and self.chunks and
+                    len(self.verified) == len(self.chunks)):
+                return all(self.verified.values())
+            if not complete:
+                if self.sha1_stale:
+                    self.sha1 = hashlib.sha1()
+                    self.sha1_position = 0
+                    self.sha1_stale = False
+                with open(path, 'rb') as fileobj:
+                    fileobj.seek(self.sha1_position)
+                    for block in iter(lambda: fileobj.read(READ_SIZE), ''):
+                        self.sha1.update(block)
+                        self.sha1_position += len(block)
+            if self.sha1.hexdigest() != self.digest:
+                return False
+        return all(self.verified.values())
+
+
+def verify_download(url, path, check, progress=None, cancel=None,
+                    validator=None):
+    '''Re-fetches any chunks of the download at path that check finds
+    damaged, up to CHUNK_RETRIES times, then makes sure the whole file
+    matches. Raises ReplicationError if it still doesn't.'''
+    cancelled = lambda: cancel is not None and cancel.is_set()
+    for attempt in range(CHUNK_RETRIES + 1):
+        damaged = check.damaged_ranges(path)
+        if not damaged:
+            break
+        if attempt == CHUNK_RETRIES:
+            raise ReplicationError(
+                '%s chunks of %s are still damaged after %s attempts'
+                % (len(damaged), url, CHUNK_RETRIES))
+        sys.stdout.write('Re-fetching %s damaged chunks of %s...\n'
+                         % (len(damaged), url))
+        for start, end in damaged:
+            fetch_range(url, path, start, end, progress=progress,
+                        cancelled=cancelled, validator=validator,
+                        check=check)
+    if not check.matches(path):
+        raise ReplicationError(
+            '%s does not match the size and digest in the catalog' % url)
+    check.passed = True
+
+
+def not_modified(local_file_path, length, last_modified):
+    '''Returns True if the file at local_file_path is the expected length
+    and no older than the last_modified HTTP date, the same test curl's -z
+    option makes'''
+    if not last_modified or not os.path.exists(local_file_path):
+        return False
+    modified = email.utils.parsedate_tz(last_modified)
+    if modified is None:
+        return False
+    return (os.path.getsize(local_file_path) == length and
+            os.path.getmtime(local_file_path) >=
+            email.utils.mktime_tz(modified))
+
+
+def replicate_segmented(full_url, local_file_path, segments,
+                        expected_size=None, ignore_cache=False,
+                        progress=None, cancel=None, check=None):
+    '''Downloads full_url as byte ranges, up to segments of them fetched
+    concurrently, each written straight to its offset in a preallocated
+    file. Progress is kept in a ResumeJournal beside the file, so that an
+    interrupted download only fetches the missing ranges next time, unless
+    the file has changed on the server. Given an IntegrityCheck, ranges
+    are split on chunk boundaries and checked as they arrive, and damaged
+    chunks are fetched again.
+    Returns False without downloading anything if the server does not
+    support range requests.'''
+    response, url = HTTP_POOL.urlopen('HEAD', full_url)
+    HTTP_POOL.release(response)
+    if response.status != 200:
+        raise ReplicationError('HTTP %s for %s' % (response.status, url))
+    length = response.getheader('content-length')
+    if (not length or
+            'bytes' not in response.getheader('accept-ranges', '').lower()):
+        print 'Server does not support range requests, using one stream...'
+        return False
+    length = int(length)
+    if expected_size and length != expected_size:
+        raise ReplicationError(
+            '%s is %s bytes on the server but the catalog says %s'
+            % (full_url, length, expected_size))
+    etag = response.getheader('etag')
+    last_modified = response.getheader('last-modified')
+
+    temp_file_path = local_file_path + '.download'
+    journal_path = local_file_path + '.journal'
+    if not ignore_cache and not_modified(
+            local_file_path, length, last_modified):
+        # any partial download left beside a current copy is stale
+        for path in (temp_file_path, journal_path):
+            if os.path.exists(path):
+                os.unlink(path)
+        PHASES.count('hits')
+        return True
 
-    # check for specified build if argument supplied
-    if args.build:
+    journal = None
+    if not ignore_cache and os.path.exists(temp_file_path):
+        journal = ResumeJournal.load(journal_path)
+        if journal and journal.matches(full_url, length, etag,
+                                       last_modified):
+            print 'Resuming with %s of %s already downloaded...' % (
+                human_size(journal.completed_bytes()), human_size(length))
+        elif journal:
+            print 'File has changed on the server, starting again...'
+            journal = None
+    if journal is None:
+        if not os.path.isdir(os.path.dirname(local_file_path)):
+            os.makedirs(os.path.dirname(local_file_path))
+        with open(temp_file_path, 'wb') as fileobj:
+            fileobj.truncate(length)
+        journal = ResumeJournal(journal_path, full_url, length,
+                                etag=etag, last_modified=last_modified)
+        journal.save()
+    if progress and journal.completed:
+        progress(journal.completed_bytes())
+
+    # If-Range only accepts a strong validator
+    validator = last_modified
+    if etag and not etag.startswith('W/'):
+        validator = etag
+    abandoned = threading.Event()
+
+    def cancelled():
+        '''True once a sibling range failed or the transfer is cancelled'''
+        return abandoned.is_set() or (cancel is not None and cancel.is_set())
+
+    def fetch(byte_range):
+        '''Fetch one range, abandoning the others if it fails'''
         try:
-            answer
-        except NameError:
-            print ('No valid build chosen. Run again without --build argument'
-                   'to select a valid build to download.')
-            exit(0)
-        else:
-            print '# %s chosen.' % answer
-    else:
-        answer = raw_input(
-                '\nChoose a product to download (1-%s): ' % len(product_info))
-
+            fetch_range(url, temp_file_path, byte_range[0], byte_range[1],
+                        progress=progress, cancelled=cancelled,
+                        validator=validator, journal=journal, check=check)
+        except ReplicationError:
+            abandoned.set()
+            raise
+
+    # the partial file and journal are left in place if this fails
+    boundaries = check.offsets if check else None
+    concurrent_map(fetch,
+                   split_ranges(journal.missing(), segments, boundaries),
+                   segments)
+    if check:
+        try:
+            verify_download(url, temp_file_path, check, progress=progress,
+                            cancel=cancel, validator=validator)
+        except ReplicationError:
+            # damaged chunks are fetched again when resumed, but if none
+            # are left (or there is no chunklist) the journal would only
+            # resume a complete, bad file, so start again next time
+            if all(check.verified.values()):
+                os.unlink(temp_file_path)
+                journal.remove()
+            raise
+    os.rename(temp_file_path, local_file_path)
+    journal.remove()
+    PHASES.count('misses')
+    return True
+
+
+def replicate_stream(full_url, local_file_path, ignore_cache=False,
+                     progress=None, cancel=None, check=None):
+    '''Downloads full_url to local_file_path in a single request, unless
+    the copy already there is current, the same as curl's -z option.
+    Given an IntegrityCheck, the bytes are checked as they arrive and
+    damaged chunks are fetched again as byte ranges.'''
+    headers = {}
+    if not ignore_cache and os.path.exists(local_file_path):
+        headers['If-Modified-Since'] = email.utils.formatdate(
+            os.path.getmtime(local_file_path), usegmt=True)
+    response, url = HTTP_POOL.urlopen('GET', full_url, headers)
     try:
-        index = int(answer) - 1
-        if index < 0:
-            raise ValueError
-        product_id = product_info.keys()[index]
-    except (ValueError, IndexError):
-        print 'Exiting.'
-        exit(0)
-
-    # download all the packages for the selected product
-    replicate_product(
-        catalog, product_id, args.workdir, ignore_cache=args.ignore_cache)
-
-    # generate a name for the sparseimage
-    volname = ('Install_macOS_%s-%s'
-               % (product_info[product_id]['version'],
-                  product_info[product_id]['BUILD']))
-    sparse_diskimage_path = os.path.join(args.workdir, volname + '.sparseimage')
-    if os.path.exists(sparse_diskimage_path):
-        os.unlink(sparse_diskimage_path)
-
-    # make an empty sparseimage and mount it
-    print 'Making empty sparseimage...'
-    sparse_diskimage_path = make_sparse_image(volname, sparse_diskimage_path)
-    mountpoint = mountdmg(sparse_diskimage_path)
-    if mountpoint:
-        # install the product to the mounted sparseimage volume
-        success = install_product(
-            product_info[product_id]['DistributionPath'],
-            mountpoint)
-        if not success:
-            print >> sys.stderr, 'Product installation failed.'
-            unmountdmg(mountpoint)
-            exit(-1)
-        print 'Product downloaded and installed to %s' % sparse_diskimage_path
-        if not args.compress:
-            unmountdmg(mountpoint)
-        else:
-            # if --compress option given, create a r/o compressed diskimage
-            # containing the Install macOS app
-            compressed_diskimagepath = os.path.join(
-                args.workdir, volname + '.dmg')
-            if os.path.exists(compressed_diskimagepath):
-                os.unlink(compressed_diskimagepath)
-            applications_dir = os.path.join(mountpoint, 'Applications')
-            for item in os.listdir(applications_dir):
-                if item.endswith('.app'):
-                    app_path = os.path.join(applications_dir, item)
-                    make_compressed_dmg(app_path, compressed_diskimagepath)
-                    break
-            # unmount sparseimage
-            unmountdmg(mountpoint)
-            # delete sparseimage since we don't need it any longer
-            os.unlink(sparse_diskimage_path)
-
-
-if __name__ == '__main__':
-    main()#!/usr/bin/python
-# encoding: utf-8
-#
-# Copyright 2017 Greg Neagle.
-#
-# Licensed under the Apache License, Version 2.0 (the "License");
-# you may not use this file except in compliance with the License.
-# You may obtain a copy of the License at
-#
-#      http://www.apache.org/licenses/LICENSE-2.0
-#
-# Unless required by applicable law or agreed to in writing, software
-# distributed under the License is distributed on an "AS IS" BASIS,
-# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
-# See the License for the specific language governing permissions and
-# limitations under the License.
-#
-# Thanks to Tim Sutton for ideas, suggestions, and sample code.
-#
-
-'''installinstallmacos.py
-A tool to download the parts for an Install macOS app from Apple's
-softwareupdate servers and install a functioning Install macOS app onto an
-empty disk image'''
-
-
-import argparse
-import os
-import plistlib
-import subprocess
-import sys
-import urlparse
-from xml.dom import minidom
-from xml.parsers.expat import ExpatError
-
-
-DEFAULT_SUCATALOG = (
-    'https://swscan.apple.com/content/catalogs/others/'
-    'index-10.13seed-10.13-10.12-10.11-10.10-10.9'
-    '-mountainlion-lion-snowleopard-leopard.merged-1.sucatalog')
+        if response.status == 304:
+            PHASES.count('hits')
+            return
+        if response.status != 200:
+            raise ReplicationError('HTTP %s for %s' % (response.status, url))
+        # write to a temporary file so an interrupted transfer never leaves
+        # a partial file that would later be taken as current
+        temp_file_path = local_file_path + '.download'
+        if not os.path.isdir(os.path.dirname(local_file_path)):
+            os.makedirs(os.path.dirname(local_file_path))
+        try:
+            position = 0
+            host = urlparse.urlsplit(url).hostname
+            with open(temp_file_path, 'wb') as fileobj:
+                while True:
+                    if cancel is not None and cancel.is_set():
+                        raise ReplicationError(
+                            'Transfer of %s cancelled' % full_url)
+                    try:
+                        data = response.read(READ_SIZE)
+                    except (httplib.HTTPException, socket.error), err:
+                        raise ReplicationError(err)
+                    if not data:
+                        break
+                    PHASES.count('bytes', len(data))
+                    RATE_LIMIT.throttle(host, len(data))
+                    fileobj.write(data)
+                    if check:
+                        check.update(position, data)
+                    position += len(data)
+                    if progress:
+                        progress(len(data))
+            if response.length:
+                raise ReplicationError(
+                    'Connection closed early while fetching %s' % url)
+            if check:
+                validator = response.getheader('last-modified')
+                etag = response.getheader('etag')
+                if etag and not etag.startswith('W/'):
+                    validator = etag
+                verify_download(url, temp_file_path, check,
+                                progress=progress, cancel=cancel,
+                                validator=validator)
+        except:
+            if os.path.exists(temp_file_path):
+                os.unlink(temp_file_path)
+            raise
+        os.rename(temp_file_path, local_file_path)
+        PHASES.count('misses')
+    finally:
+        HTTP_POOL.release(response)
 
 
-def make_sparse_image(volume_name, output_path):
-    '''Make a sparse disk image we can install a product to'''
-    cmd = ['/usr/bin/hdiutil', 'create', '-size', '8g', '-fs', 'HFS+',
-           '-volname', volume_name, '-type', 'SPARSE', '-plist', output_path]
-    try:
-        output = subprocess.check_output(cmd)
-    except subprocess.CalledProcessError, err:
-        print >> sys.stderr, err
-        exit(-1)
+def replicate_url(full_url, root_dir='/tmp',
+                  show_progress=False, ignore_cache=False, cancel=None,
+                  size=None, segments=1, progress=None, check=None):
+    '''Downloads a URL and stores it in the same relative path on our
+    filesystem. Returns a path to the replicated file.
+    If cancel is a threading.Event, the transfer is abandoned as soon as
+    it is set. Files of at least SEGMENT_THRESHOLD bytes (going by size,
+    the size the catalog expects) are fetched as resumable byte ranges,
+    up to segments of them at once, when the server supports it.
+    progress, if given, is called with the number of bytes received as
+    they arrive. check, if given, is an IntegrityCheck the download must
+    pass; a copy already current is not checked again.'''
+
+    local_file_path = local_path_for_url(full_url, root_dir)
+    # a single write keeps lines from concurrent transfers apart
+    sys.stdout.write('Downloading %s...\n' % full_url)
+    monitor = None
+    if show_progress and progress is None:
+        monitor = ProgressMonitor([(full_url, size)])
+        progress = lambda count: monitor.transfer_progress(full_url, count)
+        monitor.start()
     try:
-        return plistlib.readPlistFromString(output)[0]
-    except IndexError, err:
-        print >> sys.stderr, 'Unexpected output from hdiutil: %s' % output
-        exit(-1)
-    except ExpatError, err:
-        print >> sys.stderr, 'Malformed output from hdiutil: %s' % output
-        print >> sys.stderr, err
-        exit(-1)
+        if not (size and size >= SEGMENT_THRESHOLD and replicate_segmented(
+                full_url, local_file_path, segments, expected_size=size,
+                ignore_cache=ignore_cache, progress=progress,
+                cancel=cancel, check=check)):
+            replicate_stream(full_url, local_file_path,
+                             ignore_cache=ignore_cache, progress=progress,
+                             cancel=cancel, check=check)
+    finally:
+        if monitor:
+            monitor.stop()
+    CACHE_INDEX.used(local_file_path)
+    return local_file_path
 
 
-def make_compressed_dmg(app_path, diskimagepath):
-    """Returns path to newly-created compressed r/o disk image containing
-    Install macOS.app"""
-
-    print ('Making read-only compressed disk image containing %s...'
-           % os.path.basename(app_path))
-    cmd = ['/usr/bin/hdiutil', 'create', '-fs', 'HFS+',
-           '-srcfolder', app_path, diskimagepath]
+def concurrent_map(func, items, jobs=1):
+    '''Calls func on each of items using up to jobs worker threads.
+    Returns a list of the results in the same order as items. If a call
+    raises, items not yet started are skipped and the first exception is
+    re-raised once the calls in progress have returned.'''
+    items = list(items)
+    if jobs <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    results = [None] * len(items)
+    errors = []
+    lock = threading.Lock()
+    indexes = iter(range(len(items)))
+
+    def worker():
+        '''Process items until there are none left or one has failed'''
+        while True:
+            with lock:
+                if errors:
+                    return
+                try:
+                    index = next(indexes)
+                except StopIteration:
+                    return
+            try:
+                results[index] = func(items[index])
+            except Exception:
+                with lock:
+                    errors.append(sys.exc_info())
+                return
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(min(jobs, len(items)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        # join with a timeout so the main thread still sees Ctrl-C
+        while thread.is_alive():
+            thread.join(0.5)
+    if errors:
+        exc_type, exc_value, exc_traceback = errors[0]
+        raise exc_type, exc_value, exc_traceback
+    return results
+
+
+class BackgroundTask(threading.Thread):
+    '''Calls func(*args) on a background thread, keeping what it returns
+    or raises for result(). failed is a threading.Event set as soon as
+    func raises, so other work can stop without waiting for result().'''
+
+    def __init__(self, func, *args):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.func = func
+        self.args = args
+        self.value = None
+        self.error = None
+        self.failed = threading.Event()
+
+    def run(self):
+        '''Call func, keeping its result'''
+        try:
+            self.value = self.func(*self.args)
+        # including SystemExit, which would otherwise only end the thread
+        except BaseException:
+            self.error = sys.exc_info()
+            self.failed.set()
+
+    def result(self):
+        '''Waits for func to return and returns what it did, or re-raises
+        what it raised. Works whether the task was started or run on the
+        calling thread.'''
+        # join with a timeout so the main thread still sees Ctrl-C
+        while self.is_alive():
+            self.join(0.5)
+        if self.error:
+            exc_type, exc_value, exc_traceback = self.error
+            raise exc_type, exc_value, exc_traceback
+        return self.value
+
+
+def human_size(num_bytes):
+    '''Returns num_bytes as a short human-readable string'''
+    if num_bytes < 1024:
+        return '%d bytes' % num_bytes
+    for unit in ('KB', 'MB', 'GB', 'TB'):
+        num_bytes /= 1024.0
+        if num_bytes < 1024:
+            break
+    return '%.1f %s' % (num_bytes, unit)
+
+
+class EventStream(object):
+    '''Writes machine-readable events for --format ndjson, one JSON object
+    per line, each with an "event" name and the time it happened. Does
+    nothing until started.'''
+
+    def __init__(self):
+        self.output = None
+        self.lock = threading.Lock()
+
+    def start(self, output):
+        '''Start writing events to the file object output'''
+        self.output = output
+
+    def emit(self, event, **fields):
+        '''Write one event, if started'''
+        if self.output is None:
+            return
+        fields['event'] = event
+        fields['time'] = round(time.time(), 3)
+        line = json.dumps(fields, sort_keys=True, default=str)
+        with self.lock:
+            self.output.write(line + '\n')
+            self.output.flush()
+
+
+EVENTS = EventStream()
+
+
+class ProgressMonitor(threading.Thread):
+    '''Periodically prints the combined progress of a batch of concurrent
+    transfers, and emits the progress of each one to EVENTS'''
+
+    def __init__(self, downloads, interval=PROGRESS_INTERVAL):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.count = len(downloads)
+        self.total = sum(download[1] for download in downloads if download[1])
+        self.sizes = dict((download[0], download[1])
+                          for download in downloads)
+        self.interval = interval
+        self.completed = 0
+        self.received = 0
+        # url -> [bytes received, time started] for each transfer under way
+        self.active = {}
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+
+    def transfer_started(self, url):
+        '''Record that a transfer of url has started'''
+        with self.lock:
+            self.active[url] = [0, time.time()]
+        EVENTS.emit('download_started', url=url, size=self.sizes.get(url))
+
+    def transfer_progress(self, url, count):
+        '''Record that count more bytes of url have been received'''
+        with self.lock:
+            self.received += count
+            if url in self.active:
+                self.active[url][0] += count
+
+    def transfer_done(self, url=None, cache_hit=None):
+        '''Record that one of the transfers has completed. Unless told
+        otherwise, a transfer that received nothing is taken to have found
+        its file already current.'''
+        now = time.time()
+        with self.lock:
+            self.completed += 1
+            received, started = self.active.pop(url, [0, now])
+        if url is not None:
+            if cache_hit is None:
+                cache_hit = not received
+            EVENTS.emit('download_done', url=url, size=self.sizes.get(url),
+                        bytes=received, seconds=round(now - started, 3),
+                        cache='hit' if cache_hit else 'miss')
+
+    def transfer_failed(self, url, err):
+        '''Record that the transfer of url failed'''
+        with self.lock:
+            self.active.pop(url, None)
+        EVENTS.emit('download_failed', url=url, error=str(err))
+
+    def report_transfers(self):
+        '''Emit the bytes received, rate and estimated time remaining of
+        each transfer under way'''
+        now = time.time()
+        with self.lock:
+            active = [(url, received, started)
+                      for url, (received, started) in self.active.items()]
+        for url, received, started in sorted(active):
+            size = self.sizes.get(url)
+            rate = received / max(now - started, 0.001)
+            eta = None
+            if size and rate:
+                eta = round(max(size - received, 0) / rate, 1)
+            EVENTS.emit('download_progress', url=url, size=size,
+                        bytes=received, rate=int(rate), eta=eta)
+
+    def report(self):
+        '''Print a single line summarising progress so far'''
+        line = 'Progress: %s of %s files' % (self.completed, self.count)
+        if self.total:
+            received = min(self.received, self.total)
+            line += ', %s of %s (%d%%)' % (
+                human_size(received), human_size(self.total),
+                received * 100 / self.total)
+        else:
+            line += ', %s' % human_size(self.received)
+        print line
+        sys.stdout.flush()
+        self.report_transfers()
+
+    def run(self):
+        while not self.finished.wait(self.interval):
+            self.report()
+
+    def stop(self):
+        '''Stop reporting, printing a final progress line'''
+        self.finished.set()
+        self.join()
+        self.report()
+
+
+def file_digest(path):
+    '''Returns the SHA-1 hex digest of the file at path'''
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fileobj:
+        for block in iter(lambda: fileobj.read(READ_SIZE), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def link_or_copy(source, destination):
+    '''Hard links source to destination, copying it instead on filesystems
+    that don't support hard links'''
     try:
-        subprocess.check_call(cmd)
-    except subprocess.CalledProcessError, err:
-        print >> sys.stderr, err
-    else:
-        print 'Disk image created at: %s' % diskimagepath
+        os.link(source, destination)
+    except OSError, err:
+        if err.errno not in (errno.EXDEV, errno.EPERM, errno.ENOTSUP,
+                             errno.EMLINK):
+            raise
+        shutil.copyfile(source, destination)
+
+
+class PackageStore(object):
+    '''Keeps one copy of each package, named by the SHA-1 digest and size
+    the catalog gives for it, hard linked into the URL-shaped tree wherever
+    a product refers to it. A package posted under several URLs, products
+    or catalogs is only downloaded and stored once.'''
+
+    def __init__(self, root):
+        self.root = root
+
+    @staticmethod
+    def key(digest, size):
+        '''Returns the name a package is stored under, or None if digest
+        and size don't identify it'''
+        if not size or not digest or len(digest) != 40:
+            return None
+        try:
+            int(digest, 16)
+        except ValueError:
+            return None
+        return '%s-%s' % (digest.lower(), size)
+
+    def blob_path(self, key):
+        '''Returns the path of the stored copy of the package named key'''
+        return os.path.join(self.root, key[:2], key)
+
+    def link(self, key, local_path):
+        '''Links the stored copy of the package named key to local_path.
+        Returns False if there is no stored copy.'''
+        blob_path = self.blob_path(key)
+        if not os.path.exists(blob_path):
+            return False
+        if os.path.exists(local_path) and os.path.samefile(
+                blob_path, local_path):
+            return True
+        if not os.path.isdir(os.path.dirname(local_path)):
+            os.makedirs(os.path.dirname(local_path))
+        temp_path = local_path + '.link'
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        link_or_copy(blob_path, temp_path)
+        os.rename(temp_path, local_path)
+        return True
 
+    def add(self, key, local_path, verified=False, replace=False):
+        '''Adds the package at local_path to the store under key, unless
+        its size and digest don't match, which is taken as read if it has
+        already been verified. Returns False if they don't. With replace,
+        as when the cache is ignored, a copy already stored is replaced by
+        this one rather than linked over it.'''
+        if not replace and self.link(key, local_path):
+            # already stored, from another URL or another thread
+            return True
+        digest, size = key.rsplit('-', 1)
+        if not verified and (os.path.getsize(local_path) != int(size) or
+                             file_digest(local_path) != digest):
+            return False
+        blob_path = self.blob_path(key)
+        if not os.path.isdir(os.path.dirname(blob_path)):
+            os.makedirs(os.path.dirname(blob_path))
+        if replace:
+            temp_path = blob_path + '.new'
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            link_or_copy(local_path, temp_path)
+            os.rename(temp_path, blob_path)
+            return True
+        try:
+            link_or_copy(local_path, blob_path)
+        except OSError, err:
+            if err.errno != errno.EEXIST:
+                raise
+        return True
 
-def mountdmg(dmgpath):
-    """
-    Attempts to mount the dmg at dmgpath and returns first mountpoint
-    """
-    mountpoints = []
-    dmgname = os.path.basename(dmgpath)
-    cmd = ['/usr/bin/hdiutil', 'attach', dmgpath,
-           '-mountRandom', '/tmp', '-nobrowse', '-plist',
-           '-owners', 'on']
-    proc = subprocess.Popen(cmd, bufsize=-1,
-                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    (pliststr, err) = proc.communicate()
-    if proc.returncode:
-        print >> sys.stderr, 'Error: "%s" while mounting %s.' % (err, dmgname)
+    def blobs(self):
+        '''Yields (key, path) for each package in the store'''
+        if not os.path.isdir(self.root):
+            return
+        for prefix in sorted(os.listdir(self.root)):
+            directory = os.path.join(self.root, prefix)
+            if os.path.isdir(directory):
+                for key in sorted(os.listdir(directory)):
+                    yield key, os.path.join(directory, key)
+
+
+def integrity_check(size, digest, integrity_url, root_dir,
+                    ignore_cache=False, cancel=None):
+    '''Returns an IntegrityCheck for a package with the size, digest and
+    chunklist at integrity_url the catalog gives, any of which may be None,
+    replicating the chunklist first. Returns None if there is nothing to
+    check.'''
+    chunks = None
+    if integrity_url:
+        chunklist_path = replicate_url(
+            integrity_url, root_dir=root_dir, ignore_cache=ignore_cache,
+            cancel=cancel)
+        try:
+            chunks = parse_chunklist(chunklist_path)
+        except (IOError, ValueError), err:
+            print >> sys.stderr, 'Not using chunklist: %s' % err
+        if chunks and size and sum(chunk[1] for chunk in chunks) != size:
+            print >> sys.stderr, (
+                'Not using chunklist %s: it does not cover %s bytes'
+                % (integrity_url, size))
+            chunks = None
+    if not (size or digest or chunks):
         return None
-    if pliststr:
-        plist = plistlib.readPlistFromString(pliststr)
-        for entity in plist['system-entities']:
-            if 'mount-point' in entity:
-                mountpoints.append(entity['mount-point'])
-
-    return mountpoints[0]
-
-
-def unmountdmg(mountpoint):
-    """
-    Unmounts the dmg at mountpoint
-    """
-    proc = subprocess.Popen(['/usr/bin/hdiutil', 'detach', mountpoint],
-                            bufsize=-1, stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE)
-    (dummy_output, err) = proc.communicate()
-    if proc.returncode:
-        print >> sys.stderr, 'Polite unmount failed: %s' % err
-        print >> sys.stderr, 'Attempting to force unmount %s' % mountpoint
-        # try forcing the unmount
-        retcode = subprocess.call(['/usr/bin/hdiutil', 'detach', mountpoint,
-                                   '-force'])
-        if retcode:
-            print >> sys.stderr, 'Failed to unmount %s' % mountpoint
-
+    return IntegrityCheck(size, digest, chunks)
+
+
+class TransferPool(object):
+    '''Replicates a batch of URLs with bounded concurrency. If any transfer
+    fails, the transfers still running are cancelled and the whole batch
+    fails. Given a PackageStore, packages it already holds are linked
+    instead of downloaded, and new ones are added to it; a package posted
+    under several URLs in one batch is downloaded once and linked to the
+    rest. Given a threading.Event as cancel, the batch is also cancelled
+    when something else sets it.'''
+
+    def __init__(self, root_dir, jobs=DEFAULT_JOBS, ignore_cache=False,
+                 segments=DEFAULT_SEGMENTS, store=None, cancel=None):
+        self.root_dir = root_dir
+        self.jobs = max(1, jobs)
+        self.segments = segments
+        self.ignore_cache = ignore_cache
+        self.store = store
+        self.cancel = cancel
+        self.cancelled = cancel or threading.Event()
+        self.lock = threading.Lock()
+        self.key_locks = {}
+        self.fetched = set()
+        self.failure = None
+
+    def key_lock(self, key):
+        '''Returns the lock held while the package stored as key is
+        fetched, so that other URLs for it wait and then link to it'''
+        with self.lock:
+            return self.key_locks.setdefault(key, threading.Lock())
+
+    def replicate(self, downloads):
+        '''Replicates downloads, a list of (url, size, digest,
+        integrity_url) tuples where any but the url may be None if not
+        known. Each download is checked against whichever of its size,
+        digest and chunklist are known. Returns a list of the replicated
+        paths. Raises ReplicationError if any download fails.'''
+        if self.cancel is None:
+            self.cancelled.clear()
+        self.failure = None
+        monitor = ProgressMonitor(downloads)
+        monitor.start()
+
+        def transfer(download):
+            '''Replicate one URL, or link it to a copy of the same package
+            another thread is fetching'''
+            url, size, digest, integrity_url = download
+            key = None
+            if self.store:
+                key = self.store.key(digest, size)
+            if not key:
+                return fetch(url, size, digest, integrity_url, key)
+            with self.key_lock(key):
+                return fetch(url, size, digest, integrity_url, key)
+
+        def fetch(url, size, digest, integrity_url, key):
+            '''Replicate one URL, cancelling the rest of the batch if it
+            fails for any reason, a full disk as much as a lost
+            connection'''
+            try:
+                return fetch_package(url, size, digest, integrity_url, key)
+            except Exception, err:
+                monitor.transfer_failed(url, err)
+                with self.lock:
+                    if self.failure is None:
+                        self.failure = ReplicationError(
+                            'Could not replicate %s: %s' % (url, err))
+                        self.cancelled.set()
+                if isinstance(err, ReplicationError):
+                    raise
+                raise ReplicationError(err)
+
+        def fetch_package(url, size, digest, integrity_url, key):
+            '''Replicate one URL, or link it to a stored copy'''
+            if self.cancelled.is_set():
+                raise ReplicationError('Transfer of %s cancelled' % url)
+            local_path = local_path_for_url(url, self.root_dir)
+            # even with ignore_cache, a package fetched earlier in this
+            # batch is fresh enough
+            if (key and (key in self.fetched or not self.ignore_cache) and
+                    self.store.link(key, local_path)):
+                sys.stdout.write('Using stored copy of %s\n' % url)
+                CACHE_INDEX.used(local_path)
+                PHASES.count('hits')
+                monitor.transfer_progress(url, size)
+                monitor.transfer_done(url, cache_hit=True)
+                return local_path
+            monitor.transfer_started(url)
+            ignore_cache = self.ignore_cache
+            for attempt in range(2):
+                check = integrity_check(
+                    size, digest, integrity_url, self.root_dir,
+                    ignore_cache=ignore_cache, cancel=self.cancelled)
+                local_path = replicate_url(
+                    url, root_dir=self.root_dir, ignore_cache=ignore_cache,
+                    cancel=self.cancelled, size=size,
+                    segments=self.segments,
+                    progress=lambda count: monitor.transfer_progress(
+                        url, count),
+                    check=check)
+                # a download is checked as it arrives, but a copy that was
+                # already current is not, so check it now
+                if (check is None or check.passed or (
+                        not check.damaged_ranges(local_path, self.segments)
+                        and check.matches(local_path))):
+                    break
+                if attempt:
+                    raise ReplicationError(
+                        '%s does not match the size and digest in the '
+                        'catalog' % url)
+                print >> sys.stderr, (
+                    'The copy of %s already here is damaged, downloading '
+                    'it again...' % url)
+                ignore_cache = True
+            if key:
+                # a key means a digest, which the copy has just matched
+                self.store.add(key, local_path, verified=True,
+                               replace=ignore_cache)
+                self.fetched.add(key)
+            monitor.transfer_done(url)
+            return local_path
 
-def install_product(dist_path, target_vol):
-    '''Install a product to a target volume.
-    Returns a boolean to indicate success or failure.'''
-    cmd = ['/usr/sbin/installer', '-pkg', dist_path, '-target', target_vol]
+        try:
+            return concurrent_map(transfer, downloads, self.jobs)
+        except ReplicationError:
+            # report the transfer that failed, not one it cancelled
+            raise self.failure
+        finally:
+            monitor.stop()
+
+
+def file_stamp(path):
+    '''Returns a (size, mtime) tuple that changes whenever the file at path
+    is replaced'''
+    info = os.stat(path)
+    return (info.st_size, info.st_mtime)
+
+
+class ParseCache(object):
+    '''Remembers the results of parsing files in the workdir, in a pickle
+    beside them, so that later runs can skip parsing any file whose size
+    and modification time are unchanged. A path of None keeps the cache in
+    memory only; with refresh, earlier results are ignored but new ones
+    are still saved.'''
+
+    def __init__(self, path=None, refresh=False):
+        self.path = path
+        self.lock = threading.Lock()
+        self.changed = False
+        self.entries = {}
+        if path and not refresh:
+            try:
+                with open(path, 'rb') as fileobj:
+                    self.entries = cPickle.load(fileobj)
+            except (IOError, OSError, EOFError, ValueError, TypeError,
+                    AttributeError, ImportError, cPickle.UnpicklingError):
+                pass
+
+    def get(self, key, stamp=None):
+        '''Returns a copy of the value stored for key with the same stamp,
+        or None if there isn't one or any file it came from has changed'''
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None or entry[0] != stamp:
+            PHASES.count('parse_misses')
+            return None
+        for path, path_stamp in entry[1].items():
+            try:
+                if file_stamp(path) != path_stamp:
+                    PHASES.count('parse_misses')
+                    return None
+            except OSError:
+                PHASES.count('parse_misses')
+                return None
+        for path in entry[1]:
+            CACHE_INDEX.used(path)
+        PHASES.count('parse_hits')
+        return copy.deepcopy(entry[2])
+
+    def put(self, key, value, paths, stamp=None):
+        '''Store value for key, as depending on the files at paths'''
+        try:
+            stamps = dict((path, file_stamp(path)) for path in paths)
+        except (OSError, TypeError):
+            return
+        with self.lock:
+            self.entries[key] = (stamp, stamps, copy.deepcopy(value))
+            self.changed = True
+
+    def parse(self, key, path, parser):
+        '''Returns parser(path), without calling it if path is unchanged
+        since it was last parsed for key'''
+        result = self.get((key, path))
+        if result is None:
+            result = parser(path)
+            self.put((key, path), result, [path])
+        return result
+
+    def save(self):
+        '''Write the cache back to disk, dropping entries for files that no
+        longer exist'''
+        with self.lock:
+            if not self.path or not self.changed:
+                return
+            self.entries = dict(
+                (key, entry) for key, entry in self.entries.items()
+                if all(os.path.exists(path) for path in entry[1]))
+            try:
+                with open(self.path + '.new', 'wb') as fileobj:
+                    cPickle.dump(self.entries, fileobj,
+                                 cPickle.HIGHEST_PROTOCOL)
+                os.rename(self.path + '.new', self.path)
+            except (IOError, OSError), err:
+                print >> sys.stderr, 'Could not save %s: %s' % (self.path, err)
+            self.changed = False
+
+
+class CacheIndex(object):
+    '''Records when each file replicated into a workdir was last used, in
+    a pickle in the workdir, so the least recently used files can be
+    evicted to keep the workdir within a size limit. Only the package
+    store and the top-level directories of files that have been recorded
+    are managed; files at the top of the workdir, such as disk images and
+    the caches themselves, never are.'''
+
+    def __init__(self):
+        self.root = None
+        self.path = None
+        self.lock = threading.Lock()
+        self.changed = False
+        self.entries = {}
+
+    def open(self, root):
+        '''Start recording use of files in the workdir at root'''
+        with self.lock:
+            self.root = root
+            self.path = os.path.join(root, CACHE_INDEX_NAME)
+            self.entries = {}
+            try:
+                with open(self.path, 'rb') as fileobj:
+                    self.entries = cPickle.load(fileobj)
+            except (IOError, OSError, EOFError, ValueError, TypeError,
+                    AttributeError, ImportError, cPickle.UnpicklingError):
+                pass
+
+    def relative_path(self, path):
+        '''Returns path relative to the workdir, or None if it isn't in one
+        of the directories the index manages'''
+        if self.root is None or path is None:
+            return None
+        relative_path = os.path.relpath(path, self.root)
+        if (relative_path.startswith(os.pardir) or
+                os.sep not in relative_path):
+            return None
+        return relative_path
+
+    def used(self, path):
+        '''Record that the file at path was used just now'''
+        relative_path = self.relative_path(path)
+        if relative_path is not None:
+            with self.lock:
+                self.entries[relative_path] = time.time()
+                self.changed = True
+
+    def files(self):
+        '''Returns a list of [last_used, size, paths] for each managed file,
+        least recently used first. Hard links to the same file, such as a
+        stored package and the links to it, are a single entry. The size is
+        the space allocated on disk, which is less than the length of a
+        partially downloaded file. Files used before the index was kept
+        count as last used when they were modified.'''
+        with self.lock:
+            entries = dict(self.entries)
+        top_dirs = set([STORE_DIR_NAME])
+        top_dirs.update(path.split(os.sep, 1)[0] for path in entries)
+        files = {}
+        for top_dir in sorted(top_dirs):
+            for dirpath, _, filenames in os.walk(
+                    os.path.join(self.root, top_dir)):
+                for filename in filenames:
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        info = os.lstat(path)
+                    except OSError:
+                        continue
+                    if not stat.S_ISREG(info.st_mode):
+                        continue
+                    last_used = entries.get(
+                        os.path.relpath(path, self.root), info.st_mtime)
+                    entry = files.setdefault(
+                        (info.st_dev, info.st_ino),
+                        [last_used, info.st_blocks * 512, []])
+                    entry[0] = max(entry[0], last_used)
+                    entry[2].append(path)
+        return sorted(files.values())
+
+    def trim(self, limit, pinned=()):
+        '''Removes the least recently used files until the managed files
+        take up no more than limit bytes, never removing the files at
+        pinned paths or any links to them. Returns the number of files and
+        bytes removed.'''
+        pinned_files = set()
+        for path in pinned:
+            try:
+                info = os.stat(path)
+            except (OSError, TypeError):
+                continue
+            pinned_files.add((info.st_dev, info.st_ino))
+        files = self.files()
+        excess = sum(size for _, size, _ in files) - limit
+        removed = freed = 0
+        for _, size, paths in files:
+            if excess <= 0:
+                break
+            info = os.lstat(paths[0])
+            if (info.st_dev, info.st_ino) in pinned_files:
+                continue
+            for path in paths:
+                os.unlink(path)
+                with self.lock:
+                    self.entries.pop(os.path.relpath(path, self.root), None)
+                    self.changed = True
+            removed += 1
+            freed += size
+            excess -= size
+        return removed, freed
+
+    def save(self):
+        '''Write the index back to disk, dropping files that no longer
+        exist'''
+        with self.lock:
+            if not self.path or not self.changed:
+                return
+            self.entries = dict(
+                (path, last_used) for path, last_used in self.entries.items()
+                if os.path.exists(os.path.join(self.root, path)))
+            try:
+                with open(self.path + '.new', 'wb') as fileobj:
+                    cPickle.dump(self.entries, fileobj,
+                                 cPickle.HIGHEST_PROTOCOL)
+                os.rename(self.path + '.new', self.path)
+            except (IOError, OSError), err:
+                print >> sys.stderr, 'Could not save %s: %s' % (self.path, err)
+            self.changed = False
+
+
+CACHE_INDEX = CacheIndex()
+
+
+def parse_size(text):
+    '''Returns the number of bytes in a size such as 500M or 20G, for use
+    as an argparse type'''
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    text = text.strip().upper()
+    if text.endswith('B'):
+        text = text[:-1]
+    multiplier = 1
+    if text and text[-1] in units:
+        multiplier = units[text[-1]]
+        text = text[:-1]
     try:
-        subprocess.check_call(cmd)
-        return True
-    except subprocess.CalledProcessError, err:
-        print >> sys.stderr, err
-        return False
+        size = int(float(text) * multiplier)
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid size: %r' % text)
+    if size < 0:
+        raise argparse.ArgumentTypeError('size must not be negative')
+    return size
 
 
-class ReplicationError(Exception):
-    '''A custom error when replication fails'''
-    pass
-
+def parse_host_rate(text):
+    '''Returns a (host, rate) tuple from a limit such as 2M or
+    swcdn.apple.com=2M, for use as an argparse type'''
+    host, _, rate = text.rpartition('=')
+    return host.strip().lower() or None, parse_size(rate)
 
-def replicate_url(full_url, root_dir='/tmp',
-                  show_progress=False, ignore_cache=False):
-    '''Downloads a URL and stores it in the same relative path on our
-    filesystem. Returns a path to the replicated file.'''
 
-    path = urlparse.urlsplit(full_url)[2]
-    relative_url = path.lstrip('/')
-    relative_url = os.path.normpath(relative_url)
-    local_file_path = os.path.join(root_dir, relative_url)
-    if show_progress:
-        options = '-fL'
-    else:
-        options = '-sfL'
-    curl_cmd = ['/usr/bin/curl', options, '--create-dirs',
-                '-o', local_file_path]
-    if not ignore_cache and os.path.exists(local_file_path):
-        curl_cmd.extend(['-z', local_file_path])
-    curl_cmd.append(full_url)
-    print "Downloading %s..." % full_url
+def parse_rate_schedule(text):
+    '''Returns a (start, end, rate) tuple, with times in minutes after
+    midnight, from a window such as 08:00-18:00=2M, for use as an argparse
+    type'''
     try:
-        subprocess.check_call(curl_cmd)
-    except subprocess.CalledProcessError, err:
-        raise ReplicationError(err)
-    return local_file_path
+        window, rate = text.split('=', 1)
+        times = []
+        for clock in window.split('-'):
+            hours, minutes = clock.strip().split(':')
+            if not (0 <= int(hours) <= 24 and 0 <= int(minutes) < 60):
+                raise ValueError
+            times.append(int(hours) * 60 + int(minutes))
+        start, end = times
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'invalid schedule %r: expected HH:MM-HH:MM=RATE' % text)
+    return start, end, parse_size(rate)
+
+
+def trim_cache(limit, pinned=()):
+    '''Evicts the least recently used files from the workdir until it fits
+    within limit bytes, if there is a limit, keeping the files at pinned
+    paths. Saves the cache index either way.'''
+    if limit is not None:
+        removed, freed = CACHE_INDEX.trim(limit, pinned)
+        if removed:
+            print 'Evicted %s least recently used files, freeing %s.' % (
+                removed, human_size(freed))
+    CACHE_INDEX.save()
+
+
+def print_cache_report(limit=None):
+    '''Prints a summary of what the workdir's cache holds'''
+    files = CACHE_INDEX.files()
+    total = sum(size for _, size, _ in files)
+    store_path = os.path.join(CACHE_INDEX.root, STORE_DIR_NAME) + os.sep
+    stored = [(size, paths) for _, size, paths in files
+              if any(path.startswith(store_path) for path in paths)]
+    print 'Cache in %s: %s files, %s' % (
+        CACHE_INDEX.root, len(files), human_size(total))
+    print 'Package store: %s packages, %s, %s other links to them' % (
+        len(stored), human_size(sum(size for size, _ in stored)),
+        sum(len(paths) - 1 for _, paths in stored))
+    if limit is None:
+        print 'No size limit set.'
+    elif total > limit:
+        print 'Limit: %s, %s over' % (human_size(limit),
+                                      human_size(total - limit))
+    else:
+        print 'Limit: %s, %s free' % (human_size(limit),
+                                      human_size(limit - total))
+    if files:
+        print 'Least recently used:'
+    for last_used, size, paths in files[:CACHE_REPORT_FILES]:
+        print '  %s %10s  %s' % (
+            time.strftime('%Y-%m-%d %H:%M', time.localtime(last_used)),
+            human_size(size), os.path.relpath(sorted(paths)[-1],
+                                              CACHE_INDEX.root))
 
 
 def parse_server_metadata(filename):
@@ -675,62 +2068,216 @@ def get_server_metadata(catalog, product_key, workdir, ignore_cache=False):
         return None
 
 
+class AuxinfoParser(object):
+    '''Streams a dist file through expat, collecting the key/string pairs
+    from its first auxinfo element, or from the first dict element within
+    it if there is one. Parsing stops as soon as auxinfo closes, and the
+    text and end-of-element handlers are only installed once it opens.'''
+
+    class Done(Exception):
+        '''Raised to stop parsing once auxinfo has closed'''
+        pass
+
+    def __init__(self):
+        self.parser = expat.ParserCreate()
+        self.parser.buffer_text = True
+        self.parser.StartElementHandler = self.find_auxinfo
+        self.depth = 0
+        self.dict_depth = None
+        self.in_dict = False
+        self.direct = {'key': None, 'value': None, 'info': {}}
+        self.nested = {'key': None, 'value': None, 'info': {}}
+        # the key or string element being read, and its text so far
+        self.element = None
+        self.text = []
+
+    def parse(self, fileobj):
+        '''Parse fileobj up to the end of its auxinfo element'''
+        try:
+            for block in iter(lambda: fileobj.read(64 * 1024), ''):
+                self.parser.Parse(block, False)
+            self.parser.Parse('', True)
+        except self.Done:
+            pass
+
+    def find_auxinfo(self, name, dummy_attrs):
+        '''Skip elements until auxinfo opens'''
+        if name == 'auxinfo':
+            self.parser.StartElementHandler = self.start_element
+            self.parser.EndElementHandler = self.end_element
+
+    def start_element(self, name, dummy_attrs):
+        '''Note where the dict starts and which key and string elements
+        to read'''
+        self.depth += 1
+        # only text before any child element counts, as with minidom's
+        # firstChild.wholeText
+        self.parser.CharacterDataHandler = None
+        if self.depth == 1:
+            container = self.direct
+            if name == 'dict' and self.dict_depth is None:
+                self.dict_depth = self.depth
+                self.in_dict = True
+        elif self.in_dict and self.depth == self.dict_depth + 1:
+            container = self.nested
+        else:
+            return
+        if name in ('key', 'string'):
+            self.element = (name, self.depth, container)
+            self.text = []
+            self.parser.CharacterDataHandler = self.text.append
+
+    def end_element(self, dummy_name):
+        '''Pair up keys and strings as their elements close'''
+        self.parser.CharacterDataHandler = None
+        if self.depth == 0:
+            raise self.Done
+        if self.element and self.element[1] == self.depth:
+            tag, _, container = self.element
+            if tag == 'key':
+                container['key'] = ''.join(self.text)
+            else:
+                container['value'] = ''.join(self.text)
+            if container['key'] and container['value']:
+                container['info'][container['key']] = container['value']
+                container['key'] = container['value'] = None
+            self.element = None
+        if self.in_dict and self.depth == self.dict_depth:
+            self.in_dict = False
+        self.depth -= 1
+
+    def info(self):
+        '''Returns the pairs found, from the dict within auxinfo if there
+        was one'''
+        if self.dict_depth is not None:
+            return self.nested['info']
+        return self.direct['info']
+
+
 def parse_dist(filename):
     '''Parses a softwareupdate dist file, returning a dict of info of
-    interest'''
-    dist_info = {}
+    interest. The file is only read as far as the end of its auxinfo
+    element.'''
+    auxinfo = AuxinfoParser()
     try:
-        dom = minidom.parse(filename)
+        with open(filename, 'rb') as fileobj:
+            auxinfo.parse(fileobj)
     except ExpatError:
         print >> sys.stderr, 'Invalid XML in %s' % filename
-        return dist_info
-    except IOError, err:
+        return {}
+    except (IOError, TypeError), err:
         print >> sys.stderr, 'Error reading %s: %s' % (filename, err)
-        return dist_info
-
-    auxinfos = dom.getElementsByTagName('auxinfo')
-    if not auxinfos:
-        return dist_info
-    auxinfo = auxinfos[0]
-    key = None
-    value = None
-    children = auxinfo.childNodes
-    # handle the possibility that keys from auxinfo may be nested
-    # within a 'dict' element
-    dict_nodes = [n for n in auxinfo.childNodes
-                  if n.nodeType == n.ELEMENT_NODE and
-                  n.tagName == 'dict']
-    if dict_nodes:
-        children = dict_nodes[0].childNodes
-    for node in children:
-        if node.nodeType == node.ELEMENT_NODE and node.tagName == 'key':
-            key = node.firstChild.wholeText
-        if node.nodeType == node.ELEMENT_NODE and node.tagName == 'string':
-            value = node.firstChild.wholeText
-        if key and value:
-            dist_info[key] = value
-            key = None
-            value = None
-    return dist_info
-
-
-def download_and_parse_sucatalog(sucatalog, workdir, ignore_cache=False):
-    '''Downloads and returns a parsed softwareupdate catalog'''
+        return {}
+    return auxinfo.info()
+
+
+def plist_value(element):
+    '''Returns the Python equivalent of a parsed plist element, the same
+    value plistlib would produce'''
+    tag = element.tag
+    if tag == 'dict':
+        value = {}
+        key = None
+        for child in element:
+            if child.tag == 'key':
+                key = child.text or ''
+            else:
+                value[key] = plist_value(child)
+        return value
+    if tag == 'array':
+        return [plist_value(child) for child in element]
+    if tag == 'string':
+        return element.text or ''
+    if tag == 'integer':
+        return int(element.text)
+    if tag == 'real':
+        return float(element.text)
+    if tag == 'true':
+        return True
+    if tag == 'false':
+        return False
+    if tag == 'date':
+        return datetime.datetime.strptime(element.text, '%Y-%m-%dT%H:%M:%SZ')
+    if tag == 'data':
+        return plistlib.Data.fromBase64(element.text or '')
+    raise ValueError('Unknown plist element <%s>' % tag)
+
+
+def parse_sucatalog(path, product_filter=None):
+    '''Parses the softwareupdate catalog at path one product at a time,
+    keeping only the products for which product_filter returns True (or
+    all of them if it is None) and discarding the rest as it goes.
+    Returns the catalog as a dict, like plistlib.readPlist.'''
+    catalog = {}
+    products = {}
+    # the elements currently open; the catalog's top level dict is
+    # stack[1], its values stack[2] and each product stack[3]
+    stack = []
+    top_level_key = product_key = None
+    for event, element in ElementTree.iterparse(path, ('start', 'end')):
+        if event == 'start':
+            stack.append(element)
+            continue
+        stack.pop()
+        depth = len(stack)
+        if depth == 2:
+            if element.tag == 'key':
+                top_level_key = element.text
+            elif top_level_key == 'Products':
+                catalog['Products'] = products
+            else:
+                catalog[top_level_key] = plist_value(element)
+            element.clear()
+        elif depth == 3 and top_level_key == 'Products':
+            if element.tag == 'key':
+                product_key = element.text
+            else:
+                product = plist_value(element)
+                if product_filter is None or product_filter(product):
+                    products[product_key] = product
+            stack[-1].remove(element)
+    return catalog
+
+
+def download_and_parse_sucatalog(sucatalog, workdir, ignore_cache=False,
+                                 product_filter=None, filter_key=None,
+                                 cache=None):
+    '''Downloads and returns a parsed softwareupdate catalog, keeping only
+    the products for which product_filter returns True if it is given.
+    If cache is a ParseCache, an unchanged catalog is not parsed again. A
+    catalog filtered by product_filter is only cached if filter_key, a
+    name for what the filter keeps, is given too, since two filters can't
+    otherwise be told apart.'''
     try:
-        localcatalogpath = replicate_url(
-            sucatalog, root_dir=workdir, ignore_cache=ignore_cache)
+        with PHASES.phase('catalog fetch'):
+            localcatalogpath = replicate_url(
+                sucatalog, root_dir=workdir, ignore_cache=ignore_cache)
     except ReplicationError, err:
         print >> sys.stderr, 'Could not replicate %s: %s' % (sucatalog, err)
         exit(-1)
+    if cache is None or (product_filter is not None and filter_key is None):
+        cache = ParseCache()
     try:
-        catalog = plistlib.readPlist(localcatalogpath)
-        return catalog
-    except (OSError, IOError, ExpatError), err:
+        with PHASES.phase('catalog parse'):
+            return cache.parse(
+                ('catalog', filter_key), localcatalogpath,
+                lambda path: parse_sucatalog(path, product_filter))
+    except (OSError, IOError, SyntaxError, ValueError), err:
         print >> sys.stderr, (
             'Error reading %s: %s' % (localcatalogpath, err))
         exit(-1)
 
 
+def is_mac_os_installer(product):
+    '''Returns True if a catalog product appears to be a macOS installer'''
+    try:
+        return product['ExtendedMetaInfo'][
+            'InstallAssistantPackageIdentifiers'][
+                'OSInstall'] == 'com.apple.mpkg.OSInstall'
+    except (KeyError, TypeError):
+        return False
+
+
 def find_mac_os_installers(catalog):
     '''Return a list of product identifiers for what appear to be macOS
     installers'''
@@ -738,109 +2285,1008 @@ def find_mac_os_installers(catalog):
     if 'Products' in catalog:
         product_keys = list(catalog['Products'].keys())
         for product_key in product_keys:
-            product = catalog['Products'][product_key]
-            try:
-                if product['ExtendedMetaInfo'][
-                        'InstallAssistantPackageIdentifiers'][
-                            'OSInstall'] == 'com.apple.mpkg.OSInstall':
-                    mac_os_installer_products.append(product_key)
-            except KeyError:
-                continue
+            if is_mac_os_installer(catalog['Products'][product_key]):
+                mac_os_installer_products.append(product_key)
     return mac_os_installer_products
 
 
-def os_installer_product_info(catalog, workdir, ignore_cache=False):
-    '''Returns a dict of info about products that look like macOS installers'''
-    product_info = {}
+def dist_language(product):
+    '''Returns the key of the distribution file used for product, English
+    or en, or None if it has neither'''
+    distributions = product.get('Distributions', {})
+    for language in ('English', 'en'):
+        if distributions.get(language):
+            return language
+    return None
+
+
+def product_files(product, workdir, packages=True):
+    '''Returns the paths in workdir of the files replicated for product:
+    its ServerMetadata and English distribution file and, with packages,
+    each package with its metadata and chunklist'''
+    urls = [product.get('ServerMetadataURL'),
+            product.get('Distributions', {}).get(dist_language(product))]
+    if packages:
+        for package in product.get('Packages', []):
+            urls.extend([package.get('URL'), package.get('MetadataURL'),
+                         package.get('IntegrityDataURL')])
+    return [local_path_for_url(url, workdir) for url in urls if url]
+
+
+def get_product_info(catalog, product_key, workdir, ignore_cache=False,
+                     cache=None):
+    '''Replicates and parses the ServerMetadata and English distribution
+    file for one product. Returns a dict of info about the product.
+    If cache is a ParseCache and the product's catalog entry and files are
+    unchanged since they were last parsed, nothing is fetched at all.'''
+    product = catalog['Products'][product_key]
+    dist_url = product['Distributions'].get(dist_language(product))
+    # the ServerMetadata and dist URLs of a posted product don't change
+    stamp = (str(product['PostDate']), product.get('ServerMetadataURL'),
+             dist_url)
+    if cache is None:
+        cache = ParseCache()
+    info = cache.get(('product', product_key), stamp)
+    if info is not None:
+        return info
+
+    filename = get_server_metadata(
+        catalog, product_key, workdir, ignore_cache=ignore_cache)
+    info = cache.parse('metadata', filename, parse_server_metadata)
+    info['PostDate'] = str(product['PostDate'])
+    try:
+        dist_path = replicate_url(
+            dist_url, root_dir=workdir, ignore_cache=ignore_cache)
+    except ReplicationError, err:
+        print >> sys.stderr, 'Could not replicate %s: %s' % (dist_url, err)
+    dist_info = cache.parse('dist', dist_path, parse_dist)
+    info['DistributionPath'] = dist_path
+    info.update(dist_info)
+    cache.put(('product', product_key), info, [filename, dist_path],
+              stamp=stamp)
+    return info
+
+
+@phase('metadata')
+def os_installer_product_info(catalog, workdir, ignore_cache=False,
+                              jobs=METADATA_JOBS, cache=None,
+                              product_keys=None):
+    '''Returns a dict of info about products that look like macOS installers,
+    or just those in product_keys if given. Up to jobs products are fetched
+    and parsed at the same time, skipping any whose info is still current
+    in cache, if given.'''
     installer_products = find_mac_os_installers(catalog)
-    for product_key in installer_products:
-        product_info[product_key] = {}
-        filename = get_server_metadata(catalog, product_key, workdir)
-        product_info[product_key] = parse_server_metadata(filename)
-        product = catalog['Products'][product_key]
-        product_info[product_key]['PostDate'] = str(product['PostDate'])
-        distributions = product['Distributions']
-        dist_url = distributions.get('English') or distributions.get('en')
-        try:
-            dist_path = replicate_url(
-                dist_url, root_dir=workdir, ignore_cache=ignore_cache)
-        except ReplicationError, err:
-            print >> sys.stderr, 'Could not replicate %s: %s' % (dist_url, err)
-        dist_info = parse_dist(dist_path)
-        product_info[product_key]['DistributionPath'] = dist_path
-        product_info[product_key].update(dist_info)
+    if product_keys is not None:
+        installer_products = [product_key
+                              for product_key in installer_products
+                              if product_key in product_keys]
+
+    def product_info_for(product_key):
+        '''Get the info for one product, emitting it as soon as it's
+        known'''
+        info = get_product_info(catalog, product_key, workdir,
+                                ignore_cache=ignore_cache, cache=cache)
+        EVENTS.emit('product', product_id=product_key,
+                    version=info.get('version'), build=info.get('BUILD'),
+                    title=info.get('title'), post_date=info.get('PostDate'))
+        return info
+
+    results = concurrent_map(product_info_for, installer_products, jobs)
+    return dict(zip(installer_products, results))
+
+
+def load_list_state(path):
+    '''Returns the products listed by the last incremental listing of each
+    catalog, as saved by save_list_state'''
+    try:
+        return plistlib.readPlist(path)
+    except (IOError, OSError, ExpatError):
+        return {}
 
-    return product_info
 
+def save_list_state(path, state):
+    '''Saves the products listed by an incremental listing'''
+    try:
+        plistlib.writePlist(state, path + '.new')
+        os.rename(path + '.new', path)
+    except (IOError, OSError), err:
+        print >> sys.stderr, 'Could not save %s: %s' % (path, err)
+
+
+def list_changes(catalog, previous, workdir, ignore_cache=False, cache=None):
+    '''Compares the installer products in catalog with previous, the dict
+    the last call returned for the same catalog, and prints those added,
+    changed (by PostDate) or removed since. Metadata and dist files are
+    only fetched for products added or changed. Returns a list of dicts
+    for the plist, and the dict to pass as previous next time.'''
+    installers = find_mac_os_installers(catalog)
+    changes = {}
+    for product_key in installers:
+        post_date = catalog['Products'][product_key].get('PostDate')
+        if product_key not in previous:
+            changes[product_key] = 'added'
+        elif previous[product_key].get('PostDate') != post_date:
+            changes[product_key] = 'changed'
+    product_info = os_installer_product_info(
+        catalog, workdir, ignore_cache=ignore_cache, cache=cache,
+        product_keys=changes)
+    current = {}
+    for product_key in installers:
+        if product_key in product_info:
+            info = product_info[product_key]
+            current[product_key] = {
+                'version': info['version'], 'build': info['BUILD'],
+                'title': info['title']}
+        else:
+            current[product_key] = dict(previous[product_key])
+        current[product_key]['PostDate'] = (
+            catalog['Products'][product_key].get('PostDate'))
+    for product_key in previous:
+        if product_key not in current:
+            changes[product_key] = 'removed'
+
+    result = []
+    markers = {'added': '+', 'changed': '~', 'removed': '-'}
+    if changes:
+        print '%2s %12s %10s %8s  %s' % ('', 'ProductID', 'Version',
+                                         'Build', 'Title')
+    else:
+        print 'No changes since the last listing.'
+    for product_key in installers + sorted(
+            key for key in previous if key not in current):
+        if product_key not in changes:
+            continue
+        info = current.get(product_key) or previous[product_key]
+        print '%2s %12s %10s %8s  %s' % (
+            markers[changes[product_key]], product_key, info['version'],
+            info['build'], info['title'])
+        result.append({'index': len(result) + 1,
+                       'product_id': product_key,
+                       'version': info['version'],
+                       'build': info['build'],
+                       'title': info['title'],
+                       'change': changes[product_key]})
+        EVENTS.emit('change', **result[-1])
+    return result, current
+
+
+@phase('download')
+def replicate_products(catalog, product_ids, workdir, ignore_cache=False,
+                       jobs=DEFAULT_JOBS, segments=DEFAULT_SEGMENTS,
+                       cancel=None):
+    '''Downloads all the packages for several products through one
+    TransferPool, using up to jobs concurrent transfers and splitting large
+    packages into up to segments byte ranges. A package several of the
+    products share is only fetched once. Packages the catalog gives a
+    digest for are kept in the workdir's PackageStore. Setting cancel, a
+    threading.Event, abandons the downloads. Returns a dict of the paths
+    of the replicated files of each product. Raises ReplicationError if
+    any of them could not be replicated.'''
+    downloads = []
+    indexes = {}
+    positions = {}
+    for product_id in product_ids:
+        product = catalog['Products'][product_id]
+        wanted = []
+        for package in product.get('Packages', []):
+            if 'URL' in package:
+                wanted.append((package['URL'], package.get('Size'),
+                               package.get('Digest'),
+                               package.get('IntegrityDataURL')))
+            if 'MetadataURL' in package:
+                wanted.append((package['MetadataURL'], None, None, None))
+        positions[product_id] = []
+        for download in wanted:
+            if download[0] not in indexes:
+                indexes[download[0]] = len(downloads)
+                downloads.append(download)
+            positions[product_id].append(indexes[download[0]])
+    pool = TransferPool(workdir, jobs=jobs, ignore_cache=ignore_cache,
+                        segments=segments, cancel=cancel,
+                        store=PackageStore(
+                            os.path.join(workdir, STORE_DIR_NAME)))
+    paths = pool.replicate(downloads)
+    return dict((product_id, [paths[index] for index in positions[product_id]])
+                for product_id in product_ids)
+
+
+def replicate_product(catalog, product_id, workdir, ignore_cache=False,
+                      jobs=DEFAULT_JOBS, segments=DEFAULT_SEGMENTS):
+    '''Downloads all the packages for a product; see replicate_products.
+    Returns the paths of the replicated files.'''
+    return replicate_products(
+        catalog, [product_id], workdir, ignore_cache=ignore_cache,
+        jobs=jobs, segments=segments)[product_id]
+
+
+def bytes_to_fetch(package, workdir, store):
+    '''Returns how many bytes of package are still to be downloaded into
+    the workdir, going by the Size the catalog gives for it, the copy
+    already there, the package store and any partial download.'''
+    size = package.get('Size') or 0
+    path = local_path_for_url(package['URL'], workdir)
+    if os.path.isfile(path) and (not size or os.path.getsize(path) == size):
+        return 0
+    key = store.key(package.get('Digest'), size)
+    if key and os.path.exists(store.blob_path(key)):
+        return 0
+    journal = ResumeJournal.load(path + '.journal')
+    if (journal and journal.size == size and
+            os.path.exists(path + '.download')):
+        return size - journal.completed_bytes()
+    return size
+
+
+def plan_products(catalog, product_ids, workdir, compress=False,
+                  install=True):
+    '''Works out the disk space needed to download and install several
+    products, going by the sizes the catalog gives for their packages, or
+    just to download them if install is False. A package the products
+    share is only counted once. Returns a dict of the byte budget, with the
+    budget of each product under 'products'; 'fits' is False if the
+    workdir's filesystem is too small for it all.'''
+    store = PackageStore(os.path.join(workdir, STORE_DIR_NAME))
+    seen = set()
+    products = {}
+    for product_id in product_ids:
+        packages = {}
+        for package in catalog['Products'][product_id].get('Packages', []):
+            if 'URL' in package:
+                packages[package['URL']] = package
+        package_bytes = sum(package.get('Size') or 0
+                            for package in packages.values())
+        fetch = []
+        shared = 0
+        for url, package in packages.items():
+            key = store.key(package.get('Digest'), package.get('Size'))
+            if url in seen or (key and key in seen):
+                # counted with an earlier product
+                shared += 1
+            else:
+                fetch.append(bytes_to_fetch(package, workdir, store))
+            seen.update(filter(None, [url, key]))
+        products[product_id] = {
+            'packages': len(packages),
+            'package_bytes': package_bytes,
+            'shared': shared,
+            'cached': fetch.count(0),
+            'fetch': len(fetch) - fetch.count(0),
+            'fetch_bytes': sum(fetch),
+            'image_size': max(MIN_IMAGE_SIZE,
+                              -(-int(package_bytes * IMAGE_SIZE_FACTOR) //
+                                1024 ** 3) * 1024 ** 3),
+        }
+    # each sparse image only grows as far as the installed app, which is
+    # about the size of its packages; a compressed copy of the app needs
+    # as much again while both exist, and the sparse image is then deleted
+    sizes = [product['package_bytes'] for product in products.values()]
+    image_bytes = 0
+    if install:
+        image_bytes = sum(sizes)
+        if compress:
+            image_bytes += max(sizes or [0])
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    info = os.statvfs(workdir)
+    plan = {
+        'products': products,
+        'image_bytes': image_bytes,
+        'margin': SPACE_MARGIN,
+        'free': info.f_bavail * info.f_frsize,
+    }
+    for total in ('packages', 'package_bytes', 'shared', 'cached', 'fetch',
+                  'fetch_bytes'):
+        plan[total] = sum(product[total] for product in products.values())
+    plan['needed'] = plan['fetch_bytes'] + image_bytes + SPACE_MARGIN
+    plan['fits'] = plan['needed'] <= plan['free']
+    return plan
+
+
+def print_plan(plan, workdir):
+    '''Prints the byte budget worked out by plan_products'''
+    print 'Packages:          %s files, %s' % (
+        plan['packages'], human_size(plan['package_bytes']))
+    if plan['shared']:
+        print 'Shared:            %s files' % plan['shared']
+    print 'Already here:      %s files' % plan['cached']
+    print 'To download:       %s files, %s' % (
+        plan['fetch'], human_size(plan['fetch_bytes']))
+    for product_id in sorted(plan['products']):
+        print 'Sparse image size: %s%s' % (
+            human_size(plan['products'][product_id]['image_size']),
+            len(plan['products']) > 1 and ' for %s' % product_id or '')
+    print 'Space for images:  %s' % human_size(plan['image_bytes'])
+    print 'Margin:            %s' % human_size(plan['margin'])
+    print 'Needed:            %s' % human_size(plan['needed'])
+    print 'Free in %s: %s' % (workdir, human_size(plan['free']))
+    if plan['fits']:
+        print 'There is enough free space.'
+    else:
+        print 'Not enough free space: %s short.' % human_size(
+            plan['needed'] - plan['free'])
+
+
+def replicated_files(workdir):
+    '''Yields the path of each file in the workdir outside the package
+    store'''
+    for dirpath, dirnames, filenames in os.walk(workdir):
+        if dirpath == workdir and STORE_DIR_NAME in dirnames:
+            dirnames.remove(STORE_DIR_NAME)
+        for filename in filenames:
+            yield os.path.join(dirpath, filename)
+
+
+def workdir_catalogs(workdir, cache):
+    '''Returns the macOS installer products of each catalog replicated into
+    the workdir, as parsed catalogs. Raises ValueError if one can't be
+    read.'''
+    catalogs = []
+    for path in replicated_files(workdir):
+        if not path.endswith('.sucatalog'):
+            continue
+        try:
+            catalogs.append(cache.parse(
+                ('catalog', INSTALLERS_FILTER_KEY), path,
+                lambda path: parse_sucatalog(path, is_mac_os_installer)))
+        except (OSError, IOError, SyntaxError, ValueError), err:
+            raise ValueError('Error reading %s: %s' % (path, err))
+    return catalogs
+
+
+def verify_workdir(workdir, jobs=VERIFY_JOBS, cache=None):
+    '''Checks each package in the workdir against the size, digest and
+    chunklist that a catalog there gives for it, reading it back through
+    mmap. The chunks of a package are checked by up to jobs threads at
+    once, and so are packages without a chunklist. Prints the result for
+    each package and returns the number that failed.'''
+    if cache is None:
+        cache = ParseCache()
+    packages = {}
+    for catalog in workdir_catalogs(workdir, cache):
+        for product in catalog.get('Products', {}).values():
+            for package in product.get('Packages', []):
+                if 'URL' not in package:
+                    continue
+                path = local_path_for_url(package['URL'], workdir)
+                try:
+                    info = os.stat(path)
+                except OSError:
+                    continue
+                # a package linked in under several URLs is checked once
+                packages[(info.st_dev, info.st_ino)] = (path, package)
+
+    def verify(item):
+        '''Check one package, returning a reason if it fails'''
+        path, package = item
+        chunks = None
+        if package.get('IntegrityDataURL'):
+            chunklist_path = local_path_for_url(
+                package['IntegrityDataURL'], workdir)
+            try:
+                chunks = parse_chunklist(chunklist_path)
+            except (IOError, ValueError):
+                pass
+        check = IntegrityCheck(package.get('Size'), package.get('Digest'),
+                               chunks)
+        try:
+            damaged = check.damaged_ranges(path, jobs=jobs)
+            if damaged:
+                return '%s damaged chunks' % len(damaged)
+            if not check.matches(path):
+                return 'does not match the size and digest in the catalog'
+        except (IOError, OSError), err:
+            return str(err)
+        return None
 
-def replicate_product(catalog, product_id, workdir, ignore_cache=False):
-    '''Downloads all the packages for a product'''
-    product = catalog['Products'][product_id]
+    items = sorted(packages.values())
+    chunked = [item for item in items
+               if item[1].get('IntegrityDataURL')]
+    unchunked = [item for item in items
+                 if not item[1].get('IntegrityDataURL')]
+    results = ([verify(item) for item in chunked] +
+               concurrent_map(verify, unchunked, jobs))
+    failed = 0
+    for (path, _), reason in zip(chunked + unchunked, results):
+        if reason:
+            failed += 1
+            print 'FAILED %s: %s' % (os.path.relpath(path, workdir), reason)
+        else:
+            print 'OK     %s' % os.path.relpath(path, workdir)
+    print '%s packages checked, %s failed.' % (len(results), failed)
+    return failed
+
+
+def collect_garbage(workdir, cache=None):
+    '''Removes packages from the workdir's PackageStore that no product in
+    any catalog replicated into the workdir refers to, along with their
+    links in the URL-shaped tree. Returns the number of packages and bytes
+    freed.'''
+    store = PackageStore(os.path.join(workdir, STORE_DIR_NAME))
+    if cache is None:
+        cache = ParseCache()
+    try:
+        catalogs = workdir_catalogs(workdir, cache)
+    except (OSError, IOError, SyntaxError, ValueError), err:
+        # keep everything rather than guess what the catalog holds
+        print >> sys.stderr, 'Not collecting garbage: %s' % err
+        return 0, 0
+    if not catalogs:
+        print >> sys.stderr, (
+            'No catalogs in %s, not collecting garbage.' % workdir)
+        return 0, 0
+    referenced = set()
+    for catalog in catalogs:
+        for product in catalog.get('Products', {}).values():
+            for package in product.get('Packages', []):
+                key = store.key(package.get('Digest'), package.get('Size'))
+                if key:
+                    referenced.add(key)
+
+    linked = set()
+    removed = freed = 0
+    for key, path in list(store.blobs()):
+        if key in referenced:
+            continue
+        info = os.stat(path)
+        if info.st_nlink > 1:
+            linked.add((info.st_dev, info.st_ino))
+        os.unlink(path)
+        removed += 1
+        freed += info.st_size
+        print 'Removed %s from the package store' % key
+    # the links into the URL tree hold on to the space too
+    if linked:
+        for path in replicated_files(workdir):
+            info = os.lstat(path)
+            if (info.st_dev, info.st_ino) in linked:
+                os.unlink(path)
+    return removed, freed
+
+
+def rewrite_urls(value, base_url):
+    '''Returns a copy of a catalog or part of one with every http and https
+    URL pointing at the same path under base_url'''
+    if isinstance(value, dict):
+        return dict((key, rewrite_urls(item, base_url))
+                    for key, item in value.items())
+    if isinstance(value, list):
+        return [rewrite_urls(item, base_url) for item in value]
+    if isinstance(value, basestring) and value.startswith(
+            ('http://', 'https://')):
+        url = urlparse.urlsplit(value)
+        return urlparse.urlunsplit(
+            urlparse.urlsplit(base_url)[:2] + (url.path, url.query, ''))
+    return value
+
+
+def is_mirrored(product, workdir):
+    '''Returns True if every file a client needs for product is in the
+    workdir. Only the English distribution file is replicated, so only it
+    is needed.'''
+    if dist_language(product) is None:
+        return False
+    for path in product_files(product, workdir):
+        if not os.path.isfile(path):
+            return False
     for package in product.get('Packages', []):
-        # TO-DO: Check 'Size' attribute and make sure
-        # we have enough space on the target
-        # filesystem before attempting to download
-        if 'URL' in package:
-            try:
-                replicate_url(
-                    package['URL'], root_dir=workdir,
-                    show_progress=True, ignore_cache=ignore_cache)
-            except ReplicationError, err:
-                print >> sys.stderr, (
-                    'Could not replicate %s: %s' % (package['URL'], err))
-                exit(-1)
-        if 'MetadataURL' in package:
+        if package.get('URL') and package.get('Size'):
+            path = local_path_for_url(package['URL'], workdir)
+            if os.path.getsize(path) != package['Size']:
+                return False
+    return True
+
+
+def mirrored_product(product):
+    '''Returns a copy of product offering only the English distribution
+    file, the one the mirror holds'''
+    product = dict(product)
+    language = dist_language(product)
+    product['Distributions'] = {language: product['Distributions'][language]}
+    return product
+
+
+def write_mirror_catalog(catalog, catalog_url, workdir, base_url):
+    '''Writes a copy of catalog for the mirror to serve in place of the one
+    at catalog_url, with its URLs pointing at base_url. Only the products
+    whose files have all been replicated to the workdir are included, each
+    with just its English distribution file.
+    Returns the number of products in it.'''
+    mirror_catalog = dict(catalog)
+    mirror_catalog['Products'] = dict(
+        (product_id, mirrored_product(product))
+        for product_id, product in catalog.get('Products', {}).items()
+        if is_mirrored(product, workdir))
+    path = local_path_for_url(
+        catalog_url, os.path.join(workdir, MIRROR_DIR_NAME))
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    plistlib.writePlist(rewrite_urls(mirror_catalog, base_url),
+                        path + '.new')
+    os.rename(path + '.new', path)
+    return len(mirror_catalog['Products'])
+
+
+class MirrorRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Serves the files replicated to the mirror's workdir by URL path,
+    with the mirror's own copies of catalogs in place of Apple's. Supports
+    single byte-range requests, If-Range and conditional GETs by
+    If-Modified-Since or If-None-Match.'''
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_HEAD(self):
+        '''Send headers only'''
+        self.send_file(head=True)
+
+    def do_GET(self):
+        '''Send headers and content'''
+        self.send_file()
+
+    def local_path(self):
+        '''Returns the path of the file to serve for this request, or None
+        if there isn't one'''
+        url_path = urllib.unquote(urlparse.urlsplit(self.path).path)
+        parts = [part for part in url_path.split('/') if part]
+        # nothing hidden, partial or outside the URL tree
+        if (not parts or
+                any(part.startswith('.') for part in parts) or
+                parts[-1].endswith(UNSERVED_SUFFIXES)):
+            return None
+        # the rewritten catalogs may sit at the top of the URL tree
+        path = os.path.join(self.server.root, MIRROR_DIR_NAME, *parts)
+        if os.path.isfile(path):
+            return path
+        # but the top of the workdir holds its own files, not a host's
+        path = os.path.join(self.server.root, *parts)
+        if len(parts) >= 2 and os.path.isfile(path):
+            return path
+        return None
+
+    def requested_range(self, length, etag, last_modified):
+        '''Returns the (start, end) byte range asked for, None for the
+        whole file, or False if the range can't be satisfied'''
+        range_header = self.headers.getheader('range')
+        if not range_header or not range_header.startswith('bytes='):
+            return None
+        if_range = self.headers.getheader('if-range')
+        if if_range and if_range not in (etag, last_modified):
+            return None
+        byte_range = range_header[len('bytes='):]
+        if ',' in byte_range or '-' not in byte_range:
+            # several ranges at once aren't supported; send it all
+            return None
+        first, last = [item.strip() for item in byte_range.split('-', 1)]
+        try:
+            if not first:
+                start, end = max(0, length - int(last)), length - 1
+            else:
+                start = int(first)
+                end = min(int(last), length - 1) if last else length - 1
+        except ValueError:
+            return None
+        if start > end or start >= length:
+            return False
+        return start, end
+
+    def not_modified(self, info, etag):
+        '''Returns True if the client's copy is current'''
+        if_none_match = self.headers.getheader('if-none-match')
+        if if_none_match:
+            return if_none_match.strip() == '*' or etag in [
+                item.strip() for item in if_none_match.split(',')]
+        if_modified_since = self.headers.getheader('if-modified-since')
+        if if_modified_since:
+            since = email.utils.parsedate_tz(if_modified_since)
+            if since is not None:
+                return int(info.st_mtime) <= email.utils.mktime_tz(since)
+        return False
+
+    def send_file(self, head=False):
+        '''Send the file named by the request path, or part of it'''
+        path = self.local_path()
+        if path is None:
+            self.send_error(404)
+            return
+        try:
+            fileobj = open(path, 'rb')
+        except IOError:
+            self.send_error(404)
+            return
+        with fileobj:
+            info = os.fstat(fileobj.fileno())
+            length = info.st_size
+            etag = '"%x-%x"' % (int(info.st_mtime), length)
+            last_modified = email.utils.formatdate(info.st_mtime, usegmt=True)
+            if self.not_modified(info, etag):
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Last-Modified', last_modified)
+                self.end_headers()
+                return
+            byte_range = self.requested_range(length, etag, last_modified)
+            if byte_range is False:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%s' % length)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            if byte_range:
+                start, end = byte_range
+                self.send_response(206)
+                self.send_header('Content-Range',
+                                 'bytes %s-%s/%s' % (start, end, length))
+            else:
+                start, end = 0, length - 1
+                self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(end - start + 1))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', last_modified)
+            self.end_headers()
+            if head:
+                return
+            fileobj.seek(start)
+            remaining = end - start + 1
+            while remaining:
+                data = fileobj.read(min(READ_SIZE, remaining))
+                if not data:
+                    break
+                self.wfile.write(data)
+                remaining -= len(data)
+
+
+class MirrorServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''Serves a workdir to other hosts, a thread per connection'''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, root, address='', port=MIRROR_PORT):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, (address, port), MirrorRequestHandler)
+        self.root = root
+
+    def handle_error(self, request, client_address):
+        '''Clients going away mid-transfer aren't worth a traceback'''
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(
+                self, request, client_address)
+
+
+def prepare_image(info, workdir, image_size):
+    '''Makes and mounts an empty sparse image of image_size bytes in
+    workdir for a product, where info is its entry from
+    os_installer_product_info. Returns the path of the image and its
+    mountpoint, which is None if it could not be mounted.'''
+    # generate a name for the sparseimage
+    volname = ('Install_macOS_%s-%s' % (info['version'], info['BUILD']))
+    sparse_diskimage_path = os.path.join(workdir, volname + '.sparseimage')
+    if os.path.exists(sparse_diskimage_path):
+        os.unlink(sparse_diskimage_path)
+
+    # make an empty sparseimage and mount it
+    print 'Making empty sparseimage...'
+    sparse_diskimage_path = make_sparse_image(
+        volname, sparse_diskimage_path, size=image_size)
+    return sparse_diskimage_path, mountdmg(sparse_diskimage_path)
+
+
+def prepare_images(product_ids, product_info, workdir, plan):
+    '''Prepares an image for each product in turn, sized as plan, from
+    plan_products, says. Returns a dict of the image path and mountpoint
+    of each.'''
+    images = {}
+    try:
+        for product_id in product_ids:
+            images[product_id] = prepare_image(
+                product_info[product_id], workdir,
+                plan['products'][product_id]['image_size'])
+    except:
+        # don't leave the images already made mounted
+        discard_images(images)
+        raise
+    return images
+
+
+def discard_images(images):
+    '''Unmounts and deletes images from prepare_images that will not be
+    used'''
+    for sparse_diskimage_path, mountpoint in images.values():
+        if mountpoint:
+            unmountdmg(mountpoint)
+        if os.path.exists(sparse_diskimage_path):
+            os.unlink(sparse_diskimage_path)
+
+
+def finish_image(product_id, info, image, compress=False):
+    '''Installs a downloaded product to the image prepared for it, and if
+    compress is True makes a read-only compressed disk image of the
+    Install macOS app from it. Returns True on success.'''
+    sparse_diskimage_path, mountpoint = image
+    if not mountpoint:
+        return False
+    # install the product to the mounted sparseimage volume
+    success = install_product(info['DistributionPath'], mountpoint)
+    if not success:
+        print >> sys.stderr, 'Product installation failed.'
+        EVENTS.emit('error', product_id=product_id,
+                    message='Product installation failed.')
+        unmountdmg(mountpoint)
+        return False
+    print 'Product downloaded and installed to %s' % sparse_diskimage_path
+    EVENTS.emit('installed', product_id=product_id,
+                path=sparse_diskimage_path)
+    if not compress:
+        unmountdmg(mountpoint)
+    else:
+        # if --compress option given, create a r/o compressed diskimage
+        # containing the Install macOS app
+        compressed_diskimagepath = (
+            os.path.splitext(sparse_diskimage_path)[0] + '.dmg')
+        if os.path.exists(compressed_diskimagepath):
+            os.unlink(compressed_diskimagepath)
+        applications_dir = os.path.join(mountpoint, 'Applications')
+        for item in os.listdir(applications_dir):
+            if item.endswith('.app'):
+                app_path = os.path.join(applications_dir, item)
+                make_compressed_dmg(app_path, compressed_diskimagepath)
+                break
+        # unmount sparseimage
+        unmountdmg(mountpoint)
+        # delete sparseimage since we don't need it any longer
+        os.unlink(sparse_diskimage_path)
+    return True
+
+
+def download_products(catalog, product_ids, workdir, plan,
+                      ignore_cache=False, jobs=DEFAULT_JOBS,
+                      segments=DEFAULT_SEGMENTS, cancel=None):
+    '''Downloads the packages of the products with replicate_products,
+    emitting an event as each product starts and finishes. Returns a dict
+    of the paths of the replicated files of each product. Raises
+    ReplicationError if any of them could not be replicated.'''
+    for product_id in product_ids:
+        product_plan = plan['products'][product_id]
+        EVENTS.emit('product_download_started', product_id=product_id,
+                    packages=product_plan['packages'],
+                    size=product_plan['package_bytes'],
+                    fetch=product_plan['fetch_bytes'])
+    product_paths = replicate_products(
+        catalog, product_ids, workdir, ignore_cache=ignore_cache, jobs=jobs,
+        segments=segments, cancel=cancel)
+    for product_id in product_ids:
+        EVENTS.emit('product_download_done', product_id=product_id)
+    return product_paths
+
+
+def build_products(catalog, product_ids, product_info, workdir, plan,
+                   compress=False, ignore_cache=False, jobs=DEFAULT_JOBS,
+                   segments=DEFAULT_SEGMENTS, overlap=True):
+    '''Downloads the products and makes an image of each. Making and
+    mounting the images does not need the packages, so with overlap it
+    runs on a background thread while they download, leaving only the
+    installs to wait for them. Returns a dict of the paths of the files
+    replicated for each product, and a list of the products that could not
+    be built. If the downloads fail, any images already made are removed
+    before the error is raised. If making the images fails, the downloads
+    are abandoned.'''
+    images = BackgroundTask(prepare_images, product_ids, product_info,
+                            workdir, plan)
+    if overlap:
+        images.start()
+    try:
+        product_paths = download_products(
+            catalog, product_ids, workdir, plan, ignore_cache=ignore_cache,
+            jobs=jobs, segments=segments,
+            cancel=images.failed if overlap else None)
+    except:
+        error = sys.exc_info()
+        # whatever stopped the downloads, don't leave images mounted
+        if overlap:
             try:
-                replicate_url(package['MetadataURL'], root_dir=workdir,
-                              ignore_cache=ignore_cache)
-            except ReplicationError, err:
-                print >> sys.stderr, (
-                    'Could not replicate %s: %s'
-                    % (package['MetadataURL'], err))
-                exit(-1)
+                discard_images(images.result())
+            except BaseException, err:
+                # prepare_images has removed its own images; if it exited,
+                # it has said why already
+                print >> sys.stderr, 'Could not prepare the images%s' % (
+                    '' if isinstance(err, SystemExit) else ': %s' % err)
+        raise error[0], error[1], error[2]
+    if not overlap:
+        images.run()
+    prepared = images.result()
+    # install and compress each product in turn
+    failed = [product_id for product_id in product_ids
+              if not finish_image(product_id, product_info[product_id],
+                                  prepared[product_id], compress=compress)]
+    return product_paths, failed
+
 
 def main():
     '''Do the main thing here'''
 
-    if os.getuid() != 0:
-        sys.exit('This command requires root (to install packages), so please '
-                 'run again with sudo or as root.')
-
     parser = argparse.ArgumentParser()
     parser.add_argument('--catalogurl', metavar='sucatalog_url',
                         default=DEFAULT_SUCATALOG,
                         help='Software Update catalog URL.')
     parser.add_argument('--workdir', metavar='path_to_working_dir',
                         default='.',
-                        help='Path to working directory on a volume with over '
-                        '10G of available space. Defaults to current working '
-                        'directory.')
+                        help='Path to working directory on a volume with '
+                        'enough available space for the product; see --plan. '
+                        'Defaults to current working directory.')
     parser.add_argument('--compress', action='store_true',
                         help='Output a read-only compressed disk image with '
                         'the Install macOS app at the root.')
     parser.add_argument('--ignore-cache', action='store_true',
                         help='Ignore any previously cached files.')
-    parser.add_argument('--build', metavar='build_version',
-                        default='',
-                        help='Specify a specific build to search for and '
-                        'download.')
+    parser.add_argument('--build', metavar='build_version', nargs='+',
+                        default=[],
+                        help='Specify one or more builds to search for and '
+                        'download. Several builds are downloaded together, '
+                        'fetching packages they share once, and then made '
+                        'into an image each.')
+    parser.add_argument('--all-matching', metavar='PATTERN',
+                        help='Download every build whose build or version '
+                        'matches the shell-style PATTERN, such as "18G*" or '
+                        '"10.14.*", as with several --build versions.')
     parser.add_argument('--list', action='store_true',
                         help='Output the available updates to a plist '
                         'and quit.')
+    parser.add_argument('--incremental', action='store_true',
+                        help='With --list, only output the products added, '
+                        'changed or removed since the last --incremental '
+                        'listing of the same catalog, fetching details of '
+                        'new and changed products only.')
+    parser.add_argument('--format', dest='output_format',
+                        choices=('text', 'ndjson'), default='text',
+                        help='With ndjson, write one JSON event per line to '
+                        'stdout as each product is listed and as each '
+                        'package downloads, with all other output going to '
+                        'stderr. Defaults to text.')
+    parser.add_argument('--trace', metavar='path',
+                        help='Write the time, bytes received, cache hits and '
+                        'peak memory use of each phase of the run to path '
+                        'as JSON.')
+    parser.add_argument('--plan', action='store_true',
+                        help='Output the disk space needed to download and '
+                        'install the chosen product, and quit.')
+    parser.add_argument('--mirror', action='store_true',
+                        help='Download the chosen product and serve it to '
+                        'other hosts over HTTP, with a copy of the catalog '
+                        'pointing at this host, until interrupted. Other '
+                        'hosts use the catalog URL printed as --catalogurl.')
+    parser.add_argument('--mirror-url', metavar='URL',
+                        help='Base URL other hosts reach the mirror at. '
+                        'Defaults to http://<this host>:<port>.')
+    parser.add_argument('--port', metavar='N', type=int,
+                        default=MIRROR_PORT,
+                        help='Port the mirror listens on, or 0 for any free '
+                        'port. Defaults to %s.' % MIRROR_PORT)
+    parser.add_argument('--bind', metavar='ADDRESS', default='',
+                        help='Address the mirror listens on. Defaults to '
+                        'all addresses.')
+    parser.add_argument('--gc', action='store_true',
+                        help='Remove packages no longer referred to by any '
+                        'catalog in the working directory from its package '
+                        'store, and quit.')
+    parser.add_argument('--cache-limit', metavar='SIZE', type=parse_size,
+                        help='Evict the least recently used downloads from '
+                        'the working directory until it uses no more than '
+                        'SIZE bytes, such as 500M or 40G. The selected '
+                        'product is never evicted.')
+    parser.add_argument('--cache-report', action='store_true',
+                        help='Output a summary of the downloads cached in '
+                        'the working directory and quit.')
+    parser.add_argument('--verify-only', action='store_true',
+                        help='Check the packages already downloaded to the '
+                        'working directory against the sizes, digests and '
+                        'chunklists in its catalogs, and quit.')
+    parser.add_argument('--jobs', metavar='N', type=int,
+                        default=DEFAULT_JOBS,
+                        help='Number of packages to download at the same '
+                        'time. Defaults to %s.' % DEFAULT_JOBS)
+    parser.add_argument('--max-rate', metavar='RATE', type=parse_size,
+                        help='Limit all downloads together to RATE bytes '
+                        'per second, such as 500K or 10M.')
+    parser.add_argument('--host-rate', metavar='[HOST=]RATE',
+                        type=parse_host_rate, action='append', default=[],
+                        help='Limit downloads from each host, or from HOST '
+                        'only, to RATE bytes per second. May be given more '
+                        'than once.')
+    parser.add_argument('--rate-schedule', metavar='HH:MM-HH:MM=RATE',
+                        type=parse_rate_schedule, action='append',
+                        default=[],
+                        help='Limit all downloads together to RATE bytes per '
+                        'second between those local times instead of '
+                        '--max-rate, such as 08:00-18:00=2M. A RATE of 0 is '
+                        'no limit. May be given more than once; the first '
+                        'window that applies is used.')
+    parser.add_argument('--segments', metavar='N', type=int,
+                        default=DEFAULT_SEGMENTS,
+                        help='Number of byte ranges to fetch at the same '
+                        'time for each large package. Defaults to %s.'
+                        % DEFAULT_SEGMENTS)
     args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    if args.segments < 1:
+        parser.error('--segments must be at least 1')
+    if args.incremental and not args.list:
+        parser.error('--incremental only applies to --list')
+    if args.output_format == 'ndjson':
+        # keep stdout for events alone
+        EVENTS.start(sys.stdout)
+        sys.stdout = sys.stderr
+    atexit.register(PHASES.finish, args.trace)
+    RATE_LIMIT.configure(args.max_rate, args.host_rate, args.rate_schedule)
+
+    # only installing needs root; listing, planning and mirroring don't
+    installing = not (args.list or args.plan or args.mirror or args.gc or
+                      args.verify_only or args.cache_report)
+    if installing and os.getuid() != 0:
+        sys.exit('This command requires root (to install packages), so please '
+                 'run again with sudo or as root.')
+
+    if args.gc:
+        cache = ParseCache(os.path.join(args.workdir, PARSE_CACHE_NAME))
+        removed, freed = collect_garbage(args.workdir, cache=cache)
+        cache.save()
+        print 'Removed %s packages, freeing %s.' % (removed, human_size(freed))
+        exit(0)
+
+    if args.verify_only:
+        cache = ParseCache(os.path.join(args.workdir, PARSE_CACHE_NAME))
+        try:
+            failed = verify_workdir(args.workdir, cache=cache)
+        except (OSError, IOError, SyntaxError, ValueError), err:
+            print >> sys.stderr, err
+            exit(-1)
+        cache.save()
+        exit(-1 if failed else 0)
+
+    CACHE_INDEX.open(args.workdir)
+    if args.cache_report:
+        print_cache_report(args.cache_limit)
+        exit(0)
 
     # download sucatalog and look for products that are for macOS installers
+    cache = ParseCache(os.path.join(args.workdir, PARSE_CACHE_NAME),
+                       refresh=args.ignore_cache)
     catalog = download_and_parse_sucatalog(
-        args.catalogurl, args.workdir, ignore_cache=args.ignore_cache)
+        args.catalogurl, args.workdir, ignore_cache=args.ignore_cache,
+        product_filter=is_mac_os_installer, filter_key=INSTALLERS_FILTER_KEY,
+        cache=cache)
+    catalog_path = local_path_for_url(args.catalogurl, args.workdir)
+    output_plist = "%s/softwareupdate.plist" % args.workdir
+
+    if args.incremental:
+        state_path = os.path.join(args.workdir, LIST_STATE_NAME)
+        state = load_list_state(state_path)
+        result, state[args.catalogurl] = list_changes(
+            catalog, state.get(args.catalogurl, {}), args.workdir,
+            ignore_cache=args.ignore_cache, cache=cache)
+        cache.save()
+        plistlib.writePlist({'result': result}, output_plist)
+        save_list_state(state_path, state)
+        EVENTS.emit('list_done', changes=len(result), plist=output_plist)
+        # the product info cache depends on the metadata and dist files
+        pinned = [catalog_path]
+        for product in catalog['Products'].values():
+            pinned.extend(product_files(product, args.workdir,
+                                        packages=False))
+        trim_cache(args.cache_limit, pinned=pinned)
+        exit(0)
+
     product_info = os_installer_product_info(
-        catalog, args.workdir, ignore_cache=args.ignore_cache)
+        catalog, args.workdir, ignore_cache=args.ignore_cache, cache=cache)
+    cache.save()
+    CACHE_INDEX.save()
 
     if not product_info:
         print >> sys.stderr, (
             'No macOS installer products found in the sucatalog.')
         exit(-1)
 
-    output_plist = "%s/softwareupdate.plist" % args.workdir
     pl = {}
     pl['result'] = []
 
@@ -863,84 +3309,116 @@ def main():
 
         pl['result'].append(pl_index)
 
-        if args.build:
-            if args.build == product_info[product_id]['BUILD']:
-                answer = index+1
-
 
     # Output a plist of available updates and quit if --list option chosen
     if args.list:
         plistlib.writePlist(pl, output_plist)
+        EVENTS.emit('list_done', products=len(pl['result']),
+                    plist=output_plist)
+        pinned = [catalog_path]
+        for product_id in product_info:
+            pinned.extend(product_files(catalog['Products'][product_id],
+                                        args.workdir, packages=False))
+        trim_cache(args.cache_limit, pinned=pinned)
         exit(0)
 
-    # check for specified build if argument supplied
-    if args.build:
-        try:
-            answer
-        except NameError:
-            print ('No valid build chosen. Run again without --build argument'
-                   'to select a valid build to download.')
+    # check for specified builds if arguments supplied
+    if args.build or args.all_matching:
+        selected = []
+        for product_id, info in product_info.items():
+            if info['BUILD'] in args.build or (
+                    args.all_matching and (
+                        fnmatch.fnmatch(info['BUILD'], args.all_matching) or
+                        fnmatch.fnmatch(info['version'],
+                                        args.all_matching))):
+                selected.append(product_id)
+        found = [product_info[product_id]['BUILD'] for product_id in selected]
+        missing = [build for build in args.build if build not in found]
+        if missing or not selected:
+            print ('No valid build chosen%s. Run again without --build '
+                   'argument to select a valid build to download.' % (
+                       missing and ' for %s' % ', '.join(missing) or ''))
             exit(0)
-        else:
-            print '# %s chosen.' % answer
+        for product_id in selected:
+            print '# %s chosen.' % (product_info.keys().index(product_id) + 1)
     else:
         answer = raw_input(
                 '\nChoose a product to download (1-%s): ' % len(product_info))
+        try:
+            index = int(answer) - 1
+            if index < 0:
+                raise ValueError
+            selected = [product_info.keys()[index]]
+        except (ValueError, IndexError):
+            print 'Exiting.'
+            exit(0)
 
+    # make sure there is room for the products before spending any time
+    # downloading them
+    plan = plan_products(catalog, selected, args.workdir,
+                         compress=args.compress, install=not args.mirror)
+    if args.plan:
+        print_plan(plan, args.workdir)
+        exit(0 if plan['fits'] else -1)
+    if not plan['fits']:
+        print >> sys.stderr, (
+            'Not enough free space in %s: %s needed, %s free. Run again '
+            'with --plan for details.' % (
+                args.workdir, human_size(plan['needed']),
+                human_size(plan['free'])))
+        exit(-1)
+
+    # download all the packages for the selected products together,
+    # preparing images for them meanwhile unless only mirroring
     try:
-        index = int(answer) - 1
-        if index < 0:
-            raise ValueError
-        product_id = product_info.keys()[index]
-    except (ValueError, IndexError):
-        print 'Exiting.'
+        if args.mirror:
+            product_paths = download_products(
+                catalog, selected, args.workdir, plan,
+                ignore_cache=args.ignore_cache, jobs=args.jobs,
+                segments=args.segments)
+            failed = []
+        else:
+            product_paths, failed = build_products(
+                catalog, selected, product_info, args.workdir, plan,
+                compress=args.compress, ignore_cache=args.ignore_cache,
+                jobs=args.jobs, segments=args.segments)
+    except ReplicationError, err:
+        print >> sys.stderr, err
+        print >> sys.stderr, 'Product download failed.'
+        for product_id in selected:
+            EVENTS.emit('error', product_id=product_id, message=str(err))
+        CACHE_INDEX.save()
+        exit(-1)
+    pinned = [catalog_path]
+    for product_id in selected:
+        pinned.extend(product_paths[product_id])
+        pinned.extend(product_files(catalog['Products'][product_id],
+                                    args.workdir))
+    trim_cache(args.cache_limit, pinned=pinned)
+
+    if args.mirror:
+        try:
+            server = MirrorServer(args.workdir, args.bind, args.port)
+        except socket.error, err:
+            print >> sys.stderr, 'Could not start the mirror: %s' % err
+            exit(-1)
+        base_url = args.mirror_url or 'http://%s:%s' % (
+            socket.getfqdn(), server.server_address[1])
+        count = write_mirror_catalog(catalog, args.catalogurl, args.workdir,
+                                     base_url)
+        print 'Mirroring %s products. Catalog URL for other hosts:' % count
+        print rewrite_urls(args.catalogurl, base_url)
+        sys.stdout.flush()
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        server.server_close()
         exit(0)
 
-    # download all the packages for the selected product
-    replicate_product(
-        catalog, product_id, args.workdir, ignore_cache=args.ignore_cache)
-
-    # generate a name for the sparseimage
-    volname = ('Install_macOS_%s-%s'
-               % (product_info[product_id]['version'],
-                  product_info[product_id]['BUILD']))
-    sparse_diskimage_path = os.path.join(args.workdir, volname + '.sparseimage')
-    if os.path.exists(sparse_diskimage_path):
-        os.unlink(sparse_diskimage_path)
-
-    # make an empty sparseimage and mount it
-    print 'Making empty sparseimage...'
-    sparse_diskimage_path = make_sparse_image(volname, sparse_diskimage_path)
-    mountpoint = mountdmg(sparse_diskimage_path)
-    if mountpoint:
-        # install the product to the mounted sparseimage volume
-        success = install_product(
-            product_info[product_id]['DistributionPath'],
-            mountpoint)
-        if not success:
-            print >> sys.stderr, 'Product installation failed.'
-            unmountdmg(mountpoint)
-            exit(-1)
-        print 'Product downloaded and installed to %s' % sparse_diskimage_path
-        if not args.compress:
-            unmountdmg(mountpoint)
-        else:
-            # if --compress option given, create a r/o compressed diskimage
-            # containing the Install macOS app
-            compressed_diskimagepath = os.path.join(
-                args.workdir, volname + '.dmg')
-            if os.path.exists(compressed_diskimagepath):
-                os.unlink(compressed_diskimagepath)
-            applications_dir = os.path.join(mountpoint, 'Applications')
-            for item in os.listdir(applications_dir):
-                if item.endswith('.app'):
-                    app_path = os.path.join(applications_dir, item)
-                    make_compressed_dmg(app_path, compressed_diskimagepath)
-                    break
-            # unmount sparseimage
-            unmountdmg(mountpoint)
-            # delete sparseimage since we don't need it any longer
-            os.unlink(sparse_diskimage_path)
+    if failed:
+        print >> sys.stderr, 'Failed to build %s.' % ', '.join(failed)
+        exit(-1)
 
 
 if __name__ == '__main__':
@@ -2,15 +2,20 @@
 
 ## release-to-jss.py: push a tagged release from git to the JSS
 import subprocess
-import dircache
 import os
-import io
 import re
+import sys
 import argparse
 import tempfile
 import shutil
+import threading
+import hashlib
+import json
+import time
+import Queue
+from contextlib import contextmanager
 from string import Template
-from base64 import b64encode
+from base64 import b64encode, b64decode
 import jss
 
 DESCRIPTION = """A tool to update scripts on the JSS to match a tagged release in a Git repository.
@@ -37,6 +42,16 @@ EPILOG = """
 
 TMPDIR = None
 
+# History of every file in the tagged checkout, read once per run
+GIT_INDEX = None
+
+# Serialises output from concurrent pushes, so lines don't interleave
+OUTPUT_LOCK = threading.Lock()
+
+# Seconds spent in, and number of times through, each phase of the push
+TIMINGS = {}
+TIMINGS_LOCK = threading.Lock()
+
 class Git2JSSError(BaseException):
     """ Generic error class for this script """
     pass
@@ -45,6 +60,7 @@ def _get_args():
     """ Parse arguments from the commandline and return something sensible """
 
     parser = argparse.ArgumentParser(usage=('release-to-jss.py [-h] [--create] '
+                                            '[--force] [--jobs N] [--trace FILE] '
                                             '[--all | --file FILE '
                                             '[ --name NAME ] ] TAG'),
                                      description=DESCRIPTION, epilog=EPILOG,
@@ -61,6 +77,18 @@ def _get_args():
     parser.add_argument('--create', action='store_true', default=False, dest='create_tag',
                         help="If TAG doesn't exist, then create it and push to the server")
 
+    parser.add_argument('--force', action='store_true', default=False, dest='force',
+                        help=('Save scripts to the JSS even if their contents and '
+                              'notes already match'))
+
+    parser.add_argument('--jobs', metavar='N', dest='jobs', type=int, default=1,
+                        help=('Number of scripts to push to the JSS at the same '
+                              'time (default 1)'))
+
+    parser.add_argument('--trace', metavar='FILE', dest='trace', type=str,
+                        help=('Write the time spent cloning, reading git info, '
+                              'templating, loading and saving to FILE as JSON'))
+
     file_or_all = parser.add_mutually_exclusive_group()
 
     file_or_all.add_argument('--file', metavar='FILE', dest='script_file', type=str,
@@ -72,6 +100,9 @@ def _get_args():
 
     options = parser.parse_args()
 
+    if options.jobs < 1:
+        parser.error("--jobs must be at least 1")
+
     # --name doesn't make any sense with --all, but argparse won't
     # let us express that with groups, so add in a hacky check here
     if options.push_all and options.script_name:
@@ -82,8 +113,9 @@ def _get_args():
 
 def _main(options):
     """ Main function """
-    global TMPDIR
+    global TMPDIR, GIT_INDEX
     TMPDIR = make_temp_dir()
+    started = time.time()
 
     if not tag_exists(options.tag):
         if options.create_tag:
@@ -99,23 +131,111 @@ def _main(options):
     print "Pushing tag %s to jss: %s" % (options.tag, jss_prefs.url)
 
     try:
-        checkout_tag(options.tag)
+        with timed('clone'):
+            repo_dir = checkout_tag(options.tag)
+        with timed('git info'):
+            GIT_INDEX = GitIndex(repo_dir, options.tag)
 
         if options.push_all:
-            files = [x for x in dircache.listdir(".")
+            # the scripts at the top level of the tag
+            files = [x for x in GIT_INDEX.files
                      if not re.match(r'^\.', x)
                      and re.match(r'.*\.(sh|py|pl)$', x)]
         else:
             files = [options.script_file]
 
-        for script in files:
-            process_script(script, options, _jss)
+        results = push_scripts(files, options, _jss)
+        print_summary(results)
+        if results['failed']:
+            raise Git2JSSError("%d of %d scripts failed to push"
+                               % (len(results['failed']), len(files)))
 
     except:
         print "Something went wrong."
         raise
     finally:
+        if GIT_INDEX:
+            GIT_INDEX.close()
         cleanup_tmp()
+        if options.trace:
+            write_trace(options.trace, time.time() - started, options.jobs)
+
+@contextmanager
+def timed(phase):
+    """ Add the time spent in the enclosed code to TIMINGS[phase] """
+    start = time.time()
+    try:
+        yield
+    finally:
+        with TIMINGS_LOCK:
+            timing = TIMINGS.setdefault(phase, {'seconds': 0, 'count': 0})
+            timing['seconds'] += time.time() - start
+            timing['count'] += 1
+
+
+def write_trace(path, seconds, jobs):
+    """ Write the TIMINGS to path as JSON. With more than one job the
+    phases overlap, so their seconds can add up to more than the total
+    """
+    with open(path, 'w') as handle:
+        json.dump({'seconds': seconds, 'jobs': jobs, 'phases': TIMINGS},
+                  handle, indent=2, sort_keys=True)
+
+
+def log(message):
+    """ Print message in one piece, even with other pushes running """
+    with OUTPUT_LOCK:
+        sys.stdout.write(message + "\n")
+        sys.stdout.flush()
+
+
+def push_scripts(files, options, _jss):
+    """ Push each of files to the JSS, up to options.jobs at a time.
+    A failure to push one script doesn't stop the others. Returns a
+    dict listing the scripts 'saved', 'unchanged', 'skipped' and 'failed'
+    """
+    results = {'saved': [], 'unchanged': [], 'skipped': [], 'failed': []}
+    pending = Queue.Queue()
+    for script in files:
+        pending.put(script)
+    results_lock = threading.Lock()
+
+    def worker():
+        """ Push scripts until there are none left """
+        while True:
+            try:
+                script = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                outcome = process_script(script, options, _jss)
+            except (Exception, Git2JSSError) as err:
+                log("Failed to push %s: %s" % (script, err))
+                outcome = 'failed'
+            with results_lock:
+                results[outcome].append(script)
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(min(options.jobs, len(files)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        # join with a timeout so that Ctrl-C still reaches us
+        while thread.is_alive():
+            thread.join(0.5)
+    return results
+
+
+def print_summary(results):
+    """ Print how many scripts were saved, unchanged, skipped and failed """
+    print "Saved %d, unchanged %d, skipped %d, failed %d." % (
+        len(results['saved']), len(results['unchanged']),
+        len(results['skipped']), len(results['failed']))
+    for outcome in ('skipped', 'failed'):
+        for script in sorted(results[outcome]):
+            print "  %s: %s" % (outcome, script)
+
 
 def make_temp_dir():
     """ Create a temporary directory """
@@ -129,48 +249,113 @@ def load_script(_jss, script_name):
     except:
         raise
     else:
-        print "Loaded %s from the JSS" % script_name
+        log("Loaded %s from the JSS" % script_name)
         return jss_script
 
 def process_script(script, options, _jss):
     """ Load the script from the JSS, insert the new
-    code and log messages, the re-upload to the JSS
+    code and log messages, the re-upload to the JSS unless
+    that leaves it unchanged (or options.force is set).
+    Returns 'saved', 'unchanged', or 'skipped' if the JSS has no
+    such script
     """
     if not options.script_name:
-        print "No name specified, assuming %s" % script
+        log("No name specified, assuming %s" % script)
         jss_name = script
     else:
         jss_name = options.script_name
     try:
-        print "Loading %s" % jss_name
-        jss_script = load_script(_jss, jss_name)
+        log("Loading %s" % jss_name)
+        with timed('load'):
+            jss_script = load_script(_jss, jss_name)
     except jss.exceptions.JSSGetError:
-        print "Skipping %s: couldn't load it from the JSS" % jss_name
-        return
+        log("Skipping %s: couldn't load it from the JSS" % jss_name)
+        return 'skipped'
+
+    loaded_hash = script_hash(jss_script)
+    with timed('git info'):
+        script_info = get_git_info(_jss, script, options.tag)
+    with timed('templating'):
+        update_script(jss_script, script, script_info)
+    if not options.force and script_hash(jss_script) == loaded_hash:
+        log("%s is unchanged on the JSS, not saving it" % jss_name)
+        return 'unchanged'
+    with timed('save'):
+        save_script(jss_script)
+    return 'saved'
+
+def script_hash(jss_script):
+    """ Return a hash of the notes and contents of jss_script, so that
+    the copy on the JSS can be compared with the one we would push.
+    The contents are taken from script_contents_encoded if it is set,
+    otherwise from script_contents
+    """
+    def text_of(tag):
+        """ The text of the tag element, as UTF-8 """
+        element = jss_script.find(tag)
+        text = element.text if element is not None and element.text else ''
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        return text
+
+    encoded = text_of('script_contents_encoded')
+    if encoded:
+        try:
+            contents = b64decode(encoded)
+        except TypeError:
+            contents = encoded
+    else:
+        contents = text_of('script_contents')
+    digest = hashlib.sha256()
+    for part in (text_of('notes'), contents):
+        digest.update("%d:%s" % (len(part), part))
+    return digest.hexdigest()
 
-    script_info = get_git_info(_jss, script, options.tag)
-    update_script(jss_script, script, script_info)
-    save_script(jss_script)
 
 def checkout_tag(script_tag):
-    """ Check out a fresh copy of the tag we are going to operate on
-        script_tag must be present on the git master
+    """ Find a copy of the tag we are going to operate on, and return
+        the directory of the git repository holding it.
+        script_tag must be present on the git master. If our own copy
+        of the tag matches origin's, it is read straight from the local
+        object store; otherwise the history of the tag, without file
+        contents, is cloned into TMPDIR, and only the scripts we push
+        are fetched later
     """
     origin = subprocess.check_output(["git", "config", "--get",
                                       "remote.origin.url"]).strip()
     if re.search(r'\.git$', origin):
         origin = origin[:-4]
+    print origin
+    fnull = open(os.devnull, 'w')
     try:
-        print origin
-        fnull = open(os.devnull, 'w')
-        subprocess.check_call(["git", "clone", "-q", "--branch",
-                               script_tag, origin + ".git", TMPDIR],
+        remote = subprocess.check_output(["git", "ls-remote", origin + ".git",
+                                          "refs/tags/" + script_tag],
+                                         stderr=fnull).split()
+    except subprocess.CalledProcessError:
+        remote = []
+    if not remote:
+        raise Git2JSSError("Couldn't check out tag %s: are you sure it exists?" % script_tag)
+
+    try:
+        local = subprocess.check_output(["git", "rev-parse", "-q", "--verify",
+                                         "refs/tags/" + script_tag],
+                                        stderr=fnull).strip()
+    except subprocess.CalledProcessError:
+        local = None
+    if local == remote[0]:
+        return subprocess.check_output(["git", "rev-parse",
+                                        "--show-toplevel"]).strip()
+
+    try:
+        subprocess.check_call(["git", "clone", "-q", "--filter=blob:none",
+                               "--no-checkout", "--branch", script_tag,
+                               origin + ".git", TMPDIR],
                               stderr=subprocess.STDOUT,
                               stdout=fnull)
     except subprocess.CalledProcessError:
         raise Git2JSSError("Couldn't check out tag %s: are you sure it exists?" % script_tag)
     else:
-        return True
+        return TMPDIR
 
 def tag_exists(tag):
     """ Check whether a tag exists. Returns True or false """
@@ -206,36 +391,117 @@ def update_script(jss_script, script_file, script_info, should_template=True):
     # Update the script - we need to write a base64 encoded version
     # of the contents of script_file into the 'script_contents_encoded'
     # element of the script object
-    with io.open(TMPDIR + "/" + script_file, 'r', encoding="utf-8") as handle:
-        if should_template:
-            print "Templating script..."
-            jss_script.find('script_contents_encoded').text = b64encode(
-                template_script(handle.read(), script_info).encode('utf-8'))
-        else:
-            print "No templating requested."
-            jss_script.find('script_contents_encoded').text = b64encode(
-                handle.read().encode('utf-8'))
+    contents = GIT_INDEX.read(script_file)
+    if should_template:
+        log("Templating %s..." % script_file)
+        jss_script.find('script_contents_encoded').text = b64encode(
+            template_script(contents, script_info).encode('utf-8'))
+    else:
+        log("No templating requested for %s." % script_file)
+        jss_script.find('script_contents_encoded').text = b64encode(
+            contents.encode('utf-8'))
 
     # Only one of script_contents and script_contents_encoded should be sent
     # so delete the one we are not using.
     jss_script.remove(jss_script.find('script_contents'))
 
 
+class GitIndex(object):
+    """ The origin URL, files and history of a tag, read from the
+    object store of the repository holding it rather than from a
+    working copy: one 'git log' over the whole repo gives the history
+    of every file, and one 'git cat-file --batch' process reads the
+    contents of any of them
+    """
+
+    # Starts each commit's line in the log; paths follow on their own lines
+    MARKER = '\x00'
+
+    def __init__(self, repo_dir, tag):
+        self.repo_dir = repo_dir
+        self.tag = tag
+        # as checkout_tag clones it
+        origin = subprocess.check_output(["git", "config",
+                                          "--get", "remote.origin.url"],
+                                         cwd=repo_dir).strip()
+        self.origin = re.sub(r'\.git$', '', origin) + ".git"
+
+        self.files = []
+        tree = subprocess.check_output(["git", "ls-tree", "-z", tag],
+                                       cwd=repo_dir)
+        for entry in tree.split('\0'):
+            if entry:
+                details, path = entry.split('\t', 1)
+                if details.split()[1] == 'blob':
+                    self.files.append(path)
+
+        self.history = {}
+        # without rename detection, whatever diff.renames says, as
+        # 'git log FILE' attributes commits, and so that a partial clone
+        # doesn't fetch blobs to compare
+        output = subprocess.check_output(["git", "-c", "core.quotepath=off",
+                                          "log", "--name-only", "--no-renames",
+                                          "--format=%x00%h%x00%ad%x00%cD%x00%ce%x00%s",
+                                          tag],
+                                         cwd=repo_dir)
+        commit = None
+        for line in output.split('\n'):
+            if line.startswith(self.MARKER):
+                commit = line[1:].split(self.MARKER, 4)
+            elif line and commit:
+                # newest first, as 'git log FILE' lists them
+                self.history.setdefault(line, []).append(commit)
+
+        self.lock = threading.Lock()
+        self.reader = subprocess.Popen(["git", "cat-file", "--batch"],
+                                       stdin=subprocess.PIPE,
+                                       stdout=subprocess.PIPE,
+                                       cwd=repo_dir)
+
+    def read(self, path):
+        """ The contents of path in the tag, as text with universal
+        newlines, as io.open would read it from a checkout """
+        with self.lock:
+            self.reader.stdin.write("%s:%s\n" % (self.tag, path))
+            self.reader.stdin.flush()
+            header = self.reader.stdout.readline().split()
+            if len(header) != 3 or header[1] != 'blob':
+                raise Git2JSSError("%s is not a file in tag %s" % (path, self.tag))
+            data = self.reader.stdout.read(int(header[2]))
+            self.reader.stdout.read(1)
+        text = data.decode('utf-8')
+        return text.replace(u'\r\n', u'\n').replace(u'\r', u'\n')
+
+    def close(self):
+        """ Stop the cat-file process """
+        self.reader.stdin.close()
+        self.reader.wait()
+
+    def date(self, path):
+        """ The date of the last commit to path, as 'git log -1
+        --format="%ad"' gives it, quotes and all """
+        commits = self.history.get(path)
+        if not commits:
+            return ''
+        return '"%s"' % commits[0][1]
+
+    def log(self, path):
+        """ The log of path, as 'git log --format=%h - %cD %ce: %n %s%n'
+        gives it """
+        return ''.join("%s - %s %s: \n %s\n\n" % (commit[0], commit[2],
+                                                    commit[3], commit[4])
+                       for commit in self.history.get(path, [])).strip()
+
+
 def get_git_info(jss_prefs, script_file, script_tag):
     """ Populate a dict with information about the script """
     git_info = {}
     git_info['VERSION'] = script_tag
-    git_info['ORIGIN'] = subprocess.check_output(["git", "config",
-                                                  "--get", "remote.origin.url"],
-                                                 cwd=TMPDIR).strip()
+    git_info['ORIGIN'] = GIT_INDEX.origin
     git_info['PATH'] = script_file
-    git_info['DATE'] = subprocess.check_output(["git", "log",
-                                                "-1", '--format="%ad"',
-                                                script_file], cwd=TMPDIR).strip()
+    git_info['DATE'] = GIT_INDEX.date(script_file)
     git_info['USER'] = jss_prefs.user
-    git_info['LOG'] = subprocess.check_output(["git", "log",
-                                               '--format=%h - %cD %ce: %n %s%n',
-                                               script_file], cwd=TMPDIR).strip()
+    git_info['LOG'] = GIT_INDEX.log(script_file)
     return git_info
 
 
@@ -253,7 +519,7 @@ def template_script(text, script_info):
     try:
         out = tmpl.safe_substitute(script_info)
     except:
-        print "Failed to template this script."
+        log("Failed to template this script.")
         raise
 
     return out
@@ -264,10 +530,10 @@ def save_script(jss_script):
     try:
         jss_script.save()
     except:
-        print "Failed to save the script to the jss"
+        log("Failed to save %s to the jss" % jss_script.find('name').text)
         raise
     else:
-        print "Saved %s to the JSS." % jss_script.find('name').text
+        log("Saved %s to the JSS." % jss_script.find('name').text)
         return True
 
 